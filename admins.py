@@ -0,0 +1,51 @@
+"""
+    A module that contains the version of the admin flags of the users, so admin_required can
+    trust the admin flag carried in the signed session cookie instead of loading the user.
+
+    The row ADMINS_VERSION_ID of the catalog_version table goes up whenever the admin flag of a
+    user changes or an admin is deleted. It is raised by triggers of the user table (see models.py),
+    so the changes made through the models, bulk updates and plain SQL are all counted. A session
+    keeps the version it was logged in at, and admin_required loads the user again only when the
+    version changed since. Every worker reads the version at most once every ADMINS_VERSION_TTL
+    seconds, so a demoted or deleted admin loses the admin pages within that time.
+"""
+
+import threading
+import time
+
+from config import app
+from catalog import catalog_version_row
+from replicas import primary_reads
+
+
+ADMINS_VERSION_ID = 3
+
+
+class AdminsVersion:
+    """
+        The version of the admin flags as last read by this worker.
+
+        Args:
+            ttl: number of seconds the version is used without reading it from the database again.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._version = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+    def get(self):
+        """Returns the version of the admin flags, read from the database when the ttl is over."""
+        if self._version is not None and time.monotonic() - self._checked_at < self.ttl:
+            return self._version
+        with self._lock:
+            if self._version is None or time.monotonic() - self._checked_at >= self.ttl:
+                # a replica behind the primary could hand out a version older than a demotion
+                with primary_reads():
+                    self._version = catalog_version_row(ADMINS_VERSION_ID)[0]
+                self._checked_at = time.monotonic()
+            return self._version
+
+
+admins_version = AdminsVersion(ttl=app.config['ADMINS_VERSION_TTL'])
@@ -0,0 +1,302 @@
+"""
+    A module that contains the versioned REST API of the web app, served under /api/v1
+    with Flask-RESTful for the mobile client and partner integrations.
+
+    Only the session cookie of the web app authenticates the requests: a client logs in with
+    POST /login like a browser and sends the cookie back, there is no token authentication.
+
+    Every GET response carries an ETag (and a Last-Modified date for the catalog) derived
+    from the versions of the rows it was built from: the catalog version for categories
+    and products, the latest transaction and the catalog version for the transactions (their
+    orders show the current product names). A client sending the ETag back in If-None-Match
+    gets an empty 304 answer, checked before the response is built, so polling an unchanged
+    resource costs almost nothing.
+"""
+
+import hashlib
+from datetime import timezone
+from functools import wraps
+
+from flask import request, session, make_response, url_for
+from flask_restful import Api, Resource, abort
+from sqlalchemy import func
+from sqlalchemy.orm import joinedload, selectinload
+from werkzeug.http import quote_etag, http_date
+
+from config import app
+from budgets import query_budget
+from models import db, Cart, Product, Order, Transaction
+from catalog import catalog_cache, find_products, InvalidSort
+from cart import cart_summary, add_to_cart
+from checkout import cart_lines, OutOfStock, CartChanged
+from flash_sale import place_cart_order, FlashSaleBusy
+from pagination import keyset_paginate, InvalidCursor, TRANSACTION_SORT_ORDER
+
+
+api = Api(app, prefix='/api/v1')
+
+
+def login_required(func):
+    """Wraps the methods of the resources, answering 401 when the session cookie has no logged in user."""
+    @wraps(func)
+    def inner(*args, **kwargs):
+        if 'user_id' not in session:
+            abort(401, message='please login to continue')
+        return func(*args, **kwargs)
+    return inner
+
+
+def conditional(etag, build, last_modified=None):
+    """
+        Returns the response of a GET resource with its validators, or an empty 304
+        response when the client already has this version.
+
+        Args:
+            etag: a string that changes whenever the response would change.
+            build: a function returning the response data, only called when it is needed.
+            last_modified: the datetime of the last change of the data, if it is known.
+    """
+    headers = {'ETag': quote_etag(etag, weak=True), 'Cache-Control': 'private, no-cache'}
+    if last_modified is not None:
+        # the dates are saved in the server's local time, and HTTP dates have a precision of seconds
+        last_modified = last_modified.astimezone(timezone.utc).replace(microsecond=0)
+        headers['Last-Modified'] = http_date(last_modified)
+
+    # If-Modified-Since is only looked at when there is no If-None-Match, like the HTTP spec says
+    if request.if_none_match:
+        not_modified = request.if_none_match.contains_weak(etag)
+    else:
+        not_modified = last_modified is not None and request.if_modified_since is not None and last_modified <= request.if_modified_since
+    if not_modified:
+        response = make_response('', 304)
+        response.headers.update(headers)
+        return response
+    return build(), 200, headers
+
+
+def query_string_hash():
+    """Returns a short hash of the query parameters, for the ETag of a filtered or paginated list."""
+    return hashlib.sha1(request.query_string).hexdigest()[:16]
+
+
+def page_links(endpoint, page, **values):
+    """Returns the urls of the next and previous pages of a KeysetPage with the same query parameters."""
+    args = request.args.to_dict()
+    args.pop('after', None)
+    args.pop('before', None)
+    return {
+        'next': url_for(endpoint, after=page.next_cursor, **values, **args) if page.next_cursor else None,
+        'prev': url_for(endpoint, before=page.prev_cursor, **values, **args) if page.prev_cursor else None,
+    }
+
+
+def product_json(product):
+    """Returns the JSON of a product model or a product record of the catalog snapshot."""
+    return {
+        'id': product.id,
+        'sku': product.sku,
+        'name': product.product_name,
+        'price': product.price,
+        'description': product.description,
+        'category_id': product.category_id,
+        'category': product.category.cat_name,
+        'quantity_available': product.quantity_available,
+        'manu_date': product.manu_date.isoformat() if product.manu_date else None,
+        'image': product.product_image_path or None,
+    }
+
+
+def int_arg(name):
+    """Returns an integer query parameter, aborting with 400 if it is not a number."""
+    value = request.args.get(name)
+    try:
+        return int(value) if value else None
+    except ValueError:
+        abort(400, message='{} must be an integer'.format(name))
+
+
+def float_arg(name):
+    """Returns a positive number query parameter, aborting with 400 if it is not one."""
+    value = request.args.get(name)
+    try:
+        value = float(value) if value else None
+    except ValueError:
+        abort(400, message='{} must be a number'.format(name))
+    if value is not None and value <= 0:
+        abort(400, message='{} must be greater than 0'.format(name))
+    return value
+
+
+class CategoryListResource(Resource):
+    """GET /api/v1/categories, the categories with the number of products in each."""
+    method_decorators = [login_required]
+
+    @query_budget(statements=1, rows=1, ms=50)  ## served from the cached catalog, at most its version check
+    def get(self):
+        snapshot = catalog_cache.get()
+        return conditional(
+            'categories-{}'.format(snapshot.version),
+            lambda: {'items': [
+                {'id': category.id, 'name': category.cat_name, 'product_count': snapshot.product_counts[category.id]}
+                for category in snapshot.categories
+            ]},
+            snapshot.updated_at,
+        )
+
+
+class ProductListResource(Resource):
+    """
+        GET /api/v1/products, a page of products filtered with the query parameters
+        category_id, category, q (full-text search), max_price, sort and per_page,
+        paginated with the after/before cursors of the next and prev links.
+    """
+    method_decorators = [login_required]
+
+    @query_budget(statements=2, rows=50, ms=100)  ## the catalog version check and the filtered products, like the home page
+    def get(self):
+        category_id = int_arg('category_id')
+        max_price = float_arg('max_price')
+        snapshot = catalog_cache.get()
+
+        def build():
+            try:
+                page = find_products(
+                    category_name=request.args.get('category', ''), terms=request.args.get('q', ''), max_price=max_price,
+                    category_id=category_id, sort=request.args.get('sort'),
+                    after=request.args.get('after'), before=request.args.get('before'),
+                )
+            except InvalidSort:
+                abort(400, message='Invalid sort order')
+            except InvalidCursor:
+                abort(400, message='Invalid page')
+            return dict(items=[product_json(product) for product in page.items], **page_links('productlistresource', page))
+
+        return conditional('products-{}-{}'.format(snapshot.version, query_string_hash()), build, snapshot.updated_at)
+
+
+class ProductResource(Resource):
+    """GET /api/v1/products/<id>, one product."""
+    method_decorators = [login_required]
+
+    @query_budget(statements=2, rows=2, ms=50)
+    def get(self, id):
+        snapshot = catalog_cache.get()
+
+        def build():
+            product = Product.query.options(joinedload(Product.category)).filter_by(id=id).first()
+            if not product:
+                abort(404, message='Product not found')
+            return product_json(product)
+
+        return conditional('product-{}-{}'.format(id, snapshot.version), build, snapshot.updated_at)
+
+
+class CartResource(Resource):
+    """GET /api/v1/cart, the lines and summary of the user's cart, POST adds items like /api/cart/items."""
+    method_decorators = [login_required]
+
+    @query_budget(statements=1, rows=20, ms=50)
+    def get(self):
+        # the cart changes without a version of its own, so its ETag is a hash of its lines
+        carts = Cart.query.options(joinedload(Cart.product)).filter_by(user_id=session['user_id']).order_by(Cart.id).all()
+        lines = [
+            {'id': cart.id, 'product_id': cart.product_id, 'name': cart.product.product_name, 'price': cart.product.price,
+             'quantity': cart.quantity_added_to_cart, 'subtotal': cart.product.price * cart.quantity_added_to_cart}
+            for cart in carts
+        ]
+        data = {'items': lines, 'count': sum(line['quantity'] for line in lines), 'total': sum(line['subtotal'] for line in lines)}
+        etag = 'cart-' + hashlib.sha1(repr(sorted((line['id'], line['quantity'], line['price']) for line in lines)).encode()).hexdigest()[:16]
+        return conditional(etag, lambda: data)
+
+    @query_budget(statements=4, rows=5, ms=50)
+    def post(self):
+        errors = add_to_cart(session['user_id'], (request.get_json(silent=True) or {}).get('items'))
+        if errors:
+            return {'errors': errors}, 400
+        return cart_summary(session['user_id'])
+
+
+class CheckoutResource(Resource):
+    """POST /api/v1/checkout, orders everything in the user's cart like the order now button."""
+    method_decorators = [login_required]
+
+    @query_budget(statements=18, rows=20, ms=200)  ## the order now button's budget, the checkout is the same
+    def post(self):
+        carts = Cart.query.options(joinedload(Cart.product)).filter_by(user_id=session['user_id']).all()
+        if not carts:
+            return {'message': 'Cart is empty'}, 400
+        try:
+            transaction_id = place_cart_order(session['user_id'], cart_lines(carts))
+        except OutOfStock as error:
+            return {'message': 'Some products are out of stock', 'errors': [failure._asdict() for failure in error.failures]}, 409
+        except CartChanged:
+            return {'message': 'The cart was changed while ordering, please check it and order again'}, 409
+        except FlashSaleBusy:
+            return {'message': 'Too many orders at the moment, please try again'}, 503, {'Retry-After': '1'}
+        return {'transaction_id': transaction_id}, 201, {'Location': url_for('transactionresource', id=transaction_id)}
+
+
+def transaction_json(transaction):
+    return {
+        'id': transaction.id,
+        'date_time': transaction.date_time.isoformat(),
+        'price': transaction.price,
+        'item_count': transaction.item_count,
+        'orders': [
+            {'product_id': order.product_id, 'name': order.product.product_name, 'quantity': order.quantity, 'price': order.price, 'subtotal': order.subtotal}
+            for order in transaction.orders
+        ],
+    }
+
+
+class TransactionListResource(Resource):
+    """GET /api/v1/transactions, the user's transaction history, the latest first, paginated with the after/before cursors."""
+    method_decorators = [login_required]
+
+    @query_budget(statements=4, rows=151, ms=100)  ## the catalog version check, the version of the history, the page of transactions and their orders
+    def get(self):
+        user_id = session['user_id']
+        # transactions are never changed once saved, so their count and latest id version the history,
+        # and the catalog version the names of their products
+        snapshot = catalog_cache.get()
+        count, latest = db.session.execute(
+            db.select(func.count(Transaction.id), func.max(Transaction.id)).where(Transaction.user_id == user_id)
+        ).one()
+
+        def build():
+            transactions = Transaction.query.filter_by(user_id=user_id) \
+                .options(selectinload(Transaction.orders).joinedload(Order.product))
+            try:
+                page = keyset_paginate(transactions, TRANSACTION_SORT_ORDER, after=request.args.get('after'), before=request.args.get('before'))
+            except InvalidCursor:
+                abort(400, message='Invalid page')
+            return dict(items=[transaction_json(transaction) for transaction in page.items], **page_links('transactionlistresource', page))
+
+        return conditional('transactions-{}-{}-{}-{}-{}'.format(user_id, count, latest, snapshot.version, query_string_hash()), build)
+
+
+class TransactionResource(Resource):
+    """GET /api/v1/transactions/<id>, one transaction of the user with its orders."""
+    method_decorators = [login_required]
+
+    @query_budget(statements=3, rows=11, ms=50)  ## the catalog version check, the transaction and its orders
+    def get(self, id):
+        snapshot = catalog_cache.get()  ## the transaction never changes, the names of its products do
+
+        def build():
+            transaction = Transaction.query.filter_by(id=id, user_id=session['user_id']) \
+                .options(selectinload(Transaction.orders).joinedload(Order.product)).first()
+            if not transaction:
+                abort(404, message='Transaction not found')
+            return transaction_json(transaction)
+
+        return conditional('transaction-{}-{}-{}'.format(session['user_id'], id, snapshot.version), build)
+
+
+api.add_resource(CategoryListResource, '/categories')
+api.add_resource(ProductListResource, '/products')
+api.add_resource(ProductResource, '/products/<int:id>')
+api.add_resource(CartResource, '/cart')
+api.add_resource(CheckoutResource, '/checkout')
+api.add_resource(TransactionListResource, '/transactions')
+api.add_resource(TransactionResource, '/transactions/<int:id>')
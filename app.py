@@ -1,21 +1,104 @@
-"""Python Flask WebApp Grocery Shop!"""
+"""Python Flask WebApp Grocery Shop!
+
+    Importing this module only sets up the app (its views, API and commands), it doesn't touch
+    the database, so the gunicorn workers start fast and many of them can start at once.
+    The database is created, or gets its missing tables and pending migrations, the search index
+    and the admin user, once per deployment with:
+
+        flask init-db
+
+    In production the app is served from wsgi.py, see gunicorn.conf.py.
+"""
+
+import click
+import gc
+from sqlalchemy.exc import IntegrityError, OperationalError
+from sqlalchemy.orm import configure_mappers
 
 import config
 from config import app
-import routes
 from models import db, User
-from werkzeug.security import generate_password_hash
 
 
-## This section creates the database models
-with app.app_context():
-    db.create_all()   ##creates the database
+def create_app():
+    """
+        Returns the flask app with its views, API, static files and commands registered.
+        It has no side effect on the database, see init_db and warm_up.
+    """
+    import routes
+    import api  ## the REST API under /api/v1
+    import assets  ## the fingerprinted static files under /assets
+    import migrations  ## the flask db commands
+    import querylog  ## the N+1 detector and the slow query log, when they are on
+    return app
+
+
+def init_db(admin_password='admin', echo=lambda message: None):
+    """
+        Creates the database schema, or applies the pending migrations of an existing database,
+        then the search index and the admin user if they don't exist yet.
+        Run once per deployment with 'flask init-db', it can be run again safely.
+    """
+    from search import create_search_index
+    from migrations import init_schema
+    from passwords import hash_password
+    from catalog import create_catalog_version
+    from thumbnails import VARIANTS_VERSION_ID
+    from admins import ADMINS_VERSION_ID
+
+    init_schema(echo)   ##creates the database, or adds the missing tables and applies the pending migrations of an existing one, before the queries below
+    create_search_index()  ##creates the full-text search index of the products if it doesn't exist
+    create_catalog_version()  ##the row of the catalog version, so the first change only has to update it
+    create_catalog_version(VARIANTS_VERSION_ID)  ##and the one of the resized product images
+    create_catalog_version(ADMINS_VERSION_ID)  ##and the one of the admin flags, raised by the triggers of the user table
+    db.session.commit()
     # checks if admin user exist, else creates one if it doesn't exist
     admin = User.query.filter_by(is_admin=True).first() ## query to check admin user exist, if it does, store it in the variable admin.
     if not admin:
-        password = generate_password_hash('admin')
+        password = hash_password(admin_password)
         admin = User(username='admin', hashed_password=password, is_admin=True, name='admin')
         db.session.add(admin)
-        db.session.commit()
+        try:
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()  ## another init-db created it at the same time
+            return False
+        return True
+    return False
+
+
+def warm_up(flask_app):
+    """
+        Does the work of the first requests before gunicorn forks its workers (with --preload),
+        so the workers share it copy-on-write instead of each doing it again: the templates are
+        compiled, the SQLAlchemy mappers configured and the catalog cache filled.
+    """
+    from catalog import catalog_cache
+
+    for name in flask_app.jinja_env.list_templates():
+        flask_app.jinja_env.get_template(name)  ## compiled once and kept in the template cache of jinja
+    configure_mappers()
+    with flask_app.app_context():
+        try:
+            catalog_cache.get()
+        except OperationalError as error:
+            raise RuntimeError('the database is not ready, run "flask init-db" first') from error
+        finally:
+            db.session.remove()
+        # the connections opened here must not be shared with the workers, each of them opens its own
+        for engine in db.engines.values():
+            engine.dispose()
+    # the objects made so far live as long as the workers, moving them out of the garbage collector keeps
+    # its passes from writing to (and so copying) the memory pages they share with the master process
+    gc.freeze()
+
+
+@app.cli.command('init-db')
+@click.option('--admin-password', default='admin', show_default=True, help='the password of the admin user, if it is created')
+def init_db_command(admin_password):
+    """Creates the database, its search index and the admin user."""
+    created = init_db(admin_password, echo=click.echo)
+    click.echo('database ready{}'.format(', admin user created' if created else ''))
 
 
+app = create_app()
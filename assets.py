@@ -0,0 +1,184 @@
+"""
+    A module that contains the fingerprinted urls of the static files (scripts, styles and product images).
+
+    The templates link to the static files with asset_url, which puts a hash of the content of
+    the file in the url, e.g. /assets/0b7c1e5d2a9f4c3e/js/cart.js. As the url changes whenever
+    the file changes, the file is served with 'Cache-Control: immutable' and a one year max-age,
+    so the browsers never ask for it again. The images stored under the hash of their content
+    (see images.py and thumbnails.py) take their fingerprint from their name without being read.
+
+    The scripts and styles are compressed ahead of time by 'flask assets build', which writes a
+    .gz and a .br (when the brotli package is installed) file next to each of them. The browsers
+    get the smallest one they accept, without the server compressing anything per request.
+"""
+
+import gzip
+import hashlib
+import mimetypes
+import os
+import re
+import tempfile
+import threading
+
+import click
+from flask import abort, request, send_from_directory
+from werkzeug.security import safe_join
+
+from config import app
+from budgets import query_budget
+
+try:
+    import brotli
+except ImportError:  ## the brotli package is optional, without it only gzip files are made
+    brotli = None
+
+
+FINGERPRINT_LENGTH = 16
+ONE_YEAR = 365 * 24 * 60 * 60
+
+# the files worth compressing, images are already compressed
+COMPRESSIBLE_EXTENSIONS = {'.js', '.css', '.svg', '.json', '.map', '.txt', '.html'}
+
+# the precompressed files, in order of preference, as (Content-Encoding, file extension)
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+
+# a file named after the sha256 of its content, e.g. 3f2a...c9.jpg or its variant 3f2a...c9-320.webp
+CONTENT_ADDRESSED = re.compile(r'([0-9a-f]{64})(-\d+)?\.\w+')
+
+
+class AssetFingerprints:
+    """The fingerprints of the static files of this worker, computed again only when a file changes."""
+
+    def __init__(self):
+        self._fingerprints = {}
+        self._lock = threading.Lock()
+
+    def get(self, filename):
+        """Returns the fingerprint of a file of the static folder, or None if it doesn't exist."""
+        match = CONTENT_ADDRESSED.fullmatch(os.path.basename(filename))
+        if match:
+            return match.group(1)[:FINGERPRINT_LENGTH]
+
+        path = safe_join(app.static_folder, filename)
+        try:
+            stat = os.stat(path)
+        except (TypeError, OSError):
+            return None
+        cached = self._fingerprints.get(filename)
+        if cached is not None and cached[0] == (stat.st_mtime_ns, stat.st_size):
+            return cached[1]
+
+        sha256 = hashlib.sha256()
+        with open(path, 'rb') as file:
+            for chunk in iter(lambda: file.read(64 * 1024), b''):
+                sha256.update(chunk)
+        fingerprint = sha256.hexdigest()[:FINGERPRINT_LENGTH]
+        with self._lock:
+            self._fingerprints[filename] = ((stat.st_mtime_ns, stat.st_size), fingerprint)
+        return fingerprint
+
+
+fingerprints = AssetFingerprints()
+
+
+@app.template_global()
+def asset_url(filename):
+    """
+        Returns the fingerprinted url of a file of the static folder, e.g. asset_url('js/cart.js').
+        The paths saved in the database (static/images/...) are accepted as well.
+    """
+    filename = filename.replace(os.sep, '/').lstrip('/')
+    static_prefix = os.path.basename(app.static_folder) + '/'
+    if filename.startswith(static_prefix):
+        filename = filename[len(static_prefix):]
+    fingerprint = fingerprints.get(filename)
+    if fingerprint is None:
+        return '/' + static_prefix + filename  ## not a static file (anymore), the plain url answers as usual
+    return '/assets/{}/{}'.format(fingerprint, filename)
+
+
+@app.route('/assets/<fingerprint>/<path:filename>')
+@query_budget(statements=0, rows=0, ms=50)
+def asset(fingerprint, filename):
+    """
+        Serves a static file under its fingerprinted url, precompressed when the browser accepts it.
+        An old fingerprint still gets the current file, but it is not cached for good.
+    """
+    current = fingerprints.get(filename)
+    if current is None:
+        abort(404)
+
+    response = None
+    if os.path.splitext(filename)[1] in COMPRESSIBLE_EXTENSIONS:
+        mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        path = safe_join(app.static_folder, filename)
+        for encoding, extension in ENCODINGS:
+            # a compressed file older than the file itself is left over from a previous build
+            if encoding in request.accept_encodings and _is_fresh(path + extension, path):
+                response = send_from_directory(app.static_folder, filename + extension, mimetype=mimetype, etag=False)
+                response.headers['Content-Encoding'] = encoding
+                break
+        response = response or send_from_directory(app.static_folder, filename, etag=False)
+        response.vary.add('Accept-Encoding')
+    else:
+        response = send_from_directory(app.static_folder, filename, etag=False)
+
+    if fingerprint == current:
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+        response.cache_control.max_age = ONE_YEAR
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.no_cache = True
+    return response
+
+
+def _is_fresh(compressed_path, path):
+    try:
+        return os.stat(compressed_path).st_mtime_ns >= os.stat(path).st_mtime_ns
+    except OSError:
+        return False
+
+
+def precompress(path):
+    """Writes the .gz and .br files of a static file, returns the encodings written (skipped when they don't make it smaller)."""
+    with open(path, 'rb') as file:
+        content = file.read()
+    compressed = {'.gz': gzip.compress(content, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        compressed['.br'] = brotli.compress(content, quality=11)
+
+    written = []
+    for extension, data in compressed.items():
+        if len(data) >= len(content):
+            if os.path.exists(path + extension):
+                os.remove(path + extension)
+            continue
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.compress-')
+        with os.fdopen(fd, 'wb') as temp_file:
+            temp_file.write(data)
+        os.replace(temp_path, path + extension)
+        written.append(extension)
+    return written
+
+
+##################################### flask assets COMMANDS ##########################################################
+@app.cli.group('assets')
+def assets_cli():
+    """Build steps of the static files."""
+
+
+@assets_cli.command('build')
+def build_assets():
+    """Precompresses the scripts and styles of the static folder, run it on every deploy."""
+    if brotli is None:
+        click.echo('the brotli package is not installed, only the gzip files are made')
+    count = 0
+    for folder, _, files in os.walk(app.static_folder):
+        for name in files:
+            if os.path.splitext(name)[1] in COMPRESSIBLE_EXTENSIONS:
+                path = os.path.join(folder, name)
+                written = precompress(path)
+                click.echo('{} {}'.format(os.path.relpath(path, app.static_folder), ' '.join(written) or '(not smaller, skipped)'))
+                count += 1
+    click.echo('precompressed {} files'.format(count))
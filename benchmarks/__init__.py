@@ -0,0 +1,50 @@
+"""
+    Load tests and benchmarks of the web app, run each one as a module from the
+    project directory, e.g. 'python -m benchmarks.checkout_oversell'.
+
+    Every script points the app at a fresh SQLite database in a temporary directory
+    before importing it, so they never touch the database in instance/.
+
+    benchmarks.suite runs the main pages on a generated shop (benchmarks.datagen) and
+    writes a JSON report to compare between commits, see its docstring.
+"""
+
+import os
+import sys
+import tempfile
+
+
+def use_temporary_database(engine_options=None, **config):
+    """
+        Points the app at a new SQLite database in a temporary directory and imports it.
+        Extra keyword arguments are set as environment variables for config.py first,
+        engine_options are added to SQLALCHEMY_ENGINE_OPTIONS before the engine is made.
+        Returns the imported flask app.
+    """
+    directory = tempfile.mkdtemp(prefix='quickmart-bench-')
+    os.environ['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(directory, 'bench.sqlite3')
+    os.environ.update({name: str(value) for name, value in config.items()})
+
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    if engine_options:
+        from config import app as flask_app
+        flask_app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', {}).update(engine_options)
+    from app import app as flask_app, init_db
+    with flask_app.app_context():
+        init_db()  ## creates the tables and the admin user
+    return flask_app
+
+
+def login(client, user_id, is_admin=False):
+    """
+        Logs a test client in as a user by writing the session directly, without hashing a password.
+        The session carries the current version of the admin flags, like one whose flag admin_required already checked.
+    """
+    from admins import admins_version
+
+    with client.application.app_context():
+        version = admins_version.get()
+    with client.session_transaction() as session:
+        session['user_id'] = user_id
+        session['is_admin'] = is_admin
+        session['admins_version'] = version
@@ -0,0 +1,454 @@
+"""
+    Checks the performance budgets of the routes (see budgets.py) on the reference dataset.
+
+    The reference dataset is the shop of benchmarks.datagen with REFERENCE_ORDERS orders and the
+    seed 0; the shopper is the user with the most transactions, with CART_LINES lines in their cart,
+    so a view loading the lines, orders or products one by one can't hide. Every request below is
+    sent once to warm up the caches of the worker, then RUNS times. The most statements and rows
+    fetched of the runs and their median wall time are checked against the budget of the view.
+
+    Every run must get the answer the request expects (its status, redirect and flashed message),
+    so a request refused by the view can't pass as measured. The requests changing rows work on
+    rows their setup makes again before every run, /metrics is turned on for the check.
+
+    A request over its budget fails the check with its statements, and with a diff against the
+    statements recorded in query_baseline.json (--record writes it again after an intended change).
+    Every method of every routed view must have a budget and a request here, or the check fails.
+
+        python -m benchmarks.budgets
+        python -m benchmarks.budgets --time-factor 3     ## a slower machine, the time budgets x3
+        python -m benchmarks.budgets --record
+"""
+
+import argparse
+import difflib
+import io
+import json
+import os
+import sqlite3
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from collections import namedtuple
+from urllib.parse import urlsplit
+
+from benchmarks import use_temporary_database, login
+from benchmarks.datagen import PASSWORD
+
+
+REFERENCE_ORDERS = 20000
+CART_LINES = 10
+RUNS = 5
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'query_baseline.json')
+
+# the id of the rows the requests changing the catalog and the cart work on, made again before each run
+SCRATCH_ID = 1000000
+# the image of the add product request, a file of the static folder, and the number of rows of the import request
+PRODUCT_IMAGE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'static', 'images', 'oraimoPowerBank.jpg')
+IMPORT_ROWS = 2
+
+# who sends a request: 'anonymous', 'shopper' or 'admin'; path, redirect and setup are functions of the ReferenceData,
+# form is the form data and json the JSON body, or functions of the ReferenceData returning them.
+# A run answering another status than status, redirecting elsewhere than redirect or without the flashed message
+# stops the check, so a request refused by the view is never measured as if it was served.
+BudgetRequest = namedtuple(
+    'BudgetRequest', ['name', 'endpoint', 'who', 'method', 'path', 'form', 'setup', 'status', 'redirect', 'flashed', 'json'],
+    defaults=(200, None, None, None),
+)
+
+# the ids and names of the reference dataset the requests use
+ReferenceData = namedtuple('ReferenceData', [
+    'shopper_id', 'shopper_username', 'shopper_password_hash', 'admin_id', 'product_ids', 'category_id', 'transaction_id',
+])
+
+# what a request took: the most statements and rows of the runs, the median wall time and the statements of the last run
+Measure = namedtuple('Measure', ['statements', 'rows', 'ms', 'sql'])
+
+
+def _fill_cart(data):
+    from models import db, Cart
+
+    # the first line has the id SCRATCH_ID, for the requests changing or removing a line
+    db.session.execute(db.delete(Cart).where(Cart.user_id == data.shopper_id))
+    db.session.add_all([
+        Cart(id=SCRATCH_ID + line, user_id=data.shopper_id, product_id=product_id, quantity_added_to_cart=1)
+        for line, product_id in enumerate(data.product_ids[:CART_LINES])
+    ])
+    db.session.commit()
+
+
+def _scratch_category(data):
+    from models import db, Category, Product
+    import search
+
+    # the category SCRATCH_ID with the product SCRATCH_ID, and none of the categories added by a previous run
+    categories = db.select(Category.id).where(db.or_(Category.id == SCRATCH_ID, Category.cat_name == 'Budget category'))
+    products = db.session.execute(
+        db.select(Product.id).where(db.or_(Product.id == SCRATCH_ID, Product.category_id.in_(categories)))
+    ).scalars().all()
+    for product_id in products:
+        search.remove_product(product_id)
+    db.session.execute(db.delete(Product).where(Product.id.in_(products)))
+    db.session.execute(db.delete(Category).where(Category.id.in_(categories)))
+    db.session.add(Category(id=SCRATCH_ID, cat_name='Budget category'))
+    db.session.add(Product(
+        id=SCRATCH_ID, product_name='Budget product', price=1.0, category_id=SCRATCH_ID, quantity_available=10, product_image_path='',
+    ))
+    db.session.commit()
+
+
+def _drop_imported(data):
+    from models import db, Product
+    import search
+
+    products = db.session.execute(db.select(Product.id).where(Product.sku.like('BUDGET-%'))).scalars().all()
+    for product_id in products:
+        search.remove_product(product_id)
+    db.session.execute(db.delete(Product).where(Product.id.in_(products)))
+    db.session.commit()
+
+
+def _drop_registered(data):
+    from models import db, User
+
+    db.session.execute(db.delete(User).where(User.username == 'budget-user'))
+    db.session.commit()
+
+
+def _reset_shopper(data):
+    from models import db, User
+
+    db.session.execute(db.update(User).where(User.id == data.shopper_id).values(
+        username=data.shopper_username, hashed_password=data.shopper_password_hash,
+    ))
+    db.session.commit()
+
+
+def _product_form(data):
+    with open(PRODUCT_IMAGE, 'rb') as image:
+        content = image.read()
+    return {
+        'product_name': 'Budget product', 'price': '2.5', 'category_id': str(SCRATCH_ID), 'quantity_available': '5',
+        'manu_date': '2024-01-01', 'product_image': (io.BytesIO(content), os.path.basename(PRODUCT_IMAGE)),
+    }
+
+
+def _import_form(data):
+    rows = 'sku,product_name,price,quantity_available,manu_date,category_id\n' + ''.join(
+        'BUDGET-{0},Budget import {0},{0}.5,10,2024-01-01,{1}\n'.format(row, data.category_id) for row in range(1, IMPORT_ROWS + 1)
+    )
+    return {'products_file': (io.BytesIO(rows.encode()), 'products.csv'), 'key': 'sku'}
+
+
+def _login_form(data):
+    return {'username': data.shopper_username, 'password': PASSWORD}
+
+
+def _profile_form(data):
+    return {
+        'username': data.shopper_username, 'current_password': PASSWORD, 'new_password': 'budget-password',
+        'confirm_new_password': 'budget-password', 'name': 'Budget shopper',
+    }
+
+
+def _cart_items(data):
+    return {'items': [{'product_id': data.product_ids[-1], 'quantity': 1}]}
+
+
+def _asset_url(filename):
+    from assets import asset_url
+
+    return asset_url(filename)
+
+
+REQUESTS = [
+    # the storefront and the account
+    BudgetRequest('login page', 'login_page', 'anonymous', 'GET', lambda data: '/login', None, None),
+    BudgetRequest('register page', 'register_page', 'anonymous', 'GET', lambda data: '/register', None, None),
+    BudgetRequest('home page', 'home_page', 'shopper', 'GET', lambda data: '/', None, None),
+    BudgetRequest('home page search', 'home_page', 'shopper', 'GET', lambda data: '/?pname=coffee', None, None),
+    BudgetRequest('home page filters', 'home_page', 'shopper', 'GET', lambda data: '/?cname=Fruits%201&price=25&sort=price_asc', None, None),
+    BudgetRequest('profile', 'profile_page', 'shopper', 'GET', lambda data: '/profile', None, None),
+    BudgetRequest('cart page', 'cart_page', 'shopper', 'GET', lambda data: '/cart', None, _fill_cart),
+    BudgetRequest('cart summary', 'cart_api_summary', 'shopper', 'GET', lambda data: '/api/cart', None, _fill_cart),
+    BudgetRequest('transaction history', 'show_orders', 'shopper', 'GET', lambda data: '/transaction_history', None, None),
+    BudgetRequest('asset', 'asset', 'anonymous', 'GET', lambda data: _asset_url('js/cart.js'), None, None),
+
+    # the admin pages
+    BudgetRequest('admin dashboard', 'admin_dashboard', 'admin', 'GET', lambda data: '/admin_dashboard', None, None),
+    BudgetRequest('admin category', 'show_category', 'admin', 'GET', lambda data: '/category/show/{}/'.format(data.category_id), None, None),
+    BudgetRequest('add category page', 'add_category', 'admin', 'GET', lambda data: '/category/add', None, None),
+    BudgetRequest('edit category page', 'edit_category', 'admin', 'GET', lambda data: '/category/{}/edit'.format(data.category_id), None, None),
+    BudgetRequest('delete category page', 'delete_category', 'admin', 'GET', lambda data: '/category/{}/delete'.format(data.category_id), None, None),
+    BudgetRequest('add product page', 'add_product', 'admin', 'GET', lambda data: '/category/show/{}/product/add/'.format(data.category_id), None, None),
+    BudgetRequest('edit product page', 'edit_product', 'admin', 'GET', lambda data: '/category/show/{}/product/edit/'.format(data.product_ids[0]), None, None),
+    BudgetRequest('delete product page', 'delete_product', 'admin', 'GET', lambda data: '/category/show/{}/product/delete/'.format(data.product_ids[0]), None, None),
+    BudgetRequest('import page', 'import_products_page', 'admin', 'GET', lambda data: '/products/import', None, None),
+    BudgetRequest('export orders of a user', 'export', 'admin', 'GET', lambda data: '/export/orders?username={}'.format(data.shopper_username), None, None),
+    BudgetRequest('export inventory', 'export', 'admin', 'GET', lambda data: '/export/inventory', None, None),
+    BudgetRequest('metrics', 'show_metrics', 'admin', 'GET', lambda data: '/metrics', None, None),
+
+    # the REST API
+    BudgetRequest('api categories', 'categorylistresource', 'shopper', 'GET', lambda data: '/api/v1/categories', None, None),
+    BudgetRequest('api products', 'productlistresource', 'shopper', 'GET', lambda data: '/api/v1/products', None, None),
+    BudgetRequest('api product', 'productresource', 'shopper', 'GET', lambda data: '/api/v1/products/{}'.format(data.product_ids[0]), None, None),
+    BudgetRequest('api cart', 'cartresource', 'shopper', 'GET', lambda data: '/api/v1/cart', None, _fill_cart),
+    BudgetRequest('api transactions', 'transactionlistresource', 'shopper', 'GET', lambda data: '/api/v1/transactions', None, None),
+    BudgetRequest('api transaction', 'transactionresource', 'shopper', 'GET', lambda data: '/api/v1/transactions/{}'.format(data.transaction_id), None, None),
+
+    # the requests changing the cart and the orders
+    BudgetRequest('add to cart', 'home_page_add_to_cart_post', 'shopper', 'POST', lambda data: '/add_to_cart/{}'.format(data.product_ids[-1]), {'quantity_input': '1'}, _fill_cart,
+                  status=302, redirect=lambda data: '/', flashed='Product added to cart successfully'),
+    BudgetRequest('remove from cart', 'cart_delete', 'shopper', 'POST', lambda data: '/cart/{}/delete'.format(SCRATCH_ID), {}, _fill_cart,
+                  status=302, redirect=lambda data: '/cart', flashed='Product removed from cart successfully'),
+    BudgetRequest('order now', 'order_now_button', 'shopper', 'POST', lambda data: '/order_now', {}, _fill_cart,
+                  status=302, redirect=lambda data: '/cart', flashed='Order placed successfully'),
+    BudgetRequest('cart api add', 'cart_api_add', 'shopper', 'POST', lambda data: '/api/cart/items', None, _fill_cart,
+                  json=_cart_items),
+    BudgetRequest('cart api update', 'cart_api_update', 'shopper', 'PATCH', lambda data: '/api/cart/items/{}'.format(SCRATCH_ID), None, _fill_cart,
+                  json={'quantity': 2}),
+    BudgetRequest('cart api remove', 'cart_api_remove', 'shopper', 'DELETE', lambda data: '/api/cart/items/{}'.format(SCRATCH_ID), None, _fill_cart),
+    BudgetRequest('api cart add', 'cartresource', 'shopper', 'POST', lambda data: '/api/v1/cart', None, _fill_cart,
+                  json=_cart_items),
+    BudgetRequest('api checkout', 'checkoutresource', 'shopper', 'POST', lambda data: '/api/v1/checkout', None, _fill_cart, status=201),
+
+    # the requests changing the catalog, on the scratch category and product
+    BudgetRequest('add category', 'add_category_post', 'admin', 'POST', lambda data: '/category/add', {'category_name': 'Budget category'}, _scratch_category,
+                  status=302, redirect=lambda data: '/admin_dashboard', flashed='Successfully added category'),
+    BudgetRequest('edit category', 'edit_category_post', 'admin', 'POST', lambda data: '/category/{}/edit'.format(SCRATCH_ID), {'category_name': 'Budget category'}, _scratch_category,
+                  status=302, redirect=lambda data: '/admin_dashboard', flashed='Category updated successfully'),
+    BudgetRequest('delete category', 'delete_category_post', 'admin', 'POST', lambda data: '/category/{}/delete'.format(SCRATCH_ID), {}, _scratch_category,
+                  status=302, redirect=lambda data: '/admin_dashboard', flashed='Category deleted successfully'),
+    BudgetRequest('add product', 'add_product_post', 'admin', 'POST', lambda data: '/category/show/{}/product/add/'.format(SCRATCH_ID), _product_form, _scratch_category,
+                  status=302, redirect=lambda data: '/category/show/{}/'.format(SCRATCH_ID), flashed='Product added successfully'),
+    BudgetRequest('edit product', 'edit_product_post', 'admin', 'POST', lambda data: '/category/show/{}/product/edit/'.format(SCRATCH_ID), {
+                      'product_name': 'Budget product', 'price': '3.5', 'category_id': str(SCRATCH_ID), 'quantity_available': '7', 'manu_date': '2024-01-01',
+                  }, _scratch_category,
+                  status=302, redirect=lambda data: '/category/show/{}/'.format(SCRATCH_ID), flashed='Product edited successfully'),
+    BudgetRequest('delete product', 'delete_product_post', 'admin', 'POST', lambda data: '/category/show/{}/product/delete/'.format(SCRATCH_ID), {}, _scratch_category,
+                  status=302, redirect=lambda data: '/category/show/{}/'.format(SCRATCH_ID), flashed='Product deleted successfully'),
+    BudgetRequest('import products', 'import_products_post', 'admin', 'POST', lambda data: '/products/import', _import_form, _drop_imported,
+                  flashed='Imported {0} rows: {0} added, 0 updated, 0 errors'.format(IMPORT_ROWS)),
+
+    # logging in and out and the accounts, each of them hashes or checks a password
+    BudgetRequest('login', 'login_post', 'anonymous', 'POST', lambda data: '/login', _login_form, None,
+                  status=302, redirect=lambda data: '/', flashed='Login Successful'),
+    BudgetRequest('logout', 'logout_page', 'shopper', 'GET', lambda data: '/logout', None, None, status=302, redirect=lambda data: '/login'),
+    BudgetRequest('register', 'register_post', 'anonymous', 'POST', lambda data: '/register',
+                  {'username': 'budget-user', 'password': 'budget-password', 'confirm_password': 'budget-password', 'name': 'Budget user'}, _drop_registered,
+                  status=302, redirect=lambda data: '/login'),
+    BudgetRequest('update profile', 'profile_post', 'shopper', 'POST', lambda data: '/profile', _profile_form, _reset_shopper,
+                  status=302, redirect=lambda data: '/profile', flashed='Profile updated successfully'),
+]
+
+
+##################################### COUNTING THE ROWS ##########################################################
+class _Counter:
+    measuring = False
+    thread = None  ## the thread sending the request, the background workers (e.g. thumbnails.py) are not counted
+    rows = 0
+    statements = []
+
+
+def _counting():
+    return _Counter.measuring and threading.get_ident() == _Counter.thread
+
+
+class CountingCursor(sqlite3.Cursor):
+    """A cursor of sqlite3 counting the rows fetched from it while a request is measured."""
+
+    def fetchone(self):
+        row = super().fetchone()
+        if row is not None and _counting():
+            _Counter.rows += 1
+        return row
+
+    def fetchmany(self, size=None):
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        if _counting():
+            _Counter.rows += len(rows)
+        return rows
+
+    def fetchall(self):
+        rows = super().fetchall()
+        if _counting():
+            _Counter.rows += len(rows)
+        return rows
+
+
+class CountingConnection(sqlite3.Connection):
+    """The sqlite3 connections of the engine, making CountingCursor cursors."""
+
+    def cursor(self, factory=None):
+        return super().cursor(factory or CountingCursor)
+
+
+def _record_statement(connection, cursor, statement, parameters, context, executemany):
+    if _counting():
+        _Counter.statements.append(statement)
+
+
+##################################### RUNNING THE REQUESTS ##########################################################
+def reference_data(app):
+    """Makes the reference dataset and returns the ids the requests use."""
+    from models import db, User, Transaction, Category
+    from benchmarks.datagen import generate, scale_for
+
+    with app.app_context():
+        dataset = generate(scale_for(REFERENCE_ORDERS), seed=0)
+        shopper_id = db.session.execute(
+            db.select(Transaction.user_id).group_by(Transaction.user_id).order_by(db.func.count().desc(), Transaction.user_id).limit(1)
+        ).scalar()
+        shopper = db.session.get(User, shopper_id)
+        admin_id = db.session.execute(db.select(User.id).filter_by(is_admin=True)).scalar()
+        category_id = db.session.execute(db.select(Category.id).order_by(Category.id)).scalar()
+        transaction_id = db.session.execute(db.select(db.func.max(Transaction.id)).filter_by(user_id=shopper_id)).scalar()
+        return ReferenceData(
+            shopper_id, shopper.username, shopper.hashed_password, admin_id, dataset.product_ids, category_id, transaction_id,
+        )
+
+
+def budget_of(view, method):
+    """Returns the QueryBudget of a view for a method, the views of flask_restful have one per method of their Resource."""
+    view_class = getattr(view, 'view_class', None)
+    if view_class is not None:
+        view = getattr(view_class, method.lower(), None)
+    return getattr(view, 'query_budget', None)
+
+
+def unexpected(request, response, flashed, data):
+    """Returns how a response differs from the one the request expects, or None when it doesn't."""
+    if response.status_code != request.status:
+        return 'answered {} instead of {}'.format(response.status_code, request.status)
+    if request.redirect is not None and urlsplit(response.location).path != request.redirect(data):
+        return 'redirected to {} instead of {}'.format(response.location, request.redirect(data))
+    # the message is still in the session after a redirect, a rendered page shows it
+    if request.flashed is not None and request.flashed not in flashed and request.flashed not in response.get_data(as_text=True):
+        return 'flashed {} instead of {!r}'.format(flashed, request.flashed)
+    return None
+
+
+def measure(app, request, data):
+    """Sends a request once to warm up, then RUNS times, and returns its Measure."""
+    client = app.test_client()
+    statements, rows, times = [], [], []
+    for run in range(RUNS + 1):
+        # every run starts from a new session, as the login and logout requests change it
+        with client.session_transaction() as session:
+            session.clear()
+        if request.who != 'anonymous':
+            login(client, data.admin_id if request.who == 'admin' else data.shopper_id, is_admin=request.who == 'admin')
+        if request.setup is not None:
+            with app.app_context():
+                request.setup(data)
+        form = request.form(data) if callable(request.form) else request.form
+        body = request.json(data) if callable(request.json) else request.json
+        _Counter.rows, _Counter.statements, _Counter.thread, _Counter.measuring = 0, [], threading.get_ident(), True
+        started = time.perf_counter()
+        try:
+            response = client.open(request.path(data), method=request.method, data=form, json=body)
+            response.get_data()  ## a streamed response (the exports) runs its statements while it is read
+        finally:
+            elapsed = time.perf_counter() - started
+            _Counter.measuring = False
+        with client.session_transaction() as session:
+            flashed = [message for _, message in session.get('_flashes', [])]
+        problem = unexpected(request, response, flashed, data)
+        if problem:
+            raise RuntimeError('{} {}'.format(request.name, problem))
+        if run == 0:
+            continue  ## the warm-up run fills the catalog cache and compiles the templates
+        statements.append(len(_Counter.statements))
+        rows.append(_Counter.rows)
+        times.append(elapsed * 1000)
+    return Measure(max(statements), max(rows), statistics.median(times), list(_Counter.statements))
+
+
+def over_budget(budget, result, time_factor):
+    """Returns the parts of the budget the Measure is over, e.g. ['statements 5 > 3']."""
+    problems = []
+    if budget.statements is not None and result.statements > budget.statements:
+        problems.append('statements {} > {}'.format(result.statements, budget.statements))
+    if budget.rows is not None and result.rows > budget.rows:
+        problems.append('rows {} > {}'.format(result.rows, budget.rows))
+    if budget.ms is not None and time_factor and result.ms > budget.ms * time_factor:
+        problems.append('time {:.1f} ms > {:.0f} ms'.format(result.ms, budget.ms * time_factor))
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--time-factor', type=float, default=1.0, help='multiplies the time budgets, 0 skips them')
+    parser.add_argument('--record', action='store_true', help='write the statements of every request to query_baseline.json')
+    args = parser.parse_args()
+
+    # /metrics is measured too, and the uploaded images are saved out of the static folder
+    directory = tempfile.mkdtemp(prefix='quickmart-budgets-')
+    # the version of the admin flags is read once, like a worker does between two changes of the flags, so the
+    # admin pages don't count its check when its ttl happens to end during a run (see admins.py)
+    app = use_temporary_database(
+        engine_options={'connect_args': {'factory': CountingConnection}},
+        METRICS_ENABLED='true', METRICS_DIR=os.path.join(directory, 'metrics'), ADMINS_VERSION_TTL=3600,
+    )
+    app.config['UPLOAD_PATH'] = os.path.join(directory, 'images')
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+    from querylog import fingerprint
+
+    event.listen(Engine, 'before_cursor_execute', _record_statement)
+    data = reference_data(app)
+    baseline = {}
+    if os.path.exists(BASELINE):
+        with open(BASELINE) as file:
+            baseline = json.load(file)
+
+    failures, recorded = [], {}
+    for request in REQUESTS:
+        budget = budget_of(app.view_functions[request.endpoint], request.method)
+        if budget is None:
+            failures.append(request.name)
+            print('FAIL {}: the view {} has no query_budget for {}'.format(request.name, request.endpoint, request.method))
+            continue
+        result = measure(app, request, data)
+        statements = [fingerprint(statement) for statement in result.sql]
+        recorded[request.name] = statements
+        problems = over_budget(budget, result, args.time_factor)
+        print('{} {}: {}/{} statements, {}/{} rows, {:.1f}/{} ms{}'.format(
+            'FAIL' if problems else 'ok  ', request.name, result.statements, budget.statements, result.rows, budget.rows,
+            result.ms, budget.ms, ' ({})'.format(', '.join(problems)) if problems else '',
+        ))
+        if problems:
+            failures.append(request.name)
+            diff = list(difflib.unified_diff(baseline.get(request.name, []), statements, 'query_baseline.json', 'now', lineterm=''))
+            for line in diff or ['    ' + statement for statement in statements]:
+                print('    ' + line)
+
+    # every method of every routed view needs a budget and a request above, but the static view of flask,
+    # which serves the files of the static folder without the app (the pages link them through /assets)
+    requested = {(request.endpoint, request.method) for request in REQUESTS}
+    routed = sorted(
+        (rule.endpoint, method)
+        for rule in app.url_map.iter_rules() if rule.endpoint != 'static'
+        for method in rule.methods - {'HEAD', 'OPTIONS'}
+    )
+    for endpoint, method in routed:
+        if budget_of(app.view_functions[endpoint], method) is None:
+            failures.append(endpoint)
+            print('FAIL {} {}: has no query_budget'.format(method, endpoint))
+        elif (endpoint, method) not in requested:
+            failures.append(endpoint)
+            print('FAIL {} {}: has a query_budget but no request in benchmarks/budgets.py'.format(method, endpoint))
+
+    if args.record:
+        with open(BASELINE, 'w') as file:
+            json.dump(recorded, file, indent=2)
+            file.write('\n')
+        print('recorded the statements in {}'.format(BASELINE))
+    print('{} checks failed: {}'.format(len(failures), ', '.join(failures)) if failures else 'every request is within its budget')
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,89 @@
+"""
+    Concurrent checkout load test: many users order the last items of the same product at once.
+
+    Every user has the product in their cart and all of them press the order now button
+    at the same moment from their own thread. The test passes when the stock never goes
+    below zero and the quantity ordered is exactly the stock that was taken.
+
+        python -m benchmarks.checkout_oversell --checkouts 200 --stock 50
+"""
+
+import argparse
+import json
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks import use_temporary_database, login
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--checkouts', type=int, default=200, help='number of users checking out at once')
+    parser.add_argument('--stock', type=int, default=50, help='quantity available of the product')
+    parser.add_argument('--quantity', type=int, default=1, help='quantity of the product in every cart')
+    args = parser.parse_args()
+
+    app = use_temporary_database()
+    from models import db, User, Category, Product, Cart, Order
+    from datetime import date
+
+    with app.app_context():
+        category = Category(cat_name='Flash sale')
+        db.session.add(category)
+        db.session.flush()
+        product = Product(product_name='Last phone', price=100.0, category_id=category.id, quantity_available=args.stock, manu_date=date(2024, 1, 1), product_image_path='')
+        db.session.add(product)
+        users = [User(username='user{}'.format(number), hashed_password='-') for number in range(args.checkouts)]
+        db.session.add_all(users)
+        db.session.flush()
+        db.session.add_all([Cart(user_id=user.id, product_id=product.id, quantity_added_to_cart=args.quantity) for user in users])
+        db.session.commit()
+        product_id, user_ids = product.id, [user.id for user in users]
+
+    # every thread waits at the barrier so all the checkouts start together
+    barrier = threading.Barrier(args.checkouts)
+
+    def checkout(user_id):
+        client = app.test_client()
+        login(client, user_id)
+        barrier.wait()
+        started = time.perf_counter()
+        response = client.post('/order_now')
+        with client.session_transaction() as session:
+            messages = [message for _, message in session.get('_flashes', [])]
+        return response.status_code, messages, time.perf_counter() - started
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.checkouts) as pool:
+        results = list(pool.map(checkout, user_ids))
+    elapsed = time.perf_counter() - started
+
+    with app.app_context():
+        stock_left = db.session.get(Product, product_id).quantity_available
+        quantity_ordered = db.session.execute(db.select(db.func.coalesce(db.func.sum(Order.quantity), 0))).scalar()
+
+    placed = sum('Order placed successfully' in messages for _, messages, _ in results)
+    out_of_stock = sum(any('out of stock' in message for message in messages) for _, messages, _ in results)
+    errors = sum(status >= 500 for status, _, _ in results)
+    oversold = stock_left < 0 or quantity_ordered != args.stock - stock_left or quantity_ordered > args.stock
+
+    report = {
+        'checkouts': args.checkouts,
+        'stock': args.stock,
+        'orders_placed': placed,
+        'rejected_out_of_stock': out_of_stock,
+        'errors': errors,
+        'stock_left': stock_left,
+        'quantity_ordered': quantity_ordered,
+        'oversold': oversold,
+        'seconds': round(elapsed, 3),
+        'checkouts_per_second': round(args.checkouts / elapsed, 1),
+    }
+    print(json.dumps(report, indent=2))
+    return 1 if oversold or errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
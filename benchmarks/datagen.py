@@ -0,0 +1,199 @@
+"""
+    Seeded generator of a shop full of synthetic data for the benchmarks: users, categories,
+    products, carts, transactions and their orders, with the search index and the daily sales
+    rollups of the admin dashboard made from them.
+
+    The same seed and scale always make the same rows, so two commits are benchmarked on the
+    same data. Only the dates move with the day the data is made: the transactions are spread
+    over the last 365 days, the periods of the admin dashboard.
+
+    The rows are inserted with executemany in batches, a million orders take about a minute on SQLite.
+
+        python -m benchmarks.datagen --orders 1000000 --seed 1 --database sqlite:////tmp/quickmart-1m.sqlite3
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from collections import namedtuple
+from datetime import date, timedelta
+
+
+# the size of a generated shop; users, products and categories default to numbers that fit the orders
+Scale = namedtuple('Scale', ['orders', 'users', 'products', 'categories', 'cart_users'])
+
+# the ids and search terms the scenarios pick from
+Dataset = namedtuple('Dataset', ['user_ids', 'product_ids', 'category_ids', 'search_terms', 'password', 'counts'])
+
+# the password of every generated user, its hash is made once
+PASSWORD = 'benchmark'
+
+BATCH_SIZE = 10000
+
+ADJECTIVES = ['fresh', 'organic', 'crunchy', 'smoked', 'sweet', 'spicy', 'frozen', 'golden', 'wild', 'classic', 'roasted', 'tiny']
+NOUNS = ['apple', 'banana', 'bread', 'cheese', 'coffee', 'tea', 'rice', 'pasta', 'butter', 'honey', 'yogurt', 'salmon', 'tomato',
+         'olive', 'almond', 'chocolate', 'cereal', 'juice', 'pepper', 'garlic']
+CATEGORY_NAMES = ['Fruits', 'Bakery', 'Dairy', 'Drinks', 'Pantry', 'Seafood', 'Vegetables', 'Snacks', 'Frozen', 'Spices']
+
+
+def scale_for(orders, users=None, products=None, categories=None, cart_users=None):
+    """Returns the Scale of a shop with that many orders, the other sizes default to one user per 20 orders and so on."""
+    users = users or max(10, orders // 20)
+    return Scale(
+        orders=orders,
+        users=users,
+        products=products or max(50, min(20000, orders // 50)),
+        categories=categories or 20,
+        cart_users=cart_users if cart_users is not None else users // 10,
+    )
+
+
+def _batches(rows):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= BATCH_SIZE:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _next_id(model):
+    from models import db
+    return (db.session.execute(db.select(db.func.max(model.id))).scalar() or 0) + 1
+
+
+def generate(scale, seed=0, echo=lambda message: None):
+    """
+        Adds the rows of a shop of that Scale to the database of the current app context and
+        returns the Dataset. The database is expected to be new, e.g. made by 'flask init-db'.
+    """
+    from sqlalchemy import insert
+    from werkzeug.security import generate_password_hash
+
+    from config import app
+    from models import db, User, Category, Product, Cart, Transaction, Order
+    from catalog import bump_catalog_version
+    from sales import rebuild_sales
+    import search
+
+    rng = random.Random(seed)
+    today = date.today()
+
+    first_category = _next_id(Category)
+    categories = [
+        dict(id=first_category + number, cat_name='{} {}'.format(CATEGORY_NAMES[number % len(CATEGORY_NAMES)], number // len(CATEGORY_NAMES) + 1))
+        for number in range(scale.categories)
+    ]
+    db.session.execute(insert(Category), categories)
+    category_ids = [category['id'] for category in categories]
+
+    first_product = _next_id(Product)
+    prices = {}
+    products = []
+    for number in range(scale.products):
+        product_id = first_product + number
+        prices[product_id] = round(rng.uniform(0.5, 50), 2)
+        adjective, noun = rng.choice(ADJECTIVES), rng.choice(NOUNS)
+        products.append(dict(
+            id=product_id, sku='BENCH-{:07d}'.format(number), product_name='{} {} {}'.format(adjective, noun, number).capitalize(),
+            price=prices[product_id], description='A {} {} from the benchmark shop.'.format(adjective, noun),
+            category_id=category_ids[number % len(category_ids)], quantity_available=10 ** 9,  ## the checkouts of the benchmarks never run out
+            manu_date=date(2024, 1, 1) + timedelta(days=number % 365), product_image_path='',
+        ))
+    for batch in _batches(products):
+        db.session.execute(insert(Product), batch)
+    product_ids = [product['id'] for product in products]
+    echo('{} categories, {} products'.format(len(categories), len(products)))
+
+    hashed_password = generate_password_hash(PASSWORD, app.config['PASSWORD_HASH_METHOD'], app.config['PASSWORD_SALT_LENGTH'])
+    first_user = _next_id(User)
+    user_ids = list(range(first_user, first_user + scale.users))
+    for batch in _batches(dict(id=user_id, username='user{}'.format(user_id), hashed_password=hashed_password, name='User {}'.format(user_id)) for user_id in user_ids):
+        db.session.execute(insert(User), batch)
+    echo('{} users'.format(len(user_ids)))
+
+    carts = []
+    for user_id in rng.sample(user_ids, min(scale.cart_users, len(user_ids))):
+        for product_id in rng.sample(product_ids, rng.randint(1, min(3, len(product_ids)))):
+            carts.append(dict(user_id=user_id, product_id=product_id, quantity_added_to_cart=rng.randint(1, 3)))
+    for batch in _batches(carts):
+        db.session.execute(insert(Cart), batch)
+    echo('{} cart lines'.format(len(carts)))
+
+    # the transactions of 1 to 5 lines, until there are as many order lines as asked
+    transaction_id, order_id = _next_id(Transaction), _next_id(Order)
+    transactions, orders, placed = [], [], 0
+    started = time.perf_counter()
+    while placed < scale.orders:
+        lines = min(rng.randint(1, 5), scale.orders - placed, len(product_ids))
+        user_id = rng.choice(user_ids)
+        day = today - timedelta(days=rng.randrange(365))
+        total = item_count = 0
+        for product_id in rng.sample(product_ids, lines):
+            quantity = rng.randint(1, 4)
+            subtotal = round(prices[product_id] * quantity, 2)
+            orders.append(dict(id=order_id, user_id=user_id, product_id=product_id, quantity=quantity, transaction_id=transaction_id,
+                               price=prices[product_id], subtotal=subtotal))
+            order_id += 1
+            total += subtotal
+            item_count += quantity
+        transactions.append(dict(id=transaction_id, price=round(total, 2), user_id=user_id, date_time=day, item_count=item_count))
+        transaction_id += 1
+        placed += lines
+        if len(orders) >= BATCH_SIZE:
+            db.session.execute(insert(Transaction), transactions)
+            db.session.execute(insert(Order), orders)
+            transactions, orders = [], []
+            echo('{} orders ({:.0f}/s)'.format(placed, placed / (time.perf_counter() - started)))
+    if orders:
+        db.session.execute(insert(Transaction), transactions)
+        db.session.execute(insert(Order), orders)
+
+    # what the app keeps up to date at every change, made once for all the rows
+    rebuild_sales()
+    search.rebuild_search_index()
+    bump_catalog_version()
+    db.session.commit()
+
+    counts = {
+        model.__tablename__: db.session.execute(db.select(db.func.count()).select_from(model)).scalar()
+        for model in (User, Category, Product, Cart, Transaction, Order)
+    }
+    echo(json.dumps(counts))
+    return Dataset(user_ids, product_ids, category_ids, NOUNS, PASSWORD, counts)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--orders', type=int, default=100000, help='number of order lines, up to a million and more')
+    parser.add_argument('--users', type=int, default=None, help='number of users, one per 20 orders by default')
+    parser.add_argument('--products', type=int, default=None, help='number of products, one per 50 orders by default')
+    parser.add_argument('--seed', type=int, default=0, help='the seed of the random rows')
+    parser.add_argument('--database', default=None, help='the empty database to fill, a temporary SQLite file by default')
+    args = parser.parse_args()
+
+    if args.database:
+        os.environ['SQLALCHEMY_DATABASE_URI'] = args.database
+        sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        from app import app, init_db
+        with app.app_context():
+            init_db()
+    else:
+        from benchmarks import use_temporary_database
+        app = use_temporary_database()
+
+    started = time.perf_counter()
+    with app.app_context():
+        from models import db
+        generate(scale_for(args.orders, args.users, args.products), seed=args.seed, echo=print)
+        print('{} in {:.1f}s'.format(db.engine.url.render_as_string(hide_password=True), time.perf_counter() - started))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,134 @@
+"""
+    Flash-sale throughput benchmark: the per-request checkout against the flash-sale queue.
+
+    Many users, split over several worker processes like gunicorn workers, order the same
+    product at the same moment. The benchmark runs once with the normal checkout and once
+    with the product in FLASH_SALE_PRODUCT_IDS, each on a fresh database, and prints the
+    checkouts per second, the latency and the errors ("database is locked") of both.
+
+        python -m benchmarks.flash_sale --processes 4 --threads 50 --stock 100
+"""
+
+import argparse
+import json
+import multiprocessing
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks import use_temporary_database, login
+
+
+def run(args):
+    """Runs the benchmark in this process with the mode picked on the command line."""
+    config = {'FLASH_SALE_PRODUCT_IDS': 1} if args.mode == 'flash-sale' else {}
+    app = use_temporary_database(**config)
+    from models import db, User, Category, Product, Cart, Order
+    from datetime import date
+
+    checkouts = args.processes * args.threads
+    with app.app_context():
+        category = Category(cat_name='Flash sale')
+        db.session.add(category)
+        db.session.flush()
+        product = Product(product_name='Promo phone', price=100.0, category_id=category.id, quantity_available=args.stock, manu_date=date(2024, 1, 1), product_image_path='')
+        db.session.add(product)
+        users = [User(username='user{}'.format(number), hashed_password='-') for number in range(checkouts)]
+        db.session.add_all(users)
+        db.session.flush()
+        db.session.add_all([Cart(user_id=user.id, product_id=product.id, quantity_added_to_cart=1) for user in users])
+        db.session.commit()
+        user_ids = [user.id for user in users]
+        db.engine.dispose()  ## every worker process opens its own connections
+
+    start = multiprocessing.get_context('fork').Barrier(args.processes)
+    results = multiprocessing.get_context('fork').Queue()
+    workers = [
+        multiprocessing.get_context('fork').Process(target=worker, args=(app, user_ids[number::args.processes], start, results))
+        for number in range(args.processes)
+    ]
+    for process in workers:
+        process.start()
+    latencies, statuses, elapsed = [], [], 0.0
+    for _ in workers:
+        worker_latencies, worker_statuses, worker_elapsed = results.get()
+        latencies += worker_latencies
+        statuses += worker_statuses
+        elapsed = max(elapsed, worker_elapsed)
+    for process in workers:
+        process.join()
+
+    with app.app_context():
+        stock_left = db.session.get(Product, 1).quantity_available
+        quantity_ordered = db.session.execute(db.select(db.func.coalesce(db.func.sum(Order.quantity), 0))).scalar()
+
+    latencies.sort()
+    return {
+        'mode': args.mode,
+        'checkouts': checkouts,
+        'stock': args.stock,
+        'orders_placed': quantity_ordered,
+        'stock_left': stock_left,
+        'oversold': stock_left < 0 or quantity_ordered + stock_left != args.stock,
+        'errors': sum(status >= 500 for status in statuses),
+        'seconds': round(elapsed, 3),
+        'checkouts_per_second': round(checkouts / elapsed, 1),
+        'p50_ms': round(latencies[len(latencies) // 2] * 1000, 1),
+        'p99_ms': round(latencies[int(len(latencies) * 0.99)] * 1000, 1),
+    }
+
+
+def worker(app, user_ids, start, results):
+    """A worker process checking out the carts of its users, one thread per user."""
+    from models import db
+    with app.app_context():
+        db.engine.dispose(close=False)
+
+    clients = []
+    for user_id in user_ids:
+        client = app.test_client()
+        login(client, user_id)
+        clients.append(client)
+    barrier = threading.Barrier(len(clients))
+
+    def checkout(client):
+        barrier.wait()
+        started = time.perf_counter()
+        status = client.post('/order_now').status_code
+        return time.perf_counter() - started, status
+
+    start.wait()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=len(clients)) as pool:
+        outcomes = list(pool.map(checkout, clients))
+    results.put(([latency for latency, _ in outcomes], [status for _, status in outcomes], time.perf_counter() - started))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--processes', type=int, default=4, help='number of worker processes')
+    parser.add_argument('--threads', type=int, default=50, help='number of users checking out at once in every process')
+    parser.add_argument('--stock', type=int, default=100, help='quantity available of the product')
+    parser.add_argument('--mode', choices=['per-request', 'flash-sale'], help='run only one mode, in this process')
+    args = parser.parse_args()
+
+    if args.mode:
+        print(json.dumps(run(args)))
+        return 0
+
+    # every mode runs in its own interpreter, because the flash-sale products are read from the config at import
+    reports = []
+    for mode in ('per-request', 'flash-sale'):
+        output = subprocess.run(
+            [sys.executable, '-m', 'benchmarks.flash_sale', '--mode', mode, '--processes', str(args.processes), '--threads', str(args.threads), '--stock', str(args.stock)],
+            check=True, capture_output=True, text=True,
+        ).stdout
+        reports.append(json.loads(output.strip().splitlines()[-1]))
+    print(json.dumps(reports, indent=2))
+    return 1 if any(report['oversold'] for report in reports) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,197 @@
+"""
+    The scenarios of the benchmark suite and the two drivers that run them.
+
+    A scenario is one kind of request of a shopper or of the admin, e.g. the home page with a
+    search. Every virtual user of a driver logs in once, then sends the request of the scenario
+    again and again (after its untimed setup request, like filling the cart before a checkout).
+
+        test-client  the virtual users are threads of this process sending their requests through
+                     the flask test client, no network and no server in the way.
+        http         the virtual users are processes sending their requests over HTTP keep-alive
+                     connections to a running server, e.g. gunicorn started by benchmarks.suite.
+"""
+
+import http.client
+import multiprocessing
+import random
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode, urlsplit
+
+from benchmarks import login
+
+
+# a request of a scenario: the method, the path and the form of a POST
+Request = namedtuple('Request', ['method', 'path', 'form'])
+
+# endpoint and method: the view of the timed requests, as in the labels of metrics.py
+# as_admin: the scenario is run by the admin, user_ids are ignored
+# setup: an untimed request sent before every timed one, or None
+Scenario = namedtuple('Scenario', ['name', 'endpoint', 'method', 'as_admin', 'request', 'setup'])
+
+# the latencies in seconds and the status codes of the requests of a run, the statements are None when not counted
+RunResult = namedtuple('RunResult', ['latencies', 'statuses', 'statements', 'seconds'])
+
+
+def _add_to_cart(rng, dataset):
+    return Request('POST', '/add_to_cart/{}'.format(rng.choice(dataset.product_ids)), {'quantity_input': '1'})
+
+
+SCENARIOS = [
+    Scenario('browse', 'home_page', 'GET', False, lambda rng, dataset: Request('GET', '/', None), None),
+    Scenario('search', 'home_page', 'GET', False, lambda rng, dataset: Request('GET', '/?' + urlencode({'pname': rng.choice(dataset.search_terms)}), None), None),
+    Scenario('add_to_cart', 'home_page_add_to_cart_post', 'POST', False, _add_to_cart, None),
+    Scenario('order_now', 'order_now_button', 'POST', False, lambda rng, dataset: Request('POST', '/order_now', {}), _add_to_cart),
+    Scenario('show_orders', 'show_orders', 'GET', False, lambda rng, dataset: Request('GET', '/transaction_history', None), None),
+    Scenario('admin_dashboard', 'admin_dashboard', 'GET', True, lambda rng, dataset: Request('GET', '/admin_dashboard', None), None),
+]
+SCENARIOS_BY_NAME = {scenario.name: scenario for scenario in SCENARIOS}
+
+
+def percentile(sorted_values, fraction):
+    """Returns the value of a sorted list at a fraction (0.99 for the p99), by the nearest rank."""
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+
+##################################### TEST CLIENT DRIVER ##########################################################
+def run_test_client(app, scenario, dataset, admin_id, users, requests, seed):
+    """Runs a scenario with users threads of this process, each sending requests timed requests. Returns the RunResult."""
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+
+    counter = threading.local()
+
+    def count(connection, cursor, statement, parameters, context, executemany):
+        counter.statements = getattr(counter, 'statements', 0) + 1
+
+    def virtual_user(number):
+        rng = random.Random(seed * 1000 + number)
+        client = app.test_client()
+        user_id = admin_id if scenario.as_admin else dataset.user_ids[number % len(dataset.user_ids)]
+        login(client, user_id, is_admin=scenario.as_admin)
+        latencies, statuses, statements = [], [], []
+        barrier.wait()
+        for _ in range(requests):
+            if scenario.setup is not None:
+                _test_client_send(client, scenario.setup(rng, dataset))
+            request = scenario.request(rng, dataset)
+            counter.statements = 0
+            started = time.perf_counter()
+            statuses.append(_test_client_send(client, request))
+            latencies.append(time.perf_counter() - started)
+            statements.append(counter.statements)
+        return latencies, statuses, statements
+
+    barrier = threading.Barrier(users)
+    event.listen(Engine, 'before_cursor_execute', count)
+    try:
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=users) as pool:
+            results = list(pool.map(virtual_user, range(users)))
+        elapsed = time.perf_counter() - started
+    finally:
+        event.remove(Engine, 'before_cursor_execute', count)
+    return RunResult(
+        [latency for result in results for latency in result[0]],
+        [status for result in results for status in result[1]],
+        [statements for result in results for statements in result[2]],
+        elapsed,
+    )
+
+
+def _test_client_send(client, request):
+    if request.method == 'GET':
+        return client.get(request.path).status_code
+    return client.open(request.path, method=request.method, data=request.form).status_code
+
+
+##################################### HTTP DRIVER ##########################################################
+class HttpSession:
+    """A keep-alive connection to the server with the cookies of one user."""
+
+    def __init__(self, url):
+        parts = urlsplit(url)
+        self.connection = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=60)
+        self.cookies = {}
+
+    def send(self, request):
+        headers = {'Cookie': '; '.join('{}={}'.format(name, value) for name, value in self.cookies.items())}
+        body = None
+        if request.form is not None:
+            body = urlencode(request.form)
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        self.connection.request(request.method, request.path, body=body, headers=headers)
+        response = self.connection.getresponse()
+        response.read()
+        for header in response.headers.get_all('Set-Cookie') or []:
+            name, _, value = header.split(';', 1)[0].partition('=')
+            self.cookies[name.strip()] = value
+        return response.status
+
+
+def run_http(url, scenario, dataset, users, requests, seed):
+    """Runs a scenario with users processes sending requests timed requests each to the server at url. Returns the RunResult."""
+    context = multiprocessing.get_context('fork')
+    start = context.Barrier(users + 1)
+    results = context.Queue()
+    processes = [context.Process(target=_http_user, args=(url, scenario, dataset, number, requests, seed, start, results)) for number in range(users)]
+    for process in processes:
+        process.start()
+    start.wait()  ## every virtual user is logged in
+    started = time.perf_counter()
+    collected = [results.get() for _ in processes]
+    elapsed = time.perf_counter() - started
+    for process in processes:
+        process.join()
+    return RunResult(
+        [latency for latencies, _ in collected for latency in latencies],
+        [status for _, statuses in collected for status in statuses],
+        None,
+        elapsed,
+    )
+
+
+def _http_user(url, scenario, dataset, number, requests, seed, start, results):
+    rng = random.Random(seed * 1000 + number)
+    session = HttpSession(url)
+    if scenario.as_admin:
+        username, password = 'admin', 'admin'
+    else:
+        user_id = dataset.user_ids[number % len(dataset.user_ids)]
+        username, password = 'user{}'.format(user_id), dataset.password
+    session.send(Request('POST', '/login', {'username': username, 'password': password}))
+    start.wait()
+    latencies, statuses = [], []
+    for _ in range(requests):
+        if scenario.setup is not None:
+            session.send(scenario.setup(rng, dataset))
+        request = scenario.request(rng, dataset)
+        started = time.perf_counter()
+        statuses.append(session.send(request))
+        latencies.append(time.perf_counter() - started)
+    results.put((latencies, statuses))
+
+
+def scrape_statements(url, token):
+    """
+        Returns the number of SQL statements and of requests of every (endpoint, method) so far,
+        from the /metrics of the server (see metrics.py).
+    """
+    session = HttpSession(url)
+    session.connection.request('GET', '/metrics', headers={'Authorization': 'Bearer ' + token})
+    response = session.connection.getresponse()
+    text = response.read().decode()
+    totals = {}
+    for line in text.splitlines():
+        for suffix, index in (('_sum{', 0), ('_count{', 1)):
+            prefix = 'quickmart_http_request_sql_statements' + suffix
+            if line.startswith(prefix):
+                labels, value = line[len(prefix):].rsplit('} ', 1)
+                label = dict(part.split('=', 1) for part in labels.split(','))
+                key = (label['endpoint'].strip('"'), label['method'].strip('"'))
+                totals.setdefault(key, [0, 0])[index] = float(value)
+    return totals
@@ -0,0 +1,85 @@
+"""
+    Login throughput benchmark of the password hashing settings.
+
+    Many users log in at once from their own thread while another thread keeps loading
+    a cheap page (the login page), like the other visitors of a worker during a login peak.
+    Prints the logins per second, the logins per second per core used by the hashing threads
+    (hashlib hashes without the GIL) and the latency of the cheap page during the logins.
+
+        python -m benchmarks.password_hashing --method scrypt:32768:8:1 --workers 2 --logins 100
+        python -m benchmarks.password_hashing --method pbkdf2:sha256:600000 --workers 4
+"""
+
+import argparse
+import json
+import os
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks import use_temporary_database
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--method', default='scrypt:32768:8:1', help='PASSWORD_HASH_METHOD of the hashes')
+    parser.add_argument('--workers', type=int, default=2, help='PASSWORD_HASH_WORKERS, the threads hashing at once')
+    parser.add_argument('--threads', type=int, default=32, help='number of users logging in at once')
+    parser.add_argument('--logins', type=int, default=50, help='number of logins')
+    args = parser.parse_args()
+
+    app = use_temporary_database(PASSWORD_HASH_METHOD=args.method, PASSWORD_HASH_WORKERS=args.workers)
+    from models import db, User
+    from passwords import hash_password
+
+    with app.app_context():
+        hashed_password = hash_password('password')  ## every user has the same password, it is hashed once
+        db.session.add_all([User(username='user{}'.format(number), hashed_password=hashed_password) for number in range(args.logins)])
+        db.session.commit()
+        db.engine.dispose()
+
+    def login(number):
+        client = app.test_client()
+        response = client.post('/login', data={'username': 'user{}'.format(number), 'password': 'password'})
+        return response.status_code == 302 and response.headers['Location'].endswith('/')
+
+    page_latencies, done = [], threading.Event()
+
+    def load_pages():
+        client = app.test_client()
+        while not done.is_set():
+            started = time.perf_counter()
+            client.get('/login')
+            page_latencies.append(time.perf_counter() - started)
+
+    pages = threading.Thread(target=load_pages)
+    pages.start()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.threads) as pool:
+        results = list(pool.map(login, range(args.logins)))
+    elapsed = time.perf_counter() - started
+    done.set()
+    pages.join()
+
+    page_latencies.sort()
+    cores = min(args.workers, os.cpu_count() or 1)  ## the hashing threads can't use more cores than the machine has
+    report = {
+        'method': args.method,
+        'hashing_threads': args.workers,
+        'cores': cores,
+        'logins': args.logins,
+        'failed_logins': results.count(False),
+        'seconds': round(elapsed, 2),
+        'logins_per_second': round(args.logins / elapsed, 1),
+        'logins_per_second_per_core': round(args.logins / elapsed / cores, 1),
+        'other_page_ms_p50': round(statistics.median(page_latencies) * 1000, 1),
+        'other_page_ms_p95': round(page_latencies[int(len(page_latencies) * 0.95)] * 1000, 1),
+    }
+    print(json.dumps(report, indent=2))
+    return 1 if report['failed_logins'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,81 @@
+"""
+    Bulk product import benchmark: imports a generated CSV file of many products, twice.
+
+    The first run adds every product, the second one updates them all by their SKU.
+    Prints the rows per second of both runs and the peak memory of the process, which
+    should stay about the same whatever the number of rows, as the file is streamed in batches.
+
+        python -m benchmarks.product_import --rows 100000 --format csv
+"""
+
+import argparse
+import csv
+import json
+import os
+import resource
+import sys
+import tempfile
+import time
+
+from benchmarks import use_temporary_database
+
+
+def write_products(path, rows, format, categories):
+    """Writes a file of generated products, a tenth of them with an error to report."""
+    columns = ['sku', 'product_name', 'price', 'quantity_available', 'manu_date', 'category', 'description']
+    with open(path, 'w', newline='', encoding='utf-8') as file:
+        writer = csv.writer(file) if format == 'csv' else None
+        if writer:
+            writer.writerow(columns)
+        for number in range(rows):
+            quantity = 0 if number % 10 == 9 else number % 500 + 1  ## 'Quantity must be greater than 0'
+            values = ['SKU-{:08d}'.format(number), 'Product {}'.format(number), '{:.2f}'.format(1 + number % 1000 / 10),
+                      str(quantity), '2024-01-{:02d}'.format(number % 28 + 1), categories[number % len(categories)], 'Imported product']
+            if writer:
+                writer.writerow(values)
+            else:
+                file.write(json.dumps(dict(zip(columns, values))) + '\n')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=100000, help='number of products in the file')
+    parser.add_argument('--format', choices=['csv', 'jsonl'], default='csv', help='format of the file')
+    args = parser.parse_args()
+
+    app = use_temporary_database()
+    from models import db, Category, Product
+    from inventory import import_products, read_rows
+
+    categories = ['Phones', 'Laptops', 'Tablets', 'Cameras']
+    with app.app_context():
+        db.session.add_all([Category(cat_name=name) for name in categories])
+        db.session.commit()
+
+    path = os.path.join(tempfile.mkdtemp(prefix='quickmart-import-'), 'products.' + args.format)
+    write_products(path, args.rows, args.format, categories)
+
+    report = {'rows': args.rows, 'format': args.format, 'file_mb': round(os.path.getsize(path) / 2 ** 20, 1)}
+    for run in ('insert', 'update'):
+        with app.app_context(), open(path, 'rb') as file:
+            started = time.perf_counter()
+            result = import_products(read_rows(file, args.format), key='sku')
+            elapsed = time.perf_counter() - started
+        report[run] = {
+            'inserted': result.inserted,
+            'updated': result.updated,
+            'errors': result.error_count,
+            'seconds': round(elapsed, 2),
+            'rows_per_second': round(args.rows / elapsed),
+        }
+    with app.app_context():
+        report['products'] = db.session.execute(db.select(db.func.count(Product.id))).scalar()
+    # ru_maxrss is in KB on Linux
+    report['peak_rss_mb'] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    print(json.dumps(report, indent=2))
+    expected = args.rows - args.rows // 10
+    return 0 if report['products'] == expected and report['update']['updated'] == expected else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
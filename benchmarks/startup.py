@@ -0,0 +1,112 @@
+"""
+    Worker startup benchmark: the time to import the app and the latency of the first requests.
+
+    Every run is a new interpreter, like a gunicorn worker booting, on the same database of
+    --products products. It prints the median of the runs for each mode:
+
+        init-on-import  the app is imported and the database initialised in the worker, what
+                        every worker did before 'flask init-db' (the schema inspection and the
+                        admin lookup; the tables and the admin already exist here).
+        lazy            the app is imported, the first request compiles the templates and
+                        builds the catalog cache.
+        preloaded       wsgi.py is imported, the warm up is done before the first request,
+                        with gunicorn --preload it is done once in the master before the fork.
+
+    The first request is the home page of a logged in user, the second one shows the latency
+    once everything is warm.
+
+        python -m benchmarks.startup --products 5000 --runs 5
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+from benchmarks import use_temporary_database, login
+
+
+MODES = ('init-on-import', 'lazy', 'preloaded')
+
+
+def run(mode, user_id):
+    """Imports the app in this new interpreter like a worker booting and times its first requests."""
+    started = time.perf_counter()
+    if mode == 'preloaded':
+        from wsgi import application as app
+    else:
+        from app import app, init_db
+        if mode == 'init-on-import':
+            with app.app_context():
+                init_db()
+    imported = time.perf_counter()
+
+    client = app.test_client()
+    login(client, user_id)
+    latencies = []
+    for _ in range(2):
+        request_started = time.perf_counter()
+        status = client.get('/').status_code
+        latencies.append(time.perf_counter() - request_started)
+        assert status == 200, status
+    return {
+        'import_ms': (imported - started) * 1000,
+        'first_request_ms': latencies[0] * 1000,
+        'second_request_ms': latencies[1] * 1000,
+    }
+
+
+def seed(products):
+    """Creates the database of the benchmark with its products and a user, returns the id of the user."""
+    app = use_temporary_database()
+    from models import db, User, Category, Product
+    from datetime import date
+
+    with app.app_context():
+        categories = [Category(cat_name='Category {}'.format(number)) for number in range(20)]
+        db.session.add_all(categories)
+        db.session.flush()
+        db.session.add_all([
+            Product(product_name='Phone {}'.format(number), price=100.0 + number % 50, category_id=categories[number % 20].id,
+                    quantity_available=10, manu_date=date(2024, 1, 1), product_image_path='', description='a phone')
+            for number in range(products)
+        ])
+        user = User(username='shopper', hashed_password='-')
+        db.session.add(user)
+        db.session.commit()
+        return user.id
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--products', type=int, default=5000, help='number of products in the catalog')
+    parser.add_argument('--runs', type=int, default=5, help='number of interpreters started for every mode')
+    parser.add_argument('--mode', choices=MODES, help='run only one mode, in this process')
+    parser.add_argument('--user-id', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.mode:
+        print(json.dumps(run(args.mode, args.user_id)))
+        return 0
+
+    user_id = seed(args.products)
+    reports = []
+    for mode in MODES:
+        command = [sys.executable, '-m', 'benchmarks.startup', '--mode', mode, '--user-id', str(user_id)]
+        runs = [
+            json.loads(subprocess.run(command, check=True, capture_output=True, text=True, env=os.environ).stdout.strip().splitlines()[-1])
+            for _ in range(args.runs)
+        ]
+        report = {'mode': mode}
+        for measure in runs[0]:
+            report[measure] = round(statistics.median(result[measure] for result in runs), 1)
+        reports.append(report)
+    print(json.dumps(reports, indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,175 @@
+"""
+    The benchmark suite: fills a new database with the seeded synthetic shop of benchmarks.datagen,
+    runs the scenarios of benchmarks.load on it and reports, for every scenario, the throughput,
+    the p50, p95 and p99 latency and the SQL statements per request as JSON.
+
+    The report has the same keys in the same order for the same options, so the reports of two
+    commits can be diffed, or compared with --compare:
+
+        python -m benchmarks.suite --orders 100000 --output before.json
+        git checkout my-branch
+        python -m benchmarks.suite --orders 100000 --output after.json --compare before.json
+
+    With --driver http the scenarios are sent over HTTP by --users processes, to a gunicorn started
+    on the generated database with --workers workers (its metrics give the statements per request),
+    or to the server at --url already running on a database made with benchmarks.datagen.
+"""
+
+import argparse
+import json
+import os
+import secrets
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+from benchmarks import use_temporary_database
+from benchmarks.datagen import generate, scale_for, Dataset, NOUNS, PASSWORD
+from benchmarks.load import SCENARIOS, SCENARIOS_BY_NAME, run_test_client, run_http, scrape_statements, percentile
+
+
+def summary(result):
+    """The numbers of the report of a scenario, from its RunResult."""
+    latencies = sorted(result.latencies)
+    milliseconds = lambda seconds: round(seconds * 1000, 2) if seconds is not None else None
+    return {
+        'requests': len(latencies),
+        'errors': sum(status >= 500 for status in result.statuses),
+        'throughput_rps': round(len(latencies) / result.seconds, 1),
+        'p50_ms': milliseconds(percentile(latencies, 0.50)),
+        'p95_ms': milliseconds(percentile(latencies, 0.95)),
+        'p99_ms': milliseconds(percentile(latencies, 0.99)),
+        'queries_per_request': round(sum(result.statements) / len(result.statements), 2) if result.statements else None,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def start_gunicorn(database_url, workers):
+    """Starts gunicorn on the database with its metrics on, returns the process, its url and the metrics token."""
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+    token = secrets.token_hex(16)
+    environment = dict(
+        os.environ, SQLALCHEMY_DATABASE_URI=database_url, METRICS_ENABLED='true', METRICS_TOKEN=token,
+        METRICS_FLUSH_SECONDS='0.2', METRICS_DIR=tempfile.mkdtemp(prefix='quickmart-metrics-'),
+    )
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', '--bind', '127.0.0.1:{}'.format(port), '--workers', str(workers)],
+        env=environment, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    url = 'http://127.0.0.1:{}'.format(port)
+    for _ in range(300):
+        try:
+            urllib.request.urlopen(url + '/login', timeout=1)
+            return process, url, token
+        except OSError:
+            if process.poll() is not None:
+                raise RuntimeError('gunicorn stopped, run it by hand to see why')
+            time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError('gunicorn did not start')
+
+
+def compare(before, after):
+    """Prints the change of every number of every scenario between two reports, in percent."""
+    for name, numbers in after['scenarios'].items():
+        old = before.get('scenarios', {}).get(name)
+        if old is None:
+            continue
+        changes = []
+        for key, value in numbers.items():
+            if isinstance(value, (int, float)) and old.get(key):
+                changes.append('{} {:+.1f}%'.format(key, (value - old[key]) / old[key] * 100))
+        print('{:16} {}'.format(name, ', '.join(changes)), file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--orders', type=int, default=10000, help='number of order lines of the generated shop, up to a million and more')
+    parser.add_argument('--seed', type=int, default=0, help='the seed of the generated rows and of the requests')
+    parser.add_argument('--driver', choices=['test-client', 'http'], default='test-client')
+    parser.add_argument('--users', type=int, default=4, help='number of virtual users, threads (test-client) or processes (http)')
+    parser.add_argument('--requests', type=int, default=50, help='number of timed requests of every virtual user and scenario')
+    parser.add_argument('--scenarios', default=','.join(scenario.name for scenario in SCENARIOS), help='comma separated scenarios to run')
+    parser.add_argument('--workers', type=int, default=2, help='number of gunicorn workers started by the http driver')
+    parser.add_argument('--url', default=None, help='the server of the http driver, on a database made with benchmarks.datagen --seed SEED')
+    parser.add_argument('--metrics-token', default=None, help='the METRICS_TOKEN of the server at --url, to count its statements')
+    parser.add_argument('--output', '-o', default=None, help='the file to write the report to, the standard output by default')
+    parser.add_argument('--compare', default=None, help='a previous report to compare this one with')
+    args = parser.parse_args()
+    if args.url and args.driver != 'http':
+        parser.error('--url needs --driver http')
+
+    scenarios = [SCENARIOS_BY_NAME[name] for name in args.scenarios.split(',')]
+    report = {
+        'commit': git_commit(),
+        'settings': {name: getattr(args, name) for name in ('orders', 'seed', 'driver', 'users', 'requests', 'workers')},
+        'data': None,
+        'scenarios': {},
+    }
+
+    server = None
+    if args.url:
+        # the ids of the rows the generator made on the server with the same seed
+        scale = scale_for(args.orders)
+        dataset = Dataset(list(range(2, 2 + scale.users)), list(range(1, 1 + scale.products)), None, NOUNS, PASSWORD, None)
+        url, token = args.url, args.metrics_token
+    else:
+        app = use_temporary_database()
+        with app.app_context():
+            from models import db, User
+            started = time.perf_counter()
+            dataset = generate(scale_for(args.orders), seed=args.seed)
+            report['data'] = dict(dataset.counts, generate_seconds=round(time.perf_counter() - started, 1))
+            admin_id = db.session.execute(db.select(User.id).filter_by(username='admin')).scalar()
+            database_url = db.engine.url.render_as_string(hide_password=False)
+            db.engine.dispose()  ## the driver processes and gunicorn open their own connections
+        if args.driver == 'http':
+            server, url, token = start_gunicorn(database_url, args.workers)
+
+    try:
+        for scenario in scenarios:
+            print('{}...'.format(scenario.name), file=sys.stderr)
+            if args.driver == 'test-client':
+                result = run_test_client(app, scenario, dataset, admin_id, args.users, args.requests, args.seed)
+                report['scenarios'][scenario.name] = summary(result)
+                continue
+            before = scrape_statements(url, token) if token else {}
+            result = run_http(url, scenario, dataset, args.users, args.requests, args.seed)
+            numbers = summary(result)
+            if token:
+                time.sleep(0.5)  ## the workers write their metrics every METRICS_FLUSH_SECONDS
+                after = scrape_statements(url, token)
+                key = (scenario.endpoint, scenario.method)
+                statements, requests = (a - b for a, b in zip(after.get(key, [0, 0]), before.get(key, [0, 0])))
+                numbers['queries_per_request'] = round(statements / requests, 2) if requests else None
+            report['scenarios'][scenario.name] = numbers
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(output + '\n')
+    else:
+        print(output)
+    if args.compare:
+        with open(args.compare) as file:
+            compare(json.load(file), report)
+    return 1 if any(numbers['errors'] for numbers in report['scenarios'].values()) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,34 @@
+"""
+    A module that contains the performance budgets of the routes.
+
+    A view declares the most SQL statements, rows fetched and milliseconds one request of it
+    may take on the reference dataset of benchmarks.budgets:
+
+        @app.route('/cart')
+        @auth_required
+        @query_budget(statements=4, rows=50, ms=100)
+        def cart_page():
+
+    The views of flask_restful get it on the methods of their Resource (get, post, ...).
+    The decorator only marks the view, it changes nothing when the app serves requests.
+    'python -m benchmarks.budgets' runs every view with a budget and fails when one is over it,
+    so a lazy load added to a template shows up before it reaches production. Every routed
+    view needs a budget, the check fails on a view without one.
+"""
+
+from collections import namedtuple
+
+
+# the most statements, rows fetched from the database and wall time (ms) of one request, None is no limit
+QueryBudget = namedtuple('QueryBudget', ['statements', 'rows', 'ms'])
+
+
+def query_budget(statements, rows=None, ms=None):
+    """
+        Declares the budget of a view. Put it right above the def, the decorators made with
+        functools.wraps (auth_required, admin_required, ...) carry it to the registered view.
+    """
+    def decorator(func):
+        func.query_budget = QueryBudget(statements, rows, ms)
+        return func
+    return decorator
@@ -0,0 +1,85 @@
+"""
+    A module that contains the cart operations shared by the JSON cart endpoints of
+    routes.py and the cart resource of the REST API in api.py.
+"""
+
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
+
+from models import db, Cart, Product
+
+
+def cart_summary(user_id):
+    """Returns the number of items and the total price of the user's cart, computed in one query."""
+    count, total = db.session.execute(
+        db.select(func.coalesce(func.sum(Cart.quantity_added_to_cart), 0), func.coalesce(func.sum(Cart.quantity_added_to_cart * Product.price), 0))
+        .join(Product, Product.id == Cart.product_id)
+        .where(Cart.user_id == user_id)
+    ).one()
+    return {'count': count, 'total': total}
+
+
+def add_to_cart(user_id, items, retry=True):
+    """
+        Adds one or several products to the user's cart in a single commit.
+
+        Args:
+            user_id: the ID of the user.
+            items: a list of {"product_id": 1, "quantity": 2} dicts, the quantity defaults to 1.
+            retry: whether to try again once when another request added the same product at the same moment.
+
+        Returns:
+            a list with the error of every invalid item, or of every new line when the cart kept
+            changing at the same moment. If it isn't empty nothing was added.
+    """
+    if not isinstance(items, list) or not items:
+        return [{'error': 'items must be a non-empty list'}]
+
+    # the quantities of the same product are added together
+    quantities, errors = {}, []
+    for item in items:
+        product_id = item.get('product_id') if isinstance(item, dict) else None
+        quantity = item.get('quantity', 1) if isinstance(item, dict) else None
+        # true and false of the JSON body are ints in Python, they are not accepted as IDs or quantities
+        if not _is_int(product_id) or not _is_int(quantity) or quantity <= 0:
+            errors.append({'item': item, 'error': 'product_id and a quantity of at least 1 are required'})
+            continue
+        quantities[product_id] = quantities.get(product_id, 0) + quantity
+
+    # the products and the cart lines the user already has of them are loaded with one query each
+    products = {product.id: product for product in Product.query.filter(Product.id.in_(quantities)).all()}
+    carts = {cart.product_id: cart for cart in Cart.query.filter(Cart.user_id == user_id, Cart.product_id.in_(quantities)).all()}
+
+    for product_id, quantity in quantities.items():
+        product = products.get(product_id)
+        if not product:
+            errors.append({'product_id': product_id, 'error': 'Product not found'})
+            continue
+        in_cart = carts[product_id].quantity_added_to_cart if product_id in carts else 0
+        if quantity + in_cart > product.quantity_available:
+            errors.append({'product_id': product_id, 'error': 'Invalid quantity, should be between 1 and {}'.format(product.quantity_available - in_cart)})
+
+    if errors:
+        return errors
+
+    new_lines = []
+    for product_id, quantity in quantities.items():
+        if product_id in carts:
+            carts[product_id].quantity_added_to_cart += quantity
+        else:
+            new_lines.append(product_id)
+            db.session.add(Cart(user_id=user_id, product_id=product_id, quantity_added_to_cart=quantity))
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # the same product was added from another tab at the same moment and the unique index of the
+        # cart lines refused a second line, so the quantities are added again to the line that now exists
+        db.session.rollback()
+        if retry:
+            return add_to_cart(user_id, items, retry=False)
+        return [{'product_id': product_id, 'error': 'The cart changed at the same time, please try again'} for product_id in new_lines]
+    return []
+
+
+def _is_int(value):
+    return isinstance(value, int) and not isinstance(value, bool)
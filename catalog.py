@@ -0,0 +1,254 @@
+"""
+    A module that contains the in-process cache of the catalog (categories and their products).
+
+    Every worker keeps a read-only snapshot of the whole catalog made of small immutable
+    records, and serves the storefront pages from it instead of querying the database.
+    Every route that changes a category, a product or the stock calls bump_catalog_version
+    in the same commit as the change, which raises the version number in the catalog_version
+    table. Workers compare that number with the version of their snapshot at most once
+    every CATALOG_CACHE_TTL seconds and rebuild the snapshot when it changed.
+"""
+
+import threading
+import time
+from collections import namedtuple
+from datetime import date, datetime
+
+from sqlalchemy import event, text, update
+from sqlalchemy.orm import contains_eager
+
+from config import app
+from models import db, Category, Product, CatalogVersion
+from pagination import keyset_paginate, keyset_paginate_sorted, SortOrder, PRODUCT_SORT_ORDERS
+from replicas import primary_reads
+import search
+
+
+CATALOG_VERSION_ID = 1
+
+
+# the records have the same attribute names as the models, so the templates can render either of them
+CategoryRecord = namedtuple('CategoryRecord', ['id', 'cat_name'])
+ProductRecord = namedtuple('ProductRecord', [
+    'id', 'sku', 'product_name', 'price', 'description', 'category_id', 'category',
+    'quantity_available', 'manu_date', 'product_image_path',
+])
+
+
+# the sort key of a product record for each sort order of the catalog, the same values the sort columns have in the database
+_SORT_KEYS = {
+    'category': lambda product: (product.category_id, product.id),
+    'price_asc': lambda product: (product.price, product.id),
+    'price_desc': lambda product: (product.price, product.id),
+    'newest': lambda product: (product.manu_date or date.min, product.id),
+    'oldest': lambda product: (product.manu_date or date.min, product.id),
+}
+
+
+class CatalogSnapshot:
+    """The whole catalog at one catalog version, with the products sorted for every sort order."""
+
+    def __init__(self, version, updated_at, categories, products):
+        self.version = version
+        self.updated_at = updated_at
+        self.categories = tuple(categories)
+        self.product_counts = {category.id: 0 for category in self.categories}
+        for product in products:
+            self.product_counts[product.category_id] += 1
+
+        # products and their keys in ascending key order, for keyset_paginate_sorted
+        self.sorted_products = {}
+        for sort in PRODUCT_SORT_ORDERS:
+            key = _SORT_KEYS[sort]
+            ordered = tuple(sorted(products, key=key))
+            self.sorted_products[sort] = (ordered, [key(product) for product in ordered])
+
+
+class CatalogCache:
+    """
+        The catalog snapshot of this worker, rebuilt lazily when the catalog version in the database changes.
+
+        Args:
+            ttl: number of seconds a snapshot is used without checking the version in the database.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._snapshot = None
+        self._checked_at = 0.0
+        self._invalidations = 0
+        self._lock = threading.Lock()
+
+    def get(self):
+        """Returns the current catalog snapshot, rebuilding it if the catalog changed."""
+        snapshot = self._snapshot
+        if snapshot is not None and time.monotonic() - self._checked_at < self.ttl:
+            self.hits += 1
+            return snapshot
+
+        # only one thread of the worker checks the version and rebuilds, the others wait for its snapshot
+        with self._lock:
+            snapshot = self._snapshot
+            if snapshot is not None and time.monotonic() - self._checked_at < self.ttl:
+                self.hits += 1
+                return snapshot
+
+            # always read from the primary, a replica behind it would make the workers go back and forth between two versions
+            invalidations = self._invalidations
+            with primary_reads():
+                version, updated_at = catalog_version_row()
+                if snapshot is None or snapshot.version != version:
+                    self.misses += 1
+                    snapshot = self._snapshot = build_snapshot(version, updated_at)
+                else:
+                    self.hits += 1
+            # a change committed while the version was read may be missing from this snapshot,
+            # so it is only trusted for the ttl when nothing was committed in the meantime
+            if self._invalidations == invalidations:
+                self._checked_at = time.monotonic()
+            return snapshot
+
+    def invalidate(self):
+        """Makes the next get check the catalog version in the database."""
+        self._invalidations += 1
+        self._checked_at = 0.0
+
+    def stats(self):
+        """Returns the hit and miss counters and the version of the current snapshot."""
+        snapshot = self._snapshot
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'version': snapshot.version if snapshot is not None else None,
+        }
+
+
+def current_catalog_version():
+    """Returns the catalog version stored in the database."""
+    return catalog_version_row()[0]
+
+
+def catalog_version_row(version_id=CATALOG_VERSION_ID):
+    """Returns the catalog version stored in the database and when it last changed."""
+    row = db.session.execute(db.select(CatalogVersion.version, CatalogVersion.updated_at).filter_by(id=version_id)).first()
+    return (row.version, row.updated_at) if row else (0, None)
+
+
+def create_catalog_version(version_id=CATALOG_VERSION_ID):
+    """
+        Adds the catalog_version row if the database has none yet, in the current transaction.
+        Run by 'flask init-db', two of them at the same time add a single row.
+    """
+    db.session.execute(
+        text("INSERT INTO catalog_version (id, version, updated_at) VALUES (:id, 0, :now) ON CONFLICT (id) DO NOTHING"),
+        {'id': version_id, 'now': datetime.now()},
+    )
+
+
+def bump_version(version_id):
+    """Raises the version of the catalog_version row version_id in the current transaction, see bump_catalog_version."""
+    bump = (
+        update(CatalogVersion)
+        .where(CatalogVersion.id == version_id)
+        .values(version=CatalogVersion.version + 1, updated_at=datetime.now())
+    )
+    if db.session.execute(bump).rowcount == 0:
+        create_catalog_version(version_id)  ## a database made before init-db added the row
+        db.session.execute(bump)
+
+
+def bump_catalog_version():
+    """
+        Raises the catalog version in the current transaction, call it in every
+        route that changes categories, products or stock before its commit.
+    """
+    bump_version(CATALOG_VERSION_ID)
+    # this worker sees its own change on the next request once it is committed, the other workers after at most the ttl
+    db.session.info['catalog_changed'] = True
+
+
+@event.listens_for(db.session, 'after_commit')
+def _invalidate_catalog_cache(session):
+    # not before the commit: a request of this worker could rebuild the snapshot from the old rows in between
+    if session.info.pop('catalog_changed', False):
+        catalog_cache.invalidate()
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _keep_catalog_cache(session):
+    session.info.pop('catalog_changed', None)
+
+
+def build_snapshot(version, updated_at=None):
+    """Reads the catalog from the database into a CatalogSnapshot of the given version."""
+    # the version is read before the rows, so the rows are never older than the version they are labelled with
+    categories = [
+        CategoryRecord(id, cat_name)
+        for id, cat_name in db.session.execute(db.select(Category.id, Category.cat_name).order_by(Category.id))
+    ]
+    categories_by_id = {category.id: category for category in categories}
+
+    rows = db.session.execute(db.select(
+        Product.id, Product.sku, Product.product_name, Product.price, Product.description, Product.category_id,
+        Product.quantity_available, Product.manu_date, Product.product_image_path,
+    ).order_by(Product.id))
+    products = [
+        ProductRecord(
+            id=row.id, sku=row.sku, product_name=row.product_name, price=row.price, description=row.description,
+            category_id=row.category_id, category=categories_by_id[row.category_id],
+            quantity_available=row.quantity_available, manu_date=row.manu_date,
+            product_image_path=row.product_image_path,
+        )
+        for row in rows
+    ]
+    return CatalogSnapshot(version, updated_at, categories, products)
+
+
+class InvalidSort(ValueError):
+    """Raised by find_products when the sort order doesn't exist."""
+
+
+def find_products(category_name='', terms='', max_price=None, category_id=None, sort=None, after=None, before=None, per_page=None):
+    """
+        Returns a KeysetPage of the products of the storefront matching the filters.
+
+        Without filters the page comes from the catalog snapshot of this worker. With filters,
+        the category name, search terms, price and category all run in the database as one
+        joined query, with the category of each product loaded in the same query. The search
+        terms are looked up in the full-text search index and add the 'relevance' sort order,
+        which is the default when searching.
+
+        Raises:
+            InvalidSort: when the sort order doesn't exist.
+            InvalidCursor: when the after or before cursor is not valid.
+    """
+    sort = sort or ('relevance' if terms else 'category')
+
+    if not category_name and not terms and not max_price and category_id is None:
+        if sort not in PRODUCT_SORT_ORDERS:
+            raise InvalidSort(sort)
+        products, keys = catalog_cache.get().sorted_products[sort]
+        return keyset_paginate_sorted(products, keys, PRODUCT_SORT_ORDERS[sort], after=after, before=before, per_page=per_page)
+
+    products = Product.query.join(Product.category).options(contains_eager(Product.category))
+    if category_name:
+        products = products.filter(Category.cat_name.icontains(category_name, autoescape=True))
+    if category_id is not None:
+        products = products.filter(Product.category_id == category_id)
+    rank = None
+    if terms:
+        products, rank = search.search_products(products, terms)
+    if max_price:
+        products = products.filter(Product.price <= max_price)
+
+    sort_orders = dict(PRODUCT_SORT_ORDERS)
+    if rank is not None:
+        sort_orders['relevance'] = SortOrder([rank, Product.id], False)
+    if sort not in sort_orders:
+        raise InvalidSort(sort)
+    return keyset_paginate(products, sort_orders[sort], after=after, before=before, per_page=per_page)
+
+
+catalog_cache = CatalogCache(ttl=app.config['CATALOG_CACHE_TTL'])
@@ -0,0 +1,154 @@
+"""
+    A module that contains the checkout of a cart, used by the order now button.
+
+    The whole checkout is one database transaction: the stock of every cart line is
+    taken with a guarded 'UPDATE product ... WHERE quantity_available >= n', so two
+    checkouts can never both take the last items of a product, then the transaction
+    and its orders are inserted and the cart is emptied. If any line is out of stock
+    nothing is saved and every line that failed is reported. If the cart lines were
+    already deleted, by the same cart ordered twice at once, nothing is saved either.
+"""
+
+from collections import namedtuple
+from datetime import datetime
+
+from sqlalchemy import update, insert, delete
+
+from models import db, Product, Cart, Order, Transaction
+from catalog import bump_catalog_version
+from sales import record_sales
+
+
+# a line of a cart with the product details the checkout needs, plain values that can be passed between threads
+CartLine = namedtuple('CartLine', ['id', 'product_id', 'product_name', 'price', 'quantity', 'category_id'])
+
+# a cart line that could not be ordered and the quantity that was left of its product
+StockFailure = namedtuple('StockFailure', ['product_id', 'product_name', 'quantity_wanted', 'quantity_available'])
+
+
+class OutOfStock(Exception):
+    """Raised when some lines of a cart are out of stock, with a StockFailure for each of them."""
+
+    def __init__(self, failures):
+        super().__init__(failures)
+        self.failures = failures
+
+    def messages(self):
+        """Returns a flash message for every line that failed."""
+        return [
+            'Product, {} is out of stock, only {} left'.format(failure.product_name, failure.quantity_available)
+            if failure.quantity_available else 'Product, {} is out of stock'.format(failure.product_name)
+            for failure in self.failures
+        ]
+
+
+class CartChanged(Exception):
+    """Raised when lines of the cart were ordered or removed by another request while it was checked out."""
+
+
+def cart_lines(carts):
+    """Returns the CartLine of each Cart row, the rows must have their product loaded."""
+    return [
+        CartLine(cart.id, cart.product_id, cart.product.product_name, cart.product.price, cart.quantity_added_to_cart, cart.product.category_id)
+        for cart in carts
+    ]
+
+
+def take_stock(product_id, quantity):
+    """
+        Decrements the stock of a product only if there is enough of it left,
+        returns False without changing anything when there isn't.
+    """
+    result = db.session.execute(
+        update(Product)
+        .where(Product.id == product_id, Product.quantity_available >= quantity)
+        .values(quantity_available=Product.quantity_available - quantity)
+        .execution_options(synchronize_session=False)
+    )
+    return result.rowcount == 1
+
+
+def give_back_stock(product_id, quantity):
+    """Adds stock taken by take_stock back to a product, when the rest of an order failed."""
+    db.session.execute(
+        update(Product)
+        .where(Product.id == product_id)
+        .values(quantity_available=Product.quantity_available + quantity)
+        .execution_options(synchronize_session=False)
+    )
+
+
+def save_order(user_id, lines):
+    """
+        Inserts the transaction and the orders of cart lines whose stock was already taken
+        and deletes the cart lines, in the current database transaction. Returns the transaction.
+
+        Raises:
+            CartChanged: when some of the lines were already deleted, the caller must roll back.
+    """
+    # the totals are saved with the rows, so the history page never adds them up again
+    now = datetime.now()
+    transaction = Transaction(
+        user_id=user_id, date_time=now,
+        price=sum(line.price * line.quantity for line in lines), item_count=sum(line.quantity for line in lines),
+    )
+    db.session.add(transaction)
+    db.session.flush()  ## generates the transaction id for its orders
+
+    # all orders are inserted with one executemany and the cart is emptied with one delete
+    db.session.execute(insert(Order), [
+        dict(user_id=user_id, product_id=line.product_id, quantity=line.quantity, transaction_id=transaction.id,
+             price=line.price, subtotal=line.price * line.quantity)
+        for line in lines
+    ])
+    # a cart submitted twice at once has both checkouts read the same lines and take their stock
+    # (the database has enough for both), the second one finds the lines deleted by the first
+    result = db.session.execute(
+        delete(Cart).where(Cart.id.in_([line.id for line in lines])).execution_options(synchronize_session=False)
+    )
+    if result.rowcount != len(lines):
+        raise CartChanged([line.id for line in lines])
+    record_sales(now.date(), lines)  ## the daily sales of the admin dashboard
+    return transaction
+
+
+def place_order(user_id, lines):
+    """
+        Checks out the cart lines of a user as one database transaction and returns the new Transaction.
+
+        Args:
+            user_id: the ID of the user ordering.
+            lines: the CartLine of every line of the cart.
+
+        Raises:
+            OutOfStock: when any line is out of stock, after rolling everything back.
+            CartChanged: when the lines were ordered by another request, after rolling everything back.
+    """
+    # the stock is taken in product id order, so concurrent checkouts lock the rows in the same order
+    lines = sorted(lines, key=lambda line: line.product_id)
+    try:
+        failed = [line for line in lines if not take_stock(line.product_id, line.quantity)]
+        if failed:
+            db.session.rollback()
+            raise OutOfStock(stock_failures(failed))
+
+        transaction = save_order(user_id, lines)
+        bump_catalog_version()  ## the stock of the ordered products changed, so the cached catalog is rebuilt
+        db.session.commit()
+        return transaction
+    except OutOfStock:
+        raise
+    except Exception:
+        db.session.rollback()
+        raise
+
+
+def stock_failures(lines):
+    """Returns a StockFailure for each CartLine, with the stock that is left now."""
+    left = dict(db.session.execute(
+        db.select(Product.id, Product.quantity_available).where(Product.id.in_([line.product_id for line in lines]))
+    ).all())
+    return [
+        StockFailure(line.product_id, line.product_name, line.quantity, left.get(line.product_id, 0))
+        for line in lines
+    ]
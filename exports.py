@@ -0,0 +1,183 @@
+"""
+    A module that contains the CSV and JSON Lines exports of the orders, transactions and inventory.
+
+    The exports are generators: the rows are read from the database with a server-side cursor
+    (stream_results) EXPORT_BATCH_SIZE at a time (yield_per) and every batch is written out as
+    soon as it is read. The admin export pages send it as a streamed response and
+    'flask export' writes it to a file, so a multi-million row export starts right away and
+    only holds one batch in memory. The queries read the tables in the order of an index,
+    so the database doesn't sort the whole result before sending the first row either.
+"""
+
+import csv
+import io
+import json
+from collections import namedtuple
+from datetime import date, datetime
+
+import click
+
+from config import app
+from models import db, User, Category, Product, Order, Transaction
+
+
+EXPORT_FORMATS = ('csv', 'jsonl')
+
+# the content type of each export format
+MIMETYPES = {'csv': 'text/csv', 'jsonl': 'application/x-ndjson'}
+
+# the filters of the order and transaction exports, any of them can be None
+ExportFilters = namedtuple('ExportFilters', ['start', 'end', 'user_id'])
+
+
+def _filtered(statement, filters):
+    if filters.start is not None:
+        statement = statement.where(Transaction.date_time >= filters.start)
+    if filters.end is not None:
+        statement = statement.where(Transaction.date_time <= filters.end)
+    if filters.user_id is not None:
+        statement = statement.where(Transaction.user_id == filters.user_id)
+    return statement
+
+
+def orders_query(filters):
+    """The order lines of the transactions matching the filters, by transaction then line."""
+    # ordered by order.transaction_id so SQLite reads the lines in the order of ix_order_transaction_id
+    return _filtered(
+        db.select(
+            Order.transaction_id, Transaction.date_time, Transaction.user_id, User.username, Order.id.label('order_id'),
+            Order.product_id, Product.sku, Product.product_name, Order.quantity, Order.price, Order.subtotal,
+        )
+        .join(Transaction, Transaction.id == Order.transaction_id)
+        .join(User, User.id == Transaction.user_id)
+        .outerjoin(Product, Product.id == Order.product_id)  ## the lines of the deleted products are exported without their name
+        .order_by(Order.transaction_id, Order.id),
+        filters,
+    )
+
+
+def transactions_query(filters):
+    """The transactions matching the filters with their item count and total, by id."""
+    return _filtered(
+        db.select(
+            Transaction.id, Transaction.date_time, Transaction.user_id, User.username,
+            Transaction.item_count, Transaction.price.label('total'),
+        )
+        .join(User, User.id == Transaction.user_id)
+        .order_by(Transaction.id),
+        filters,
+    )
+
+
+def inventory_query():
+    """Every product with its category and the quantity in stock, by id."""
+    return (
+        db.select(
+            Product.id, Product.sku, Product.product_name, Product.category_id, Category.cat_name.label('category'),
+            Product.price, Product.quantity_available, Product.manu_date,
+        )
+        .join(Category, Category.id == Product.category_id)
+        .order_by(Product.id)
+    )
+
+
+def stream_export(statement, format):
+    """
+        Runs an export query and yields the text of the file batch by batch, the CSV header
+        (or nothing for JSON Lines) first, before the query returns its first row.
+    """
+    if format not in EXPORT_FORMATS:
+        raise ValueError('unknown export format {}'.format(format))
+    columns = [column.name for column in statement.selected_columns]
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if format == 'csv':
+        writer.writerow(columns)
+        yield _drain(buffer)
+
+    result = db.session.execute(statement.execution_options(stream_results=True, yield_per=app.config['EXPORT_BATCH_SIZE']))
+    try:
+        for rows in result.partitions():
+            for row in rows:
+                if format == 'csv':
+                    writer.writerow(row)
+                else:
+                    buffer.write(json.dumps(dict(zip(columns, row)), default=_json_value))
+                    buffer.write('\n')
+            yield _drain(buffer)
+    finally:
+        result.close()  ## an export stopped halfway (the download was cancelled) closes its cursor
+
+
+def _drain(buffer):
+    text = buffer.getvalue()
+    buffer.seek(0)
+    buffer.truncate()
+    return text
+
+
+def _json_value(value):
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    raise TypeError('{} is not JSON serializable'.format(type(value).__name__))
+
+
+def export_filename(name, filters, format):
+    """Returns the file name of an export, e.g. orders-2024-01-01-2024-01-31.csv."""
+    parts = [name]
+    if filters is not None:
+        parts += [filters.start.isoformat() if filters.start else 'start', filters.end.isoformat() if filters.end else date.today().isoformat()]
+        if filters.user_id is not None:
+            parts.append('user{}'.format(filters.user_id))
+    return '{}.{}'.format('-'.join(parts), format)
+
+
+##################################### flask export COMMANDS ##########################################################
+@app.cli.group('export')
+def export_cli():
+    """Exports of the orders, transactions and inventory for accounting."""
+
+
+def _filters(start, end, username):
+    user_id = None
+    if username is not None:
+        user_id = db.session.execute(db.select(User.id).filter_by(username=username)).scalar()
+        if user_id is None:
+            raise click.ClickException('no user named {}'.format(username))
+    return ExportFilters(start.date() if start else None, end.date() if end else None, user_id)
+
+
+def _write(statement, format, output):
+    for chunk in stream_export(statement, format):
+        output.write(chunk)
+    output.flush()
+
+
+@export_cli.command('orders')
+@click.option('--start', type=click.DateTime(['%Y-%m-%d']), default=None, help='first day of the transactions, YYYY-MM-DD')
+@click.option('--end', type=click.DateTime(['%Y-%m-%d']), default=None, help='last day of the transactions, YYYY-MM-DD')
+@click.option('--user', 'username', default=None, help='only the transactions of this username')
+@click.option('--format', 'format', type=click.Choice(EXPORT_FORMATS), default='csv')
+@click.option('--output', '-o', type=click.File('w', encoding='utf-8'), default='-', help='the file to write, the standard output by default')
+def export_orders(start, end, username, format, output):
+    """Exports the order lines, one row per product of every transaction."""
+    _write(orders_query(_filters(start, end, username)), format, output)
+
+
+@export_cli.command('transactions')
+@click.option('--start', type=click.DateTime(['%Y-%m-%d']), default=None, help='first day of the transactions, YYYY-MM-DD')
+@click.option('--end', type=click.DateTime(['%Y-%m-%d']), default=None, help='last day of the transactions, YYYY-MM-DD')
+@click.option('--user', 'username', default=None, help='only the transactions of this username')
+@click.option('--format', 'format', type=click.Choice(EXPORT_FORMATS), default='csv')
+@click.option('--output', '-o', type=click.File('w', encoding='utf-8'), default='-', help='the file to write, the standard output by default')
+def export_transactions(start, end, username, format, output):
+    """Exports the transactions, one row per checkout."""
+    _write(transactions_query(_filters(start, end, username)), format, output)
+
+
+@export_cli.command('inventory')
+@click.option('--format', 'format', type=click.Choice(EXPORT_FORMATS), default='csv')
+@click.option('--output', '-o', type=click.File('w', encoding='utf-8'), default='-', help='the file to write, the standard output by default')
+def export_inventory(format, output):
+    """Exports the current stock of every product."""
+    _write(inventory_query(), format, output)
@@ -0,0 +1,267 @@
+"""
+    A module that contains the flash-sale mode of the checkout.
+
+    During a promotion hundreds of users order the same product at once, and every
+    checkout would wait on the lock of that product's row. For the products listed in
+    FLASH_SALE_PRODUCT_IDS, the checkouts of a worker are instead put in a bounded
+    queue of that product. A background thread takes the waiting checkouts in batches,
+    hands out the stock in the order they arrived with a single stock update for the
+    whole batch and saves all their orders in one commit. Once the product is sold out,
+    new checkouts are rejected straight away until the catalog changes (e.g. a restock).
+
+    The queues and their threads are per process: every gunicorn worker runs its own queue
+    of the product and the workers compete for its row, so with 4 workers each batch holds
+    about a quarter of the checkouts and the row is locked by 4 batches instead of one.
+"""
+
+import queue
+import threading
+
+from config import app
+from models import db, Product
+from catalog import bump_catalog_version, catalog_cache, current_catalog_version
+from replicas import stick_to_primary
+from checkout import OutOfStock, CartChanged, StockFailure, take_stock, give_back_stock, save_order, stock_failures, place_order
+
+
+class FlashSaleBusy(Exception):
+    """Raised when the queue of a flash-sale product is full or the checkout waited too long."""
+
+
+# the states of a PendingCheckout, a checkout is cancelled when the user stopped waiting before its batch started
+_QUEUED, _PROCESSING, _CANCELLED = 'queued', 'processing', 'cancelled'
+
+
+class PendingCheckout:
+    """A checkout of a user waiting for its turn in the queue of a flash-sale product."""
+
+    def __init__(self, user_id, lines, product_id):
+        self.user_id = user_id
+        self.sale_line = next(line for line in lines if line.product_id == product_id)
+        self.other_lines = sorted((line for line in lines if line.product_id != product_id), key=lambda line: line.product_id)
+        self.lines = lines
+        self.transaction_id = None
+        self.error = None
+        self.done = threading.Event()
+        self._state = _QUEUED
+        self._lock = threading.Lock()
+
+    def claim(self):
+        """Called by the batch thread, returns False if the user stopped waiting for this checkout."""
+        with self._lock:
+            if self._state == _CANCELLED:
+                return False
+            self._state = _PROCESSING
+            return True
+
+    def cancel(self):
+        """Called when the user stops waiting, returns False if the checkout is already being processed."""
+        with self._lock:
+            if self._state == _PROCESSING:
+                return False
+            self._state = _CANCELLED
+            return True
+
+    def finish(self, transaction_id=None, error=None):
+        self.transaction_id = transaction_id
+        self.error = error
+        self.done.set()
+
+
+class FlashSaleQueue:
+    """
+        The admission queue of one flash-sale product in this worker.
+
+        Args:
+            product_id: the ID of the flash-sale product.
+            maxsize: the number of checkouts that can wait in the queue, more are rejected.
+            batch_size: the maximum number of checkouts saved in one commit.
+            batch_wait: seconds the thread waits for more checkouts to fill a batch.
+    """
+
+    def __init__(self, product_id, maxsize, batch_size, batch_wait):
+        self.product_id = product_id
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.sold_out_version = None
+        self._queue = queue.Queue(maxsize)
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, pending):
+        """Puts a checkout in the queue, or rejects it right away if the product is sold out or the queue is full."""
+        if self.sold_out_version is not None and self.sold_out_version == catalog_cache.get().version:
+            raise OutOfStock([StockFailure(self.product_id, pending.sale_line.product_name, pending.sale_line.quantity, 0)])
+        self._start()
+        try:
+            self._queue.put_nowait(pending)
+        except queue.Full:
+            raise FlashSaleBusy(self.product_id)
+
+    def _start(self):
+        # the thread is started by the first checkout, so it runs in the gunicorn worker and not in the master process
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='flash-sale-{}'.format(self.product_id), daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            # waits a little for more checkouts, so a burst of them is saved in one commit
+            try:
+                while len(batch) < self.batch_size:
+                    batch.append(self._queue.get(timeout=self.batch_wait))
+            except queue.Empty:
+                pass
+
+            batch = [pending for pending in batch if pending.claim()]
+            if not batch:
+                continue
+            with app.app_context():
+                try:
+                    self._process(batch)
+                except Exception:
+                    db.session.rollback()
+                    app.logger.exception('flash sale batch of product %s failed', self.product_id)
+                    for pending in batch:
+                        if not pending.done.is_set():
+                            pending.finish(error=FlashSaleBusy(self.product_id))
+
+    def _process(self, batch):
+        """Saves the orders of a batch of checkouts in one database transaction."""
+        allocated, stock_left = self._allocate(batch)
+
+        # the checkouts that got the product take the stock of the other products in their cart,
+        # a checkout that can't get one of them gives its flash-sale items back to the batch
+        saved, given_back, rejected, changed = [], 0, [], []
+        for pending, got_it in zip(batch, allocated):
+            if not got_it:
+                rejected.append((pending, [pending.sale_line]))
+                continue
+            taken, failed = [], []
+            for line in pending.other_lines:
+                (taken if take_stock(line.product_id, line.quantity) else failed).append(line)
+            if failed:
+                for line in taken:
+                    give_back_stock(line.product_id, line.quantity)
+                given_back += pending.sale_line.quantity
+                rejected.append((pending, failed))
+                continue
+            # a cart ordered twice is only undone up to its savepoint, the rest of the batch is saved
+            try:
+                with db.session.begin_nested():
+                    saved.append((pending, save_order(pending.user_id, pending.lines).id))
+            except CartChanged as error:
+                for line in taken:
+                    give_back_stock(line.product_id, line.quantity)
+                given_back += pending.sale_line.quantity
+                changed.append((pending, error))
+
+        if given_back:
+            give_back_stock(self.product_id, given_back)
+        # the stock only moved if an order was saved: a sold-out batch, or one that gave all its stock
+        # back, leaves the catalog as it was and must not make every worker rebuild its snapshot
+        if saved:
+            bump_catalog_version()
+        db.session.commit()
+
+        # sold out, the next checkouts of this worker are rejected without waiting until the catalog changes again
+        if stock_left == 0 and not given_back:
+            self.sold_out_version = current_catalog_version()
+
+        for pending, transaction_id in saved:
+            pending.finish(transaction_id=transaction_id)
+        for pending, lines in rejected:
+            pending.finish(error=OutOfStock(stock_failures(lines)))
+        for pending, error in changed:
+            pending.finish(error=error)
+
+    def _allocate(self, batch):
+        """
+            Takes the stock of the flash-sale product for the batch with one update, handing it out
+            in the order the checkouts arrived. Returns whether each checkout got the product and
+            the stock that is left.
+        """
+        wanted = sum(pending.sale_line.quantity for pending in batch)
+        if take_stock(self.product_id, wanted):
+            return [True] * len(batch), None
+
+        # not enough for everybody, the stock is read and shared out first come first served,
+        # if another worker took some in between the update fails and we try again
+        while True:
+            stock = db.session.execute(db.select(Product.quantity_available).filter_by(id=self.product_id)).scalar() or 0
+            allocated, remaining = [], stock
+            for pending in batch:
+                got_it = pending.sale_line.quantity <= remaining
+                remaining -= pending.sale_line.quantity if got_it else 0
+                allocated.append(got_it)
+            if stock - remaining == 0 or take_stock(self.product_id, stock - remaining):
+                return allocated, remaining
+
+
+_queues = {}
+_queues_lock = threading.Lock()
+
+
+def flash_sale_product(lines):
+    """Returns the ID of the flash-sale product in the cart lines, or None if there isn't one."""
+    product_ids = sorted(line.product_id for line in lines if line.product_id in app.config['FLASH_SALE_PRODUCT_IDS'])
+    return product_ids[0] if product_ids else None
+
+
+def get_queue(product_id):
+    """Returns the queue of a flash-sale product in this worker, making it the first time."""
+    with _queues_lock:
+        if product_id not in _queues:
+            _queues[product_id] = FlashSaleQueue(
+                product_id,
+                maxsize=app.config['FLASH_SALE_QUEUE_SIZE'],
+                batch_size=app.config['FLASH_SALE_BATCH_SIZE'],
+                batch_wait=app.config['FLASH_SALE_BATCH_WAIT'],
+            )
+        return _queues[product_id]
+
+
+def place_flash_sale_order(user_id, lines, product_id):
+    """
+        Checks out a cart with a flash-sale product through the queue of the product and
+        waits for its batch to be saved. Returns the ID of the new transaction.
+
+        Raises:
+            OutOfStock: when the flash-sale product or another line of the cart is out of stock.
+            CartChanged: when the cart lines were ordered by another request.
+            FlashSaleBusy: when the queue is full or the checkout waited longer than FLASH_SALE_TIMEOUT.
+    """
+    pending = PendingCheckout(user_id, lines, product_id)
+    get_queue(product_id).submit(pending)
+
+    # the request gives its database connection back to the pool while it waits,
+    # otherwise the waiting requests hold all the connections the batch thread needs
+    db.session.close()
+
+    if not pending.done.wait(app.config['FLASH_SALE_TIMEOUT']):
+        if pending.cancel():
+            raise FlashSaleBusy(product_id)
+        pending.done.wait()  ## the batch already started, its result comes soon
+
+    if pending.error is not None:
+        raise pending.error
+    # the order was committed by the thread of the queue, out of this request, so the request
+    # sticks to the primary itself and the cart page it redirects to doesn't read a replica behind
+    stick_to_primary()
+    return pending.transaction_id
+
+
+def place_cart_order(user_id, lines):
+    """
+        Checks out the cart lines of a user, through the queue of its flash-sale product when the
+        cart has one and with checkout.place_order otherwise. Returns the ID of the new transaction.
+
+        Raises:
+            OutOfStock, CartChanged, FlashSaleBusy: see place_order and place_flash_sale_order.
+    """
+    product_id = flash_sale_product(lines)
+    if product_id is not None:
+        return place_flash_sale_order(user_id, lines, product_id)
+    return place_order(user_id, lines).id
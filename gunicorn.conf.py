@@ -0,0 +1,23 @@
+"""
+    The gunicorn settings of the app, every one can be changed with its environment variable:
+
+        gunicorn -c gunicorn.conf.py
+"""
+
+from os import getenv
+
+
+wsgi_app = 'wsgi:application'
+bind = getenv('GUNICORN_BIND', '0.0.0.0:8000')
+workers = int(getenv('GUNICORN_WORKERS', 4))
+threads = int(getenv('GUNICORN_THREADS', 4))
+timeout = int(getenv('GUNICORN_TIMEOUT', 30))
+
+# the app is imported and warmed up once in the master, then the workers are forked from it (see wsgi.py)
+preload_app = getenv('GUNICORN_PRELOAD', 'true').lower() in ('1', 'true', 'yes')
+
+
+def on_starting(server):
+    # the counters of /metrics start from zero with the new workers, see metrics.py
+    from metrics import clear_metrics
+    clear_metrics()
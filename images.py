@@ -0,0 +1,246 @@
+"""
+    A module that contains the storage of the product images.
+
+    An uploaded image is saved under the sha256 hash of its content, e.g.
+    static/images/3f/3f2a...c9.jpg, the hash being computed while the upload is
+    streamed to disk. Uploading the same picture twice stores it once: every file
+    has a row in the image_blob table counting the products that use it. The routes
+    call acquire_image when a product gets an image and release_image when it loses
+    it (edited, deleted, or deleted with its category), and the file is removed from
+    the disk once the last product using it is gone and that change is committed.
+    A new upload is only moved to its place once its row is committed, the upload of a
+    request that rolls back is removed with its temporary file.
+"""
+
+import hashlib
+import os
+import shutil
+import tempfile
+from collections import Counter
+from datetime import datetime
+
+import click
+from sqlalchemy import event, update, delete
+from sqlalchemy.exc import IntegrityError
+
+from config import app
+from models import db, Product, ImageBlob, ImageVariant
+from catalog import bump_catalog_version
+import thumbnails
+
+
+CHUNK_SIZE = 64 * 1024
+
+
+class UnsupportedImage(ValueError):
+    """Raised by save_image when the file extension is not one of UPLOAD_EXTENSIONS."""
+
+
+def image_extension(filename):
+    """Returns the lower case extension of an uploaded file name, raises UnsupportedImage if it is not allowed."""
+    extension = os.path.splitext(filename or '')[1].lower()
+    if extension not in app.config['UPLOAD_EXTENSIONS']:
+        raise UnsupportedImage(extension)
+    return extension
+
+
+def image_path(sha256, extension):
+    """Returns the path of the file of an image, in a sub folder named after the first 2 characters of its hash."""
+    return os.path.join(app.config['UPLOAD_PATH'], sha256[:2], sha256 + extension)
+
+
+def save_image(image):
+    """
+        Streams an uploaded image to a temporary file and takes a reference to it for a
+        product, in the current database transaction. The file is moved under the hash
+        of its content when the transaction is committed, and removed if it isn't.
+        Returns the path to save in product_image_path.
+
+        Args:
+            image: the werkzeug FileStorage of the upload.
+
+        Raises:
+            UnsupportedImage: when the file extension is not one of UPLOAD_EXTENSIONS.
+    """
+    extension = image_extension(image.filename)
+    upload_path = app.config['UPLOAD_PATH']
+    os.makedirs(upload_path, exist_ok=True)
+
+    # the upload is hashed chunk by chunk while it is written to a temporary file,
+    # so it is never read twice nor held whole in memory
+    sha256 = hashlib.sha256()
+    size = 0
+    fd, temp_path = tempfile.mkstemp(dir=upload_path, prefix='.upload-')
+    try:
+        with os.fdopen(fd, 'wb') as temp_file:
+            while True:
+                chunk = image.stream.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                sha256.update(chunk)
+                temp_file.write(chunk)
+                size += len(chunk)
+
+        digest = sha256.hexdigest()
+        path = image_path(digest, extension)
+        if acquire_image(digest, path, size):
+            thumbnails.queue_variants(digest, path)  ## a new picture, its resized copies are made after the commit
+        db.session.info.setdefault('images_to_place', []).append((temp_path, path))
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return path
+
+
+def file_sha256(path):
+    """Returns the sha256 hash of the content of a file on the disk."""
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(CHUNK_SIZE), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def acquire_image(sha256, path, size, count=1):
+    """Adds references to an image file, making its image_blob row the first time. Returns True if the row is new."""
+    result = db.session.execute(
+        update(ImageBlob).where(ImageBlob.sha256 == sha256).values(ref_count=ImageBlob.ref_count + count)
+    )
+    if result.rowcount:
+        return False
+    try:
+        with db.session.begin_nested():
+            db.session.add(ImageBlob(sha256=sha256, path=path, size=size, ref_count=count, created_at=datetime.now()))
+        return True
+    except IntegrityError:
+        # another request stored the same picture in between, its row is used instead
+        db.session.execute(
+            update(ImageBlob).where(ImageBlob.sha256 == sha256).values(ref_count=ImageBlob.ref_count + count)
+        )
+        return False
+
+
+def release_image(path):
+    """Drops the reference of a product to its image, see release_images."""
+    release_images([path])
+
+
+def release_images(paths):
+    """
+        Drops one reference to the image file of each path, in the current database transaction.
+        The files that are not used anymore are removed from the disk after the commit.
+        Paths without an image_blob row (images uploaded before the content-addressed
+        storage, see 'flask images adopt') are left alone.
+    """
+    for path, count in Counter(path for path in paths if path).items():
+        db.session.execute(update(ImageBlob).where(ImageBlob.path == path).values(ref_count=ImageBlob.ref_count - count))
+        blob = db.session.execute(db.select(ImageBlob.sha256, ImageBlob.ref_count).where(ImageBlob.path == path)).first()
+        if blob is None or blob.ref_count > 0:
+            continue
+        variant_paths = thumbnails.remove_variants(blob.sha256)
+        db.session.execute(delete(ImageBlob).where(ImageBlob.sha256 == blob.sha256, ImageBlob.ref_count <= 0))
+        db.session.info.setdefault('images_to_remove', set()).update([path, *variant_paths])
+
+
+# before the other after_commit hooks, the resized copies of thumbnails.py are made from the placed file
+@event.listens_for(db.session, 'after_commit', insert=True)
+def _place_uploaded_images(session):
+    for temp_path, path in session.info.pop('images_to_place', []):
+        if os.path.exists(path):
+            os.remove(temp_path)  ## the same picture is already stored
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(temp_path, path)
+
+
+@event.listens_for(db.session, 'after_transaction_end')
+def _remove_unplaced_images(session, transaction):
+    # the transaction ended without a commit (rolled back, or the session of the request closed)
+    if transaction.parent is not None:
+        return
+    for temp_path, path in session.info.pop('images_to_place', []):
+        try:
+            os.remove(temp_path)
+        except FileNotFoundError:
+            pass
+
+
+@event.listens_for(db.session, 'after_commit')
+def _remove_released_images(session):
+    paths = session.info.pop('images_to_remove', None)
+    if not paths:
+        return
+    # a picture uploaded again since it was released has a new row, its file must stay.
+    # the session can't run queries after its commit, so this one has its own connection
+    with session.get_bind().connect() as connection:
+        still_used = set(connection.execute(db.select(ImageBlob.path).where(ImageBlob.path.in_(paths))).scalars())
+        still_used.update(connection.execute(db.select(ImageVariant.path).where(ImageVariant.path.in_(paths))).scalars())
+    for path in paths - still_used:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _keep_released_images(session):
+    session.info.pop('images_to_remove', None)
+
+
+##################################### flask images COMMANDS ##########################################################
+@app.cli.group('images')
+def images_cli():
+    """Maintenance of the content-addressed product images."""
+
+
+@images_cli.command('adopt')
+def adopt_images():
+    """
+        Moves the images uploaded before the content-addressed storage under the hash
+        of their content, so identical files are stored once and counted like new uploads.
+    """
+    rows = db.session.execute(
+        db.select(Product.id, Product.product_image_path)
+        .outerjoin(ImageBlob, ImageBlob.path == Product.product_image_path)
+        .where(ImageBlob.sha256.is_(None), Product.product_image_path != '')  ## imported products have no image yet
+    ).all()
+    old_paths = set()
+    for product_id, old_path in rows:
+        try:
+            extension = image_extension(old_path)
+            sha256 = file_sha256(old_path)
+        except (UnsupportedImage, OSError) as error:
+            click.echo('product {}: skipped {} ({})'.format(product_id, old_path, error))
+            continue
+        path = image_path(sha256, extension)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            shutil.copyfile(old_path, path)
+        acquire_image(sha256, path, os.path.getsize(path))
+        db.session.execute(update(Product).where(Product.id == product_id).values(product_image_path=path))
+        old_paths.add(old_path)
+    if old_paths:
+        bump_catalog_version()  ## the cached catalog has the old paths
+    db.session.commit()
+
+    for old_path in old_paths:
+        os.remove(old_path)
+    click.echo('adopted {} images of {} products'.format(len(old_paths), len(rows)))
+
+
+@images_cli.command('variants')
+def backfill_variants():
+    """Makes the missing resized copies of every stored image, e.g. for the images stored before they existed."""
+    if thumbnails.Image is None:
+        raise click.ClickException('Pillow is not installed, see requirements.txt')
+    blobs = db.session.execute(db.select(ImageBlob.sha256, ImageBlob.path).order_by(ImageBlob.created_at)).all()
+    made = 0
+    for number, (sha256, path) in enumerate(blobs, start=1):
+        made += thumbnails.make_variants(sha256, path)
+        db.session.commit()  ## one image at a time, so an interrupted backfill keeps what it made
+        click.echo('{}/{} {}'.format(number, len(blobs), path))
+    if made:
+        thumbnails.bump_variants_version()  ## the storefront picks up the new srcset
+        db.session.commit()
+    click.echo('made {} variants of {} images'.format(made, len(blobs)))
@@ -0,0 +1,364 @@
+"""
+    A module that contains the validation of the product fields and the bulk import of products.
+
+    The add and edit product forms and the bulk import validate the fields of a product with
+    validate_product_fields, so a product is accepted the same way wherever it comes from.
+
+    The bulk import (the admin import page and 'flask products import') streams the rows of a
+    CSV, JSON Lines or JSON array file, validates each of them and saves them in batches of
+    IMPORT_BATCH_SIZE rows: one query finds the products of the batch that already exist by
+    their SKU (or name), one executemany inserts the new ones and one updates the others, and
+    the batch is committed. Only one batch is in memory at a time, whatever the size of the file.
+
+    Columns of a row: sku, product_name, price, quantity_available, manu_date (YYYY-MM-DD),
+    category_id or category (the category name) and an optional description. The sku (when
+    matching by name) and the description of an existing product are only changed when the file
+    has their column, an empty value clears them. Imported products have no image yet, it is
+    added with the edit product form.
+"""
+
+import codecs
+import csv
+import io
+import json
+from collections import namedtuple
+from datetime import datetime, date
+
+import click
+from sqlalchemy import insert, update
+from sqlalchemy.exc import IntegrityError
+
+from config import app
+from models import db, Product, Category
+from catalog import bump_catalog_version
+import search
+
+
+# how many errors the import report keeps the details of, the others are only counted
+MAX_REPORTED_ERRORS = 1000
+
+IMPORT_KEYS = ('sku', 'name')
+IMPORT_FORMATS = ('csv', 'jsonl', 'json')
+
+# the columns a row may leave out, with the value of a new product without them
+OPTIONAL_COLUMNS = {'sku': None, 'description': None}
+
+
+class InvalidProduct(ValueError):
+    """Raised by validate_product_fields with the message to show for the invalid field."""
+
+
+def validate_product_fields(name, price, quantity_available, manu_date):
+    """
+        Validates the fields of a product typed in a form or read from an import file
+        and returns them converted as (name, price, quantity_available, manu_date).
+
+        Raises:
+            InvalidProduct: with the message to show, the same as the product forms have always shown
+                for the values a form can send.
+    """
+    if not name or not price or not quantity_available or not manu_date:
+        raise InvalidProduct('Please fill out all fields')
+    # true and false of a JSON file are not numbers, and a quantity of 2.7 is not truncated to 2
+    if isinstance(price, bool) or isinstance(quantity_available, bool):
+        raise InvalidProduct('Price and quantity must be numbers')
+    if isinstance(quantity_available, float) and not quantity_available.is_integer():
+        raise InvalidProduct('Quantity must be a whole number')
+    try:
+        price = float(price)
+        quantity_available = int(quantity_available)
+    except (TypeError, ValueError):
+        raise InvalidProduct('Price and quantity must be numbers')
+    try:
+        manu_date = datetime.strptime(manu_date, '%Y-%m-%d').date() if isinstance(manu_date, str) else manu_date
+    except ValueError:
+        raise InvalidProduct('Manufacture date must be a date (YYYY-MM-DD)')
+    if not isinstance(manu_date, date):
+        raise InvalidProduct('Manufacture date must be a date (YYYY-MM-DD)')
+
+    if quantity_available <= 0:
+        raise InvalidProduct('Quantity must be greater than 0')
+    if manu_date > date.today():
+        raise InvalidProduct('Manufacture date cannot be in the future')
+    return name, price, quantity_available, manu_date
+
+
+##################################### READING THE IMPORT FILES ##########################################################
+def read_rows(stream, format):
+    """
+        Yields the rows of an import file one at a time as dicts.
+
+        Args:
+            stream: the binary file object of the upload or of the file on the disk.
+            format: 'csv', 'jsonl' (one JSON object per line) or 'json' (an array of objects).
+    """
+    if format == 'csv':
+        # utf-8-sig skips the byte order mark spreadsheet programs put at the start of the file
+        yield from csv.DictReader(io.TextIOWrapper(stream, encoding='utf-8-sig', newline=''))
+    elif format == 'jsonl':
+        for line in io.TextIOWrapper(stream, encoding='utf-8-sig'):
+            if line.strip():
+                yield _json_row(line)
+    elif format == 'json':
+        yield from _read_json_array(stream)
+    else:
+        raise ValueError('unknown import format {}'.format(format))
+
+
+def _json_row(text):
+    try:
+        return json.loads(text)
+    except ValueError:
+        return {'_error': 'Invalid JSON'}
+
+
+def _read_json_array(stream, chunk_size=64 * 1024):
+    # the objects of the array are decoded one by one from a small buffer, so the whole array is never loaded
+    decoder = json.JSONDecoder()
+    reader = codecs.getincrementaldecoder('utf-8-sig')()
+    buffer, position, started, finished = '', 0, False, False
+    while True:
+        chunk = stream.read(chunk_size)
+        buffer = buffer[position:] + reader.decode(chunk, final=not chunk)
+        position = 0
+        # the file must start with the opening bracket, checked before the first object is read
+        # so a file that is not an array stops the import before any of it is saved
+        if not started:
+            while position < len(buffer) and buffer[position].isspace():
+                position += 1
+            if position < len(buffer):
+                if buffer[position] != '[':
+                    raise ValueError('the JSON file must be an array of products')
+                started = True
+                position += 1
+        while started:
+            # skips the whitespace and the commas between the objects
+            while position < len(buffer) and (buffer[position].isspace() or buffer[position] == ','):
+                position += 1
+            if position < len(buffer) and buffer[position] == ']':
+                finished = True
+                break
+            if position >= len(buffer):
+                break
+            try:
+                row, end = decoder.raw_decode(buffer, position)
+            except ValueError:
+                if not chunk:
+                    raise ValueError('invalid JSON array')
+                break  ## the object continues in the next chunk
+            position = end
+            yield row if isinstance(row, dict) else {'_error': 'Invalid JSON'}
+        if finished or not chunk:
+            if not started:
+                raise ValueError('the JSON file must be an array of products')
+            if not finished:
+                raise ValueError('invalid JSON array, the closing bracket is missing')
+            return
+
+
+def import_format(filename):
+    """Returns the import format of a file name from its extension, or None if it is not supported."""
+    extension = filename.rsplit('.', 1)[-1].lower() if '.' in filename else ''
+    return {'csv': 'csv', 'json': 'json', 'jsonl': 'jsonl', 'ndjson': 'jsonl'}.get(extension)
+
+
+##################################### IMPORTING THE ROWS ##########################################################
+# an error of the import: the number of the row in the file (the header of a CSV file is not counted) and the message
+RowError = namedtuple('RowError', ['row', 'message'])
+
+
+class ImportReport:
+    """The number of rows inserted, updated and refused by an import, with the details of the first errors."""
+
+    def __init__(self):
+        self.rows = 0
+        self.inserted = 0
+        self.updated = 0
+        self.error_count = 0
+        self.errors = []
+        self.stopped = None  ## why the file could not be read to its end, the rows saved before stay saved
+
+    def error(self, row, message):
+        self.error_count += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append(RowError(row, message))
+
+
+def import_products(rows, key='sku', batch_size=None):
+    """
+        Validates and saves the product rows in batches, each batch in its own commit.
+        Returns the ImportReport.
+
+        Args:
+            rows: an iterable of dicts, e.g. from read_rows.
+            key: 'sku' to match the existing products by their SKU, or 'name' by their name.
+            batch_size: the number of rows per batch, IMPORT_BATCH_SIZE by default.
+    """
+    if key not in IMPORT_KEYS:
+        raise ValueError('unknown import key {}'.format(key))
+    batch_size = batch_size or app.config['IMPORT_BATCH_SIZE']
+    key_column = 'sku' if key == 'sku' else 'product_name'
+    report = ImportReport()
+
+    # the categories are few, they are looked up in memory for every row
+    category_ids, categories_by_name = set(), {}
+    for category_id, cat_name in db.session.execute(db.select(Category.id, Category.cat_name)):
+        category_ids.add(category_id)
+        categories_by_name.setdefault(cat_name.strip().lower(), category_id)
+
+    batch = {}
+    for number, row in enumerate(_readable_rows(rows, report), start=1):
+        report.rows += 1
+        try:
+            product = _validate_row(row, key, category_ids, categories_by_name)
+        except InvalidProduct as error:
+            report.error(number, str(error))
+            continue
+        batch[product[key_column]] = (number, product)  ## the same product twice in a batch, the last row wins
+        if len(batch) >= batch_size:
+            _save_batch(batch, key_column, report)
+            batch = {}
+    if batch:
+        _save_batch(batch, key_column, report)
+    return report
+
+
+def _readable_rows(rows, report):
+    # a file that can't be read further (not UTF-8, a broken JSON array) stops the import after the rows read before,
+    # the batches already saved stay saved like with any other import stopped halfway
+    rows = iter(rows)
+    while True:
+        try:
+            row = next(rows)
+        except StopIteration:
+            return
+        except (ValueError, csv.Error) as error:
+            report.stopped = 'Unreadable file, the import stopped at row {} ({})'.format(report.rows + 1, error)
+            report.error(report.rows + 1, report.stopped)
+            return
+        yield row
+
+
+def _validate_row(row, key, category_ids, categories_by_name):
+    if not isinstance(row, dict):
+        raise InvalidProduct('Invalid row')
+    if '_error' in row:
+        raise InvalidProduct(row['_error'])
+
+    def field(name):
+        value = row.get(name)
+        return value.strip() if isinstance(value, str) else value
+
+    name, price, quantity_available, manu_date = validate_product_fields(
+        field('product_name'), field('price'), field('quantity_available'), field('manu_date'),
+    )
+
+    category_id, category = field('category_id'), field('category')
+    if category_id not in (None, ''):
+        try:
+            category_id = int(category_id)
+        except (TypeError, ValueError):
+            raise InvalidProduct('Category not found')
+        if category_id not in category_ids:
+            raise InvalidProduct('Category not found')
+    elif category:
+        category_id = categories_by_name.get(str(category).lower())
+        if category_id is None:
+            raise InvalidProduct('Category not found')
+    else:
+        raise InvalidProduct('Please fill out all fields')
+
+    sku = field('sku')
+    sku = str(sku) if sku not in (None, '') else None
+    if key == 'sku' and not sku:
+        raise InvalidProduct('SKU is required')
+    if sku and len(sku) > 64:
+        raise InvalidProduct('SKU must be at most 64 characters')
+    if len(name) > 180:
+        raise InvalidProduct('Product name must be at most 180 characters')
+
+    product = dict(
+        product_name=name, price=price, quantity_available=quantity_available, manu_date=manu_date, category_id=category_id,
+    )
+    # an optional column missing from the row leaves the value of an existing product as it is
+    if 'sku' in row:
+        product['sku'] = sku
+    if 'description' in row:
+        description = field('description')
+        product['description'] = str(description)[:1400] if description not in (None, '') else None
+    return product
+
+
+def _save_batch(batch, key_column, report):
+    try:
+        inserted, updated = _save_products([product for number, product in batch.values()], key_column)
+        db.session.commit()
+    except IntegrityError:
+        # a SKU of the batch belongs to another product (when matching by name), the rows are
+        # saved one at a time to find the ones in conflict, this only happens to that batch
+        db.session.rollback()
+        inserted = updated = 0
+        for number, product in batch.values():
+            try:
+                row_inserted, row_updated = _save_products([product], key_column)
+                db.session.commit()
+            except IntegrityError:
+                db.session.rollback()
+                report.error(number, 'SKU already used by another product')
+                continue
+            inserted += row_inserted
+            updated += row_updated
+    report.inserted += inserted
+    report.updated += updated
+
+
+def _save_products(products, key_column):
+    # one query finds the existing products, one executemany inserts the new ones and one updates the others
+    column = getattr(Product, key_column)
+    keys = [product[key_column] for product in products]
+    existing = dict(db.session.execute(
+        db.select(column, Product.id).where(column.in_(keys)).order_by(Product.id.desc())
+    ).all())  ## with the same name twice in the database, the oldest product is the one updated
+
+    new_products = [dict(OPTIONAL_COLUMNS, **product, product_image_path='') for product in products if product[key_column] not in existing]
+    changed_products = [dict(product, id=existing[product[key_column]]) for product in products if product[key_column] in existing]
+    if new_products:
+        db.session.execute(insert(Product), new_products)
+    if changed_products:
+        db.session.execute(update(Product), changed_products)  ## a bulk UPDATE by primary key, one statement per set of columns
+
+    # the batch is indexed for the search and the workers rebuild their cached catalog once for the whole batch
+    product_ids = list(existing.values())
+    if new_products:
+        product_ids += db.session.execute(
+            db.select(Product.id).where(column.in_([product[key_column] for product in new_products]))
+        ).scalars().all()
+    search.index_products(product_ids)
+    bump_catalog_version()
+    return len(new_products), len(changed_products)
+
+
+##################################### flask products COMMANDS ##########################################################
+@app.cli.group('products')
+def products_cli():
+    """Bulk operations on the products."""
+
+
+@products_cli.command('import')
+@click.argument('file', type=click.File('rb'))
+@click.option('--format', 'format', type=click.Choice(IMPORT_FORMATS), default=None, help='the format of the file, guessed from its extension by default')
+@click.option('--key', type=click.Choice(IMPORT_KEYS), default='sku', help='match the existing products by SKU or by name')
+def import_command(file, format, key):
+    """Imports the products of a CSV, JSON Lines or JSON file, creating or updating them."""
+    format = format or import_format(file.name)
+    if format is None:
+        raise click.ClickException('unknown file format, use --format')
+    started = datetime.now()
+    report = import_products(read_rows(file, format), key=key)
+    for error in report.errors:
+        click.echo('row {}: {}'.format(error.row, error.message))
+    click.echo('{} rows: {} inserted, {} updated, {} errors in {:.1f}s'.format(
+        report.rows, report.inserted, report.updated, report.error_count, (datetime.now() - started).total_seconds(),
+    ))
+    if report.stopped:
+        raise click.ClickException('{}, the {} products saved before it were kept'.format(report.stopped, report.inserted + report.updated))
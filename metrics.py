@@ -0,0 +1,241 @@
+"""
+    A module that contains the per-route metrics of the app, shown in the Prometheus text format at /metrics.
+
+    For every endpoint it records the request latency, the number of SQL statements of a request
+    and their time, the time spent rendering templates and the size of the responses. Nothing is
+    recorded (no hook or listener is installed) unless METRICS_ENABLED is set.
+
+    Every gunicorn worker keeps its numbers in memory and a thread writes them to its own file of
+    METRICS_DIR (metrics-<pid>.json) every METRICS_FLUSH_SECONDS when they changed, the worker serving /metrics adds up the
+    files of all the workers. The files of the workers that stopped are kept, so the counters never go
+    back; the directory is emptied when gunicorn starts (see gunicorn.conf.py).
+"""
+
+import atexit
+import glob
+import json
+import os
+import tempfile
+import threading
+import time
+
+from flask import g, has_request_context, request, before_render_template, template_rendered
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from config import app
+
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200)
+SIZE_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+# name: (type, help, buckets of the histograms)
+METRICS = {
+    'quickmart_http_requests_total': ('counter', 'Requests served, by endpoint, method and status.', None),
+    'quickmart_http_request_duration_seconds': ('histogram', 'Time to handle a request, until its response is returned by the view.', LATENCY_BUCKETS),
+    'quickmart_http_request_sql_statements': ('histogram', 'SQL statements run by a request.', QUERY_BUCKETS),
+    'quickmart_http_request_sql_seconds_total': ('counter', 'Time spent running the SQL statements of the requests.', None),
+    'quickmart_http_template_render_seconds_total': ('counter', 'Time spent rendering the templates of the requests.', None),
+    'quickmart_http_response_size_bytes': ('histogram', 'Size of the response bodies, the streamed responses are not counted.', SIZE_BUCKETS),
+}
+
+
+class MetricsStore:
+    """The metrics of this worker, written to its file of METRICS_DIR from time to time."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._pid = None
+        self._series = {}
+        self._changed = False
+
+    def _values(self):
+        # started by the first request of each process, a worker forked from a master that already recorded something starts from zero
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._series = {}
+            threading.Thread(target=self._flush_regularly, name='metrics-flush', daemon=True).start()
+        self._changed = True
+        return self._series
+
+    def _flush_regularly(self):
+        # a thread writes the file, so the last requests of a worker that is idle now are counted too
+        while True:
+            time.sleep(app.config['METRICS_FLUSH_SECONDS'])
+            if self._changed:
+                self.flush()
+
+    def inc(self, name, labels, amount=1):
+        """Adds amount to a counter."""
+        with self._lock:
+            series = self._values()
+            series[name, labels] = series.get((name, labels), 0) + amount
+
+    def observe(self, name, labels, value):
+        """Records a value of a histogram: its bucket, the sum and the count."""
+        buckets = METRICS[name][2]
+        with self._lock:
+            series = self._values()
+            histogram = series.get((name, labels))
+            if histogram is None:
+                histogram = series[name, labels] = [0] * (len(buckets) + 2)
+            for index, bound in enumerate(buckets):
+                if value <= bound:
+                    histogram[index] += 1
+                    break
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    def flush(self):
+        """Writes the metrics of this worker to its file, replacing the previous one at once."""
+        with self._lock:
+            if self._pid != os.getpid():
+                return  ## nothing recorded in this process yet
+            self._changed = False
+            data = [[name, labels, [*value] if isinstance(value, list) else value] for (name, labels), value in self._series.items()]
+            pid = self._pid
+        if not data:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        handle, temporary = tempfile.mkstemp(dir=self.directory, prefix='.metrics-')
+        with os.fdopen(handle, 'w') as file:
+            json.dump(data, file)
+        os.replace(temporary, os.path.join(self.directory, 'metrics-{}.json'.format(pid)))
+
+
+metrics_store = MetricsStore(app.config['METRICS_DIR'])
+
+
+def collect(directory=None):
+    """Adds up the files of all the workers and returns the metrics in the Prometheus text format."""
+    metrics_store.flush()  ## the numbers of the worker serving the scrape are up to date
+    totals = {}
+    for filename in sorted(glob.glob(os.path.join(directory or metrics_store.directory, 'metrics-*.json'))):
+        try:
+            with open(filename) as file:
+                data = json.load(file)
+        except (OSError, ValueError):
+            continue  ## the file of a worker that just stopped, or of an older version
+        for name, labels, value in data:
+            if name not in METRICS:
+                continue
+            key = (name, tuple(tuple(label) for label in labels))
+            if isinstance(value, list):
+                total = totals.setdefault(key, [0] * len(value))
+                totals[key] = [a + b for a, b in zip(total, value)]
+            else:
+                totals[key] = totals.get(key, 0) + value
+
+    lines = []
+    for name, (kind, help, buckets) in METRICS.items():
+        lines.append('# HELP {} {}'.format(name, help))
+        lines.append('# TYPE {} {}'.format(name, kind))
+        for (series_name, labels), value in sorted(totals.items()):
+            if series_name != name:
+                continue
+            if kind == 'counter':
+                lines.append('{}{} {}'.format(name, _labels(labels), _number(value)))
+                continue
+            cumulative = 0
+            for bound, count in zip(buckets, value):
+                cumulative += count
+                lines.append('{}_bucket{} {}'.format(name, _labels(labels + (('le', _number(bound)),)), cumulative))
+            lines.append('{}_bucket{} {}'.format(name, _labels(labels + (('le', '+Inf'),)), value[-1]))
+            lines.append('{}_sum{} {}'.format(name, _labels(labels), _number(value[-2])))
+            lines.append('{}_count{} {}'.format(name, _labels(labels), value[-1]))
+    return '\n'.join(lines) + '\n'
+
+
+def clear_metrics():
+    """Removes the files of the workers, called when gunicorn starts so the counters start from zero."""
+    for filename in glob.glob(os.path.join(metrics_store.directory, 'metrics-*.json')):
+        os.remove(filename)
+
+
+def _labels(labels):
+    escaped = (
+        '{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in labels
+    )
+    return '{' + ','.join(escaped) + '}'
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+##################################### RECORDING THE REQUESTS ##########################################################
+class RequestMetrics:
+    """The numbers of the current request, kept in g.metrics."""
+
+    __slots__ = ('started', 'statements', 'sql_seconds', 'template_seconds', 'template_started')
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.statements = 0
+        self.sql_seconds = 0.0
+        self.template_seconds = 0.0
+        self.template_started = None
+
+
+def _current():
+    return g.get('metrics') if has_request_context() else None
+
+
+def _start_request():
+    g.metrics = RequestMetrics()
+
+
+def _end_request(response):
+    current = g.pop('metrics', None)
+    if current is None:
+        return response
+    elapsed = time.perf_counter() - current.started
+    endpoint = request.endpoint or 'none'  ## the requests of unknown urls (404) are counted together
+    labels = (('endpoint', endpoint), ('method', request.method))
+    metrics_store.inc('quickmart_http_requests_total', labels + (('status', str(response.status_code)),))
+    metrics_store.observe('quickmart_http_request_duration_seconds', labels, elapsed)
+    metrics_store.observe('quickmart_http_request_sql_statements', labels, current.statements)
+    metrics_store.inc('quickmart_http_request_sql_seconds_total', labels, current.sql_seconds)
+    metrics_store.inc('quickmart_http_template_render_seconds_total', labels, current.template_seconds)
+    if not response.is_streamed and response.content_length is not None:
+        metrics_store.observe('quickmart_http_response_size_bytes', labels, response.content_length)
+    return response
+
+
+def _before_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+    if _current() is not None:
+        connection.info['metrics_started'] = time.perf_counter()  ## a connection runs one statement at a time
+
+
+def _after_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+    current = _current()
+    started = connection.info.pop('metrics_started', None)
+    if current is not None and started is not None:
+        current.statements += 1
+        current.sql_seconds += time.perf_counter() - started
+
+
+def _before_render(sender, template, context, **extra):
+    current = _current()
+    if current is not None:
+        current.template_started = time.perf_counter()
+
+
+def _rendered(sender, template, context, **extra):
+    current = _current()
+    if current is not None and current.template_started is not None:
+        current.template_seconds += time.perf_counter() - current.template_started
+        current.template_started = None
+
+
+if app.config['METRICS_ENABLED']:
+    app.before_request(_start_request)
+    app.after_request(_end_request)
+    event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)  ## every engine, the primary and the replica
+    event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+    before_render_template.connect(_before_render, app)
+    template_rendered.connect(_rendered, app)
+    atexit.register(metrics_store.flush)
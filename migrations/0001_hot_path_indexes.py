@@ -0,0 +1,42 @@
+"""
+    Indexes of the hot query paths and a unique cart line per user and product.
+
+    - cart (user_id, product_id), unique: the cart of a user and the line of a product in it.
+      Duplicate lines a double click may have made are merged into the oldest line first.
+    - transaction (user_id, date_time, id): the history of a user, latest first, by keyset pages.
+    - order (transaction_id): the orders of the transactions of a history page.
+    - product (category_id): the products of a category, in the catalog and the admin pages.
+"""
+
+from sqlalchemy import text
+
+
+INDEXES = [
+    ('uq_cart_user_id_product_id', 'cart', 'user_id, product_id', True),
+    ('ix_transaction_user_id_date_time', 'transaction', 'user_id, date_time, id', False),
+    ('ix_order_transaction_id', 'order', 'transaction_id', False),
+    ('ix_product_category_id', 'product', 'category_id', False),
+]
+
+
+def upgrade(connection):
+    # the quantities of the duplicate lines go to the oldest line of the same product, the others are deleted
+    connection.execute(text(
+        "UPDATE cart SET quantity_added_to_cart = ("
+        "  SELECT sum(duplicate.quantity_added_to_cart) FROM cart AS duplicate"
+        "  WHERE duplicate.user_id = cart.user_id AND duplicate.product_id = cart.product_id"
+        ") WHERE id IN (SELECT min(id) FROM cart GROUP BY user_id, product_id HAVING count(*) > 1)"
+    ))
+    connection.execute(text(
+        "DELETE FROM cart WHERE id NOT IN (SELECT min(id) FROM cart GROUP BY user_id, product_id)"
+    ))
+
+    for name, table, columns, unique in INDEXES:
+        connection.execute(text(
+            'CREATE {}INDEX IF NOT EXISTS {} ON "{}" ({})'.format('UNIQUE ' if unique else '', name, table, columns)
+        ))
+
+
+def downgrade(connection):
+    for name, table, columns, unique in INDEXES:
+        connection.execute(text('DROP INDEX IF EXISTS {}'.format(name)))
@@ -0,0 +1,32 @@
+"""
+    Stored line subtotal of the orders and item count of the transactions.
+
+    - order.subtotal: price * quantity of the line, saved at checkout.
+    - transaction.item_count: the number of items of the transaction, saved at checkout.
+    The existing orders and transactions get theirs computed from their rows.
+"""
+
+from sqlalchemy import text
+
+from migrations import has_column
+
+
+def upgrade(connection):
+    if not has_column(connection, 'order', 'subtotal'):
+        connection.execute(text('ALTER TABLE "order" ADD COLUMN subtotal FLOAT NOT NULL DEFAULT 0'))
+    if not has_column(connection, 'transaction', 'item_count'):
+        connection.execute(text('ALTER TABLE "transaction" ADD COLUMN item_count INTEGER NOT NULL DEFAULT 0'))
+
+    connection.execute(text('UPDATE "order" SET subtotal = price * quantity'))
+    connection.execute(text(
+        'UPDATE "transaction" SET item_count = coalesce(('
+        '  SELECT sum(quantity) FROM "order" WHERE "order".transaction_id = "transaction".id'
+        '), 0)'
+    ))
+
+
+def downgrade(connection):
+    if has_column(connection, 'transaction', 'item_count'):
+        connection.execute(text('ALTER TABLE "transaction" DROP COLUMN item_count'))
+    if has_column(connection, 'order', 'subtotal'):
+        connection.execute(text('ALTER TABLE "order" DROP COLUMN subtotal'))
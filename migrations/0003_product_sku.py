@@ -0,0 +1,24 @@
+"""
+    Stock keeping unit of the products, the key of the bulk import.
+
+    - product.sku: optional, unique when set (several products can have none).
+    - product (product_name): the import matches the products by name when it has no SKU column.
+"""
+
+from sqlalchemy import text
+
+from migrations import has_column
+
+
+def upgrade(connection):
+    if not has_column(connection, 'product', 'sku'):
+        connection.execute(text('ALTER TABLE product ADD COLUMN sku VARCHAR(64)'))
+    connection.execute(text('CREATE UNIQUE INDEX IF NOT EXISTS uq_product_sku ON product (sku)'))
+    connection.execute(text('CREATE INDEX IF NOT EXISTS ix_product_product_name ON product (product_name)'))
+
+
+def downgrade(connection):
+    connection.execute(text('DROP INDEX IF EXISTS ix_product_product_name'))
+    connection.execute(text('DROP INDEX IF EXISTS uq_product_sku'))
+    if has_column(connection, 'product', 'sku'):
+        connection.execute(text('ALTER TABLE product DROP COLUMN sku'))
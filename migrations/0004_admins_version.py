@@ -0,0 +1,25 @@
+"""
+    Version of the admin flags of the users, so the admin flag of the session cookie can be trusted.
+
+    - the triggers user_admin_changed and user_admin_deleted of the user table raise the catalog_version
+      row 3 when the admin flag of a user changes or an admin is deleted (see admins.py).
+"""
+
+from sqlalchemy import inspect, text
+
+from models import ADMINS_VERSION_TRIGGERS
+
+
+def upgrade(connection):
+    for trigger in ADMINS_VERSION_TRIGGERS:
+        connection.execute(text(trigger))
+    # the row the triggers raise, 'flask init-db' adds it as well
+    if inspect(connection).has_table('catalog_version'):
+        connection.execute(text(
+            "INSERT INTO catalog_version (id, version, updated_at) VALUES (3, 0, datetime('now', 'localtime')) ON CONFLICT (id) DO NOTHING"
+        ))
+
+
+def downgrade(connection):
+    connection.execute(text('DROP TRIGGER IF EXISTS user_admin_deleted'))
+    connection.execute(text('DROP TRIGGER IF EXISTS user_admin_changed'))
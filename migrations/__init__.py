@@ -0,0 +1,216 @@
+"""
+    A package that contains the migrations of the database schema.
+
+    Every module of this package named like 0001_some_change.py is a migration with an
+    upgrade(connection) and a downgrade(connection) function, applied in the order of
+    their number, each in its own transaction (see migration_transaction). Their steps
+    check before changing (IF NOT EXISTS, has_column), so a migration can run again. The number of the last migration applied is kept in the schema_version
+    table, so an existing database gets only the changes it doesn't have yet.
+
+    New tables are still created by db.create_all from the models; the migrations change
+    the tables that already exist (indexes, columns, data). A new database is created
+    straight from the models, which already have every change, and is marked as up to date.
+    An existing database is migrated by 'flask init-db' or 'flask db upgrade', run once when deploying.
+
+    Commands:
+        flask db upgrade [--revision N]      applies the pending migrations (up to N)
+        flask db downgrade --revision N      reverts the migrations after N
+        flask db current                     shows the version of the database
+        flask db history                     lists the migrations
+        flask db check-plans                 checks the query plans of the hot queries (see plans.py)
+"""
+
+import importlib
+import pkgutil
+import re
+from collections import namedtuple
+from contextlib import contextmanager
+
+import click
+from sqlalchemy import inspect, text
+
+from config import app
+from models import db
+
+
+SCHEMA_VERSION_TABLE = 'schema_version'
+
+Migration = namedtuple('Migration', ['revision', 'name', 'description', 'upgrade', 'downgrade'])
+
+
+class MigrationConflict(RuntimeError):
+    """Raised when another process changed the schema version while a migration was running."""
+
+
+def load_migrations():
+    """Returns the migrations of this package, sorted by revision number."""
+    migrations = []
+    for module_info in pkgutil.iter_modules(__path__):
+        match = re.fullmatch(r'(\d{4})_\w+', module_info.name)
+        if not match:
+            continue
+        module = importlib.import_module('{}.{}'.format(__name__, module_info.name))
+        migrations.append(Migration(
+            int(match.group(1)), module_info.name, (module.__doc__ or '').strip().splitlines()[0],
+            module.upgrade, module.downgrade,
+        ))
+    migrations.sort(key=lambda migration: migration.revision)
+    return migrations
+
+
+def head_revision():
+    """Returns the number of the last migration."""
+    migrations = load_migrations()
+    return migrations[-1].revision if migrations else 0
+
+
+def current_revision(connection):
+    """Returns the schema version of the database, None when the database has no schema_version table yet."""
+    if not inspect(connection).has_table(SCHEMA_VERSION_TABLE):
+        return None
+    return connection.execute(text(f"SELECT version FROM {SCHEMA_VERSION_TABLE}")).scalar()
+
+
+def has_column(connection, table, column):
+    """Returns True if the table has the column, for the migrations adding or dropping one to run twice safely."""
+    return column in {existing['name'] for existing in inspect(connection).get_columns(table)}
+
+
+@contextmanager
+def migration_transaction():
+    """
+        Yields a connection in a transaction that is committed at the end, or rolled back with
+        everything the migration did if it raises, its CREATE, ALTER and DROP statements included.
+    """
+    with db.engine.connect() as connection:
+        # pysqlite only begins a transaction before INSERT, UPDATE and DELETE, so the DDL of a
+        # migration would be committed right away. Its own transaction handling is turned off for
+        # this connection and the transaction is begun explicitly, taking the write lock at once
+        # so two migrating processes wait for each other (the recipe of the SQLAlchemy docs)
+        dbapi_connection = connection.connection.driver_connection
+        sqlite = connection.dialect.name == 'sqlite'
+        if sqlite:
+            isolation_level, dbapi_connection.isolation_level = dbapi_connection.isolation_level, None
+        try:
+            with connection.begin():
+                if sqlite:
+                    connection.exec_driver_sql('BEGIN IMMEDIATE')
+                yield connection
+        finally:
+            if sqlite:
+                dbapi_connection.isolation_level = isolation_level  ## the connection goes back to the pool of the app
+
+
+def stamp(connection, revision):
+    """Marks the database as being at a schema version without running any migration."""
+    connection.execute(text(f"CREATE TABLE IF NOT EXISTS {SCHEMA_VERSION_TABLE} (version INTEGER NOT NULL)"))
+    connection.execute(text(f"DELETE FROM {SCHEMA_VERSION_TABLE}"))
+    connection.execute(text(f"INSERT INTO {SCHEMA_VERSION_TABLE} (version) VALUES (:version)"), {'version': revision})
+
+
+def _move(connection, from_revision, to_revision):
+    # the version only moves if it is still the one the migration started from, so when two workers
+    # start at the same time the second one rolls back instead of applying the migration twice
+    result = connection.execute(
+        text(f"UPDATE {SCHEMA_VERSION_TABLE} SET version = :to_revision WHERE version = :from_revision"),
+        {'from_revision': from_revision, 'to_revision': to_revision},
+    )
+    if result.rowcount != 1:
+        raise MigrationConflict('the schema version is not {} anymore'.format(from_revision))
+
+
+def upgrade(revision=None, echo=lambda message: None):
+    """Applies the migrations after the current schema version up to revision (the last one by default)."""
+    target = head_revision() if revision is None else revision
+    for migration in load_migrations():
+        # every migration runs in its own transaction, a failing migration leaves the previous ones applied
+        with migration_transaction() as connection:
+            current = current_revision(connection)
+            if current is None:
+                stamp(connection, 0)
+                current = 0
+            if migration.revision <= current or migration.revision > target:
+                continue
+            echo('upgrade {} {}'.format(migration.name, migration.description))
+            migration.upgrade(connection)
+            _move(connection, current, migration.revision)
+
+
+def downgrade(revision, echo=lambda message: None):
+    """Reverts the migrations after revision, the last one first."""
+    for migration in reversed(load_migrations()):
+        with migration_transaction() as connection:
+            current = current_revision(connection) or 0
+            if migration.revision > current or migration.revision <= revision:
+                continue
+            echo('downgrade {} {}'.format(migration.name, migration.description))
+            migration.downgrade(connection)
+            _move(connection, current, migration.revision - 1)
+
+
+def init_schema(echo=lambda message: None):
+    """
+        Creates or updates the database schema, run by 'flask init-db' once per deployment: a new
+        database is created from the models and marked as up to date, an existing one gets its
+        missing tables and then its pending migrations (see upgrade), before anything queries
+        the tables through the models.
+    """
+    with db.engine.begin() as connection:
+        new_database = not inspect(connection).get_table_names()
+    db.create_all()
+    if new_database:
+        with migration_transaction() as connection:
+            stamp(connection, head_revision())
+        return
+    # the tables made by create_all above already have every change, the steps of the migrations skip them
+    upgrade(echo=echo)
+
+
+##################################### flask db COMMANDS ##########################################################
+@app.cli.group('db')
+def db_cli():
+    """Migrations of the database schema."""
+
+
+@db_cli.command('upgrade')
+@click.option('--revision', type=int, default=None, help='the migration to stop at, the last one by default')
+def upgrade_command(revision):
+    """Applies the pending migrations."""
+    upgrade(revision, echo=click.echo)
+    with db.engine.connect() as connection:
+        click.echo('schema version {}'.format(current_revision(connection)))
+
+
+@db_cli.command('downgrade')
+@click.option('--revision', type=int, required=True, help='the migration to go back to, 0 for the schema before the first migration')
+def downgrade_command(revision):
+    """Reverts the migrations after a revision."""
+    downgrade(revision, echo=click.echo)
+    with db.engine.connect() as connection:
+        click.echo('schema version {}'.format(current_revision(connection)))
+
+
+@db_cli.command('current')
+def current_command():
+    """Shows the schema version of the database."""
+    with db.engine.connect() as connection:
+        click.echo('schema version {} (last migration {})'.format(current_revision(connection), head_revision()))
+
+
+@db_cli.command('history')
+def history_command():
+    """Lists the migrations."""
+    with db.engine.connect() as connection:
+        current = current_revision(connection) or 0
+    for migration in load_migrations():
+        click.echo('{} {} {}'.format('*' if migration.revision <= current else ' ', migration.name, migration.description))
+
+
+@db_cli.command('check-plans')
+def check_plans_command():
+    """Fails when a hot query of the routes is planned as a full table scan or a temporary sort."""
+    from migrations.plans import check_query_plans
+
+    problems = check_query_plans(echo=click.echo)
+    if problems:
+        raise click.ClickException('{} queries have a bad plan'.format(len(problems)))
@@ -0,0 +1,100 @@
+"""
+    A module that checks the query plans of the hot queries of the routes, run by 'flask db check-plans'.
+
+    Every check runs the same code a route runs (the same query helpers and pagination), records
+    the SELECT statements it sends to the database and asks SQLite for their EXPLAIN QUERY PLAN.
+    A plan that reads a whole table ('SCAN cart') or sorts the rows in a temporary b-tree instead
+    of reading them in index order is reported, e.g. after an index was dropped or a query changed
+    so it can't use its index anymore. The checks only need the tables, not any data.
+"""
+
+import re
+from contextlib import contextmanager
+from datetime import date
+
+from sqlalchemy import event
+from sqlalchemy.orm import joinedload, selectinload
+
+from models import db, Cart, Product, Order, Transaction
+from cart import cart_summary
+from pagination import keyset_paginate, encode_cursor, TRANSACTION_SORT_ORDER, CATEGORY_PRODUCT_SORT_ORDERS
+
+
+# a plan step reading every row of a table, 'SCAN cart' but not 'SCAN cart USING INDEX ...'
+FULL_SCAN = re.compile(r'^SCAN (\w+)$')
+TEMP_SORT = 'USE TEMP B-TREE'
+
+USER_ID, PRODUCT_ID, CATEGORY_ID = 1, 1, 1
+
+
+@contextmanager
+def recorded_statements():
+    """Records the (statement, parameters) of every SELECT sent to the database inside the with block."""
+    statements = []
+
+    def record(connection, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith('SELECT'):
+            statements.append((statement, parameters))
+
+    event.listen(db.engine, 'before_cursor_execute', record)
+    try:
+        yield statements
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', record)
+
+
+def _cart_line():
+    Cart.query.filter_by(user_id=USER_ID, product_id=PRODUCT_ID).first()
+
+
+def _cart_page():
+    Cart.query.filter_by(user_id=USER_ID).options(joinedload(Cart.product)).all()
+    cart_summary(USER_ID)
+
+
+def _transaction_history():
+    transactions = Transaction.query.filter_by(user_id=USER_ID).options(selectinload(Transaction.orders).joinedload(Order.product))
+    keyset_paginate(transactions, TRANSACTION_SORT_ORDER, per_page=10)
+    page = keyset_paginate(transactions, TRANSACTION_SORT_ORDER, after=encode_cursor((date.today(), 10)), per_page=10)
+    # with an empty database there are no orders to load, so their query is run the way selectinload runs it
+    if not page.items:
+        Order.query.filter(Order.transaction_id.in_([1, 2, 3])).options(joinedload(Order.product)).all()
+
+
+def _category_products():
+    products = Product.query.filter_by(category_id=CATEGORY_ID)
+    keyset_paginate(products, CATEGORY_PRODUCT_SORT_ORDERS['id'], per_page=24)
+    keyset_paginate(products, CATEGORY_PRODUCT_SORT_ORDERS['id'], after=encode_cursor((24,)), per_page=24)
+
+
+HOT_QUERIES = [
+    ('cart line of a product', _cart_line),
+    ('cart page', _cart_page),
+    ('transaction history page', _transaction_history),
+    ('products of a category page', _category_products),
+]
+
+
+def bad_plan_steps(plan):
+    """Returns the steps of an EXPLAIN QUERY PLAN that scan a whole table or sort in a temporary b-tree."""
+    return [detail for detail in plan if FULL_SCAN.match(detail) or TEMP_SORT in detail]
+
+
+def check_query_plans(echo=print):
+    """Runs every hot query and returns a list of (name, statement, bad steps) for the ones with a bad plan."""
+    if db.engine.dialect.name != 'sqlite':
+        echo('query plans are only checked on SQLite')
+        return []
+
+    problems = []
+    for name, run in HOT_QUERIES:
+        with recorded_statements() as statements:
+            run()
+        for statement, parameters in statements:
+            plan = [row[3] for row in db.session.connection().exec_driver_sql('EXPLAIN QUERY PLAN ' + statement, parameters)]
+            bad_steps = bad_plan_steps(plan)
+            echo('{} {}: {}'.format('FAIL' if bad_steps else 'ok  ', name, '; '.join(plan)))
+            if bad_steps:
+                problems.append((name, statement, bad_steps))
+    db.session.rollback()
+    return problems
@@ -1,8 +1,29 @@
+import sqlite3
+
 from flask_sqlalchemy import SQLAlchemy
 from flask import request
+from sqlalchemy import event, DDL
+from sqlalchemy.engine import Engine
 from config import app
+from replicas import RoutingSession
+from datetime import datetime
+
+db = SQLAlchemy(app, session_options={'class_': RoutingSession})  ## the read-only pages can read from a replica, see replicas.py
+
+
+@event.listens_for(Engine, 'connect')
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    # the SQLite settings of config.py are per connection, so every new connection of the pool gets them
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA busy_timeout = {:d}'.format(app.config['SQLITE_BUSY_TIMEOUT']))
+    cursor.execute('PRAGMA journal_mode = {}'.format(app.config['SQLITE_JOURNAL_MODE']))
+    cursor.execute('PRAGMA synchronous = {}'.format(app.config['SQLITE_SYNCHRONOUS']))
+    cursor.execute('PRAGMA cache_size = {:d}'.format(app.config['SQLITE_CACHE_SIZE']))
+    cursor.execute('PRAGMA mmap_size = {:d}'.format(app.config['SQLITE_MMAP_SIZE']))
+    cursor.close()
 
-db = SQLAlchemy(app)
 
 class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -15,6 +36,19 @@ class User(db.Model):
     transactions = db.relationship('Transaction', backref=db.backref('user', lazy=True))
 
 
+# the triggers raising the version of the admin flags (the catalog_version row 3, see admins.py) when the flag
+# of a user changes or an admin is deleted, so the bulk updates and plain SQL are seen like the changes of the models.
+# migrations/0004_admins_version.py adds them to the databases made before them.
+ADMINS_VERSION_TRIGGERS = [
+    'CREATE TRIGGER IF NOT EXISTS user_admin_changed AFTER UPDATE OF is_admin ON "user" WHEN OLD.is_admin IS NOT NEW.is_admin '
+    "BEGIN UPDATE catalog_version SET version = version + 1, updated_at = datetime('now', 'localtime') WHERE id = 3; END",
+    'CREATE TRIGGER IF NOT EXISTS user_admin_deleted AFTER DELETE ON "user" WHEN OLD.is_admin '
+    "BEGIN UPDATE catalog_version SET version = version + 1, updated_at = datetime('now', 'localtime') WHERE id = 3; END",
+]
+for trigger in ADMINS_VERSION_TRIGGERS:
+    event.listen(User.__table__, 'after_create', DDL(trigger).execute_if(dialect='sqlite'))
+
+
 class Category(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     cat_name = db.Column(db.String(180), unique=False)
@@ -23,6 +57,7 @@ class Category(db.Model):
 
 class Product(db.Model):
     id = db.Column(db.Integer, primary_key=True)
+    sku = db.Column(db.String(64), nullable=True)  ## the stock keeping unit the bulk import matches products by, see inventory.py
     product_name = db.Column(db.String(180), nullable=False)
     price = db.Column(db.Float, nullable=False)
     description = db.Column(db.String(1400), nullable=True)
@@ -32,7 +67,12 @@ class Product(db.Model):
     carts = db.relationship('Cart', backref=db.backref('product', lazy=True))
     orders = db.relationship('Order', backref=db.backref('product', lazy=True))
     
-    product_image_path = db.Column(db.String(180), nullable=False)
+    product_image_path = db.Column(db.String(180), nullable=False)  ## empty for the imported products until an image is uploaded
+    __table_args__ = (
+        db.Index('ix_product_category_id', 'category_id'),
+        db.Index('uq_product_sku', 'sku', unique=True),
+        db.Index('ix_product_product_name', 'product_name'),
+    )
 
 
 class Cart(db.Model):
@@ -40,6 +80,8 @@ class Cart(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False)
     quantity_added_to_cart = db.Column(db.Integer, nullable=False)
+    # a user has one line per product, adding the product again adds to its quantity
+    __table_args__ = (db.Index('uq_cart_user_id_product_id', 'user_id', 'product_id', unique=True),)
 
 
 class Order(db.Model):
@@ -50,6 +92,8 @@ class Order(db.Model):
     #items = db.relationship('OrderItem', backref=db.backref('order', lazy=True))
     transaction_id = db.Column(db.Integer, db.ForeignKey('transaction.id'), nullable=False)
     price = db.Column(db.Float, nullable=False)
+    subtotal = db.Column(db.Float, nullable=False, default=0, server_default='0')  ## price * quantity, saved at checkout
+    __table_args__ = (db.Index('ix_order_transaction_id', 'transaction_id'),)
 
 class Transaction(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -57,5 +101,59 @@ class Transaction(db.Model):
     orders = db.relationship('Order', backref=db.backref('transaction', lazy=True))
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     date_time = db.Column(db.Date, nullable=False)
+    item_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')  ## number of items ordered, saved at checkout
+    # the history of a user is listed latest first, see TRANSACTION_SORT_ORDER in pagination.py
+    __table_args__ = (db.Index('ix_transaction_user_id_date_time', 'user_id', 'date_time', 'id'),)
+
+
+class CatalogVersion(db.Model):
+    # a row whose version goes up on every change to the categories, products or stock (id 1),
+    # each worker compares it with the version of its cached catalog snapshot to know when to rebuild it.
+    # the resized product images have their own row (id 2, see thumbnails.py), they don't change the catalog,
+    # and so do the admin flags of the users (id 3, see admins.py).
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
+
+
+class ImageBlob(db.Model):
+    # a product image file stored under the sha256 hash of its content, with the number of products using it,
+    # the file is removed from the disk when the last of them is deleted or gets another image (see images.py).
+    sha256 = db.Column(db.String(64), primary_key=True)
+    path = db.Column(db.String(180), unique=True, nullable=False)
+    size = db.Column(db.Integer, nullable=False)
+    ref_count = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
+
+
+class ImageVariant(db.Model):
+    # a resized copy of a product image in one format and width, made in the background by thumbnails.py
+    # and listed in the srcset of the image, removed with the image_blob it was made from.
+    id = db.Column(db.Integer, primary_key=True)
+    sha256 = db.Column(db.String(64), db.ForeignKey('image_blob.sha256'), nullable=False, index=True)
+    format = db.Column(db.String(8), nullable=False)
+    width = db.Column(db.Integer, nullable=False)
+    height = db.Column(db.Integer, nullable=False)
+    path = db.Column(db.String(180), unique=True, nullable=False)
+    size = db.Column(db.Integer, nullable=False)
+    __table_args__ = (db.UniqueConstraint('sha256', 'format', 'width'),)
+
+
+class ProductDailySales(db.Model):
+    # the units and revenue of a product on a day, added to at checkout (see sales.py), so the dashboard
+    # reads a row per product and day instead of every order. category_id is the category at the time of the sale.
+    day = db.Column(db.Date, primary_key=True)
+    product_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    category_id = db.Column(db.Integer, nullable=False)
+    units = db.Column(db.Integer, nullable=False, default=0)
+    revenue = db.Column(db.Float, nullable=False, default=0)
+    orders = db.Column(db.Integer, nullable=False, default=0)
 
 
+class CategoryDailySales(db.Model):
+    # the same totals per category and day, the dashboard charts read at most a row per category and day
+    day = db.Column(db.Date, primary_key=True)
+    category_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    units = db.Column(db.Integer, nullable=False, default=0)
+    revenue = db.Column(db.Float, nullable=False, default=0)
+    orders = db.Column(db.Integer, nullable=False, default=0)
@@ -0,0 +1,195 @@
+"""
+    A module that contains the keyset (cursor) pagination used by the catalog pages.
+
+    Instead of OFFSET, every page remembers the sort key of its first and last row
+    in an opaque cursor, and the next/previous page is fetched with a
+    'WHERE (sort key) > cursor ORDER BY sort key LIMIT n' query. The database work
+    for a page stays the same no matter how deep into the catalog the user is.
+"""
+
+import base64
+import bisect
+import json
+from collections import namedtuple
+from datetime import date
+
+from flask import request, url_for
+from sqlalchemy import func, literal, tuple_, Date
+
+from config import app
+from models import Product, Transaction
+
+
+# A sort order is the list of columns the rows are ordered by (the last one must be unique, like the id)
+# and the direction. The values of the columns are read back with each row to build the cursors.
+SortOrder = namedtuple('SortOrder', ['columns', 'descending'])
+
+
+# manu_date is nullable, so products without a date are sorted as if they were made on the earliest date
+_manu_date = func.coalesce(Product.manu_date, literal(date.min, Date))
+
+
+# sort orders offered on the catalog pages, the first one of each is the default.
+PRODUCT_SORT_ORDERS = {
+    'category': SortOrder([Product.category_id, Product.id], False),
+    'price_asc': SortOrder([Product.price, Product.id], False),
+    'price_desc': SortOrder([Product.price, Product.id], True),
+    'newest': SortOrder([_manu_date, Product.id], True),
+    'oldest': SortOrder([_manu_date, Product.id], False),
+}
+
+CATEGORY_PRODUCT_SORT_ORDERS = {
+    'id': SortOrder([Product.id], False),
+    'price_asc': PRODUCT_SORT_ORDERS['price_asc'],
+    'price_desc': PRODUCT_SORT_ORDERS['price_desc'],
+    'newest': PRODUCT_SORT_ORDERS['newest'],
+    'oldest': PRODUCT_SORT_ORDERS['oldest'],
+}
+
+
+# transaction history, the latest transaction first
+TRANSACTION_SORT_ORDER = SortOrder([Transaction.date_time, Transaction.id], True)
+
+
+class InvalidCursor(ValueError):
+    """Raised when a cursor in the query parameters was not made by encode_cursor."""
+
+
+class KeysetPage:
+    """One page of rows with the cursors to the pages before and after it."""
+
+    def __init__(self, items, keys, has_prev, has_next):
+        self.items = items
+        self.has_prev = has_prev
+        self.has_next = has_next
+        self.prev_cursor = encode_cursor(keys[0]) if keys and has_prev else None
+        self.next_cursor = encode_cursor(keys[-1]) if keys and has_next else None
+
+
+def encode_cursor(values):
+    """Turns the sort key of a row into an url safe string."""
+    values = [value.isoformat() if isinstance(value, date) else value for value in values]
+    return base64.urlsafe_b64encode(json.dumps(values, separators=(',', ':')).encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor, sort_order):
+    """Turns a cursor back into the sort key values, converted to the python type of each sort column."""
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except ValueError:
+        raise InvalidCursor(cursor)
+    if not isinstance(values, list) or len(values) != len(sort_order.columns):
+        raise InvalidCursor(cursor)
+
+    decoded = []
+    for column, value in zip(sort_order.columns, values):
+        try:
+            if _python_type(column) is date:
+                value = date.fromisoformat(value)
+            elif not isinstance(value, (int, float)):
+                raise TypeError(value)
+        except (TypeError, ValueError):
+            raise InvalidCursor(cursor)
+        decoded.append(value)
+    return decoded
+
+
+def _python_type(column):
+    """Returns the python type of a sort column, computed columns without a known type are numbers."""
+    try:
+        return column.type.python_type
+    except NotImplementedError:
+        return float
+
+
+def get_page_size():
+    """Returns the page size asked for with the 'per_page' query parameter, or the configured default."""
+    try:
+        per_page = int(request.args.get('per_page', app.config['CATALOG_PAGE_SIZE']))
+    except ValueError:
+        per_page = app.config['CATALOG_PAGE_SIZE']
+    return max(1, min(per_page, app.config['CATALOG_MAX_PAGE_SIZE']))
+
+
+def keyset_paginate(query, sort_order, after=None, before=None, per_page=None):
+    """
+        Returns a KeysetPage of the query ordered by the sort order.
+
+        Args:
+            query: the query of the rows, with any joins the sort columns need.
+            sort_order: the SortOrder to page through.
+            after: cursor of the row the page starts after, for the next page.
+            before: cursor of the row the page ends before, for the previous page.
+            per_page: the number of rows on a page.
+    """
+    per_page = per_page or get_page_size()
+    columns = sort_order.columns
+    backwards = bool(before)
+
+    # going backwards, we read the rows in the opposite direction and flip them back afterwards
+    descending = sort_order.descending != backwards
+    cursor = decode_cursor(before if backwards else after, sort_order) if (before or after) else None
+    if cursor is not None:
+        key, values = tuple_(*columns), tuple_(*[literal(value, column.type) for column, value in zip(columns, cursor)])
+        query = query.filter(key < values if descending else key > values)
+
+    # the sort columns are selected next to each row, so the cursors are built from the exact values the database compared
+    query = query.add_columns(*columns).order_by(*[column.desc() if descending else column.asc() for column in columns])
+
+    # one extra row tells us if there is another page in the direction we are reading
+    rows = query.limit(per_page + 1).all()
+    has_more = len(rows) > per_page
+    rows = rows[:per_page]
+    if backwards:
+        rows.reverse()
+
+    items = [row[0] for row in rows]
+    keys = [tuple(row[1:]) for row in rows]
+    if backwards:
+        return KeysetPage(items, keys, has_prev=has_more, has_next=True)
+    return KeysetPage(items, keys, has_prev=cursor is not None, has_next=has_more)
+
+
+def keyset_paginate_sorted(items, keys, sort_order, after=None, before=None, per_page=None):
+    """
+        Returns a KeysetPage of rows that are already in memory, with the same cursors as keyset_paginate.
+
+        Args:
+            items: the rows in ascending order of their sort keys.
+            keys: the sort key tuple of each row, in the same order.
+            sort_order: the SortOrder the keys were made from.
+            after, before, per_page: the same as in keyset_paginate.
+    """
+    per_page = per_page or get_page_size()
+    backwards = bool(before)
+    descending = sort_order.descending != backwards
+    cursor = tuple(decode_cursor(before if backwards else after, sort_order)) if (before or after) else None
+
+    # the rows after the cursor are found with a binary search on the sorted keys
+    if not descending:
+        start = bisect.bisect_right(keys, cursor) if cursor is not None else 0
+        positions = list(range(start, min(start + per_page + 1, len(keys))))
+    else:
+        end = bisect.bisect_left(keys, cursor) if cursor is not None else len(keys)
+        positions = list(range(end - 1, max(end - per_page - 2, -1), -1))
+
+    has_more = len(positions) > per_page
+    positions = positions[:per_page]
+    if backwards:
+        positions.reverse()
+
+    page_items = [items[position] for position in positions]
+    page_keys = [keys[position] for position in positions]
+    if backwards:
+        return KeysetPage(page_items, page_keys, has_prev=has_more, has_next=True)
+    return KeysetPage(page_items, page_keys, has_prev=cursor is not None, has_next=has_more)
+
+
+@app.template_global()
+def page_url(**cursor):
+    """Returns the url of the current page with the 'after'/'before' cursor replaced, for the next/prev links."""
+    args = request.args.to_dict()
+    args.pop('after', None)
+    args.pop('before', None)
+    args.update(cursor)
+    return url_for(request.endpoint, **(request.view_args or {}), **args)
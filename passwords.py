@@ -0,0 +1,115 @@
+"""
+    A module that contains the hashing and checking of the user passwords.
+
+    The passwords are hashed with the PASSWORD_HASH_METHOD of config.py (a werkzeug method
+    such as 'scrypt:32768:8:1' or 'pbkdf2:sha256:600000'). A hash is CPU bound on purpose,
+    so at the login peaks the hashes of a worker run in a pool of at most PASSWORD_HASH_WORKERS
+    threads: hashlib releases the GIL while it hashes, so the other requests of the worker
+    keep being served. At most PASSWORD_HASH_QUEUE_SIZE hashes wait for the pool, for up to
+    PASSWORD_HASH_TIMEOUT seconds; when the queue is full the logins are turned away at once
+    with PasswordHashBusy instead of piling up.
+
+    The functions of this module only work on the hash strings, they never touch the database
+    session. The callers end their database transaction before a hash (see the login, register
+    and profile routes), so a few dozen logins waiting for their hash don't hold every connection.
+
+    When the method or cost of the config changes, the stored hashes are made again with the
+    new one the next time their user logs in (see needs_rehash), the users never notice.
+"""
+
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+from werkzeug.security import generate_password_hash, check_password_hash
+
+from config import app
+
+
+class PasswordHashBusy(Exception):
+    """Raised when too many password hashes are waiting for the pool of this worker."""
+
+
+class PasswordHasher:
+    """The bounded pool of threads hashing the passwords of this worker."""
+
+    def __init__(self):
+        self._executor = None
+        self._slots = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._method_prefixes = {}
+
+    def _start(self):
+        # started by the first hash of each process, the threads of a pool started before gunicorn forked its workers don't exist in them
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                self._pid = os.getpid()
+                workers = app.config['PASSWORD_HASH_WORKERS']
+                self._slots = threading.BoundedSemaphore(workers + app.config['PASSWORD_HASH_QUEUE_SIZE'])
+                self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='password-hash')
+
+    def _run(self, function, *args):
+        self._start()
+        # a full queue turns the request away at once, it doesn't keep a thread of the server waiting for a slot
+        if not self._slots.acquire(blocking=False):
+            raise PasswordHashBusy()
+        try:
+            future = self._executor.submit(function, *args)
+            try:
+                return future.result(timeout=app.config['PASSWORD_HASH_TIMEOUT'])
+            except TimeoutError:
+                if future.cancel():
+                    raise PasswordHashBusy()  ## still waiting in the queue of the pool
+                return future.result()  ## already being hashed, it is done soon
+        finally:
+            self._slots.release()
+
+    def hash(self, password):
+        """Returns the hash of a password with the configured method, to save in user.hashed_password."""
+        return self._run(generate_password_hash, password, app.config['PASSWORD_HASH_METHOD'], app.config['PASSWORD_SALT_LENGTH'])
+
+    def check(self, stored_hash, password):
+        """Returns True if the password matches the stored hash, whatever method it was made with."""
+        return self._run(check_password_hash, stored_hash, password)
+
+    def needs_rehash(self, stored_hash):
+        """Returns True if the stored hash was made with another method or cost than the configured one."""
+        configured = app.config['PASSWORD_HASH_METHOD']
+        if configured not in self._method_prefixes:
+            # 'scrypt' is stored as 'scrypt:32768:8:1', so the full method is learned from a hash once
+            self._method_prefixes[configured] = generate_password_hash('', configured, 1).split('$', 1)[0]
+        method, _, rest = stored_hash.partition('$')
+        salt = rest.partition('$')[0]
+        return method != self._method_prefixes[configured] or len(salt) != app.config['PASSWORD_SALT_LENGTH']
+
+
+password_hasher = PasswordHasher()
+
+
+def hash_password(password):
+    """
+        Hashes a new password in the pool, see PasswordHasher.hash. End the database transaction
+        of the request before calling it (e.g. db.session.commit()), so the request doesn't keep
+        a connection of the pool while it waits for its hash.
+
+        Raises:
+            PasswordHashBusy: when the pool of this worker has too many hashes waiting.
+    """
+    return password_hasher.hash(password)
+
+
+def check_password(stored_hash, password):
+    """
+        Returns True if the password matches the stored hash of a user. Like hash_password,
+        end the database transaction of the request before calling it.
+
+        Raises:
+            PasswordHashBusy: when the pool of this worker has too many hashes waiting.
+    """
+    return password_hasher.check(stored_hash, password)
+
+
+def needs_rehash(stored_hash):
+    """Returns True if the stored hash was made with an outdated method or cost, the caller saves a new hash_password."""
+    return password_hasher.needs_rehash(stored_hash)
@@ -0,0 +1,180 @@
+"""
+    A module that contains the query checks for development and staging: the N+1 detector and the slow query log.
+
+    The N+1 detector (N_PLUS_ONE_DETECTION) fingerprints the SQL statements of every request, the
+    statement with its parameters left out. A fingerprint seen N_PLUS_ONE_THRESHOLD times or more in
+    one request is usually a lazy relationship loaded row by row, e.g. {{ cart.product.product_name }}
+    in a loop of a template, and is logged as a warning with the template line or the line of code that
+    sent it. The fix is an eager load (joinedload or selectinload) in the view.
+
+    The slow query log (SLOW_QUERY_THRESHOLD_MS) writes every statement slower than the threshold to
+    SLOW_QUERY_LOG as one JSON object per line, with the endpoint, the duration, the parameters, the
+    code that sent it and its query plan (EXPLAIN QUERY PLAN on SQLite, EXPLAIN on PostgreSQL).
+
+    Nothing is installed when both are off, they are meant for development and staging.
+"""
+
+import json
+import logging
+import os
+import re
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from config import app
+
+
+# the lists of an IN are fingerprinted as one, 'IN (?, ?, ?)' and 'IN (?)' are the same statement
+IN_LIST = re.compile(r'\bIN \((?:\s*(?:\?|%\(\w+\)s|:\w+)\s*,?)+\)', re.IGNORECASE)
+WHITESPACE = re.compile(r'\s+')
+
+# the query plan of a statement by database, and the column of the plan rows with the text of a step
+EXPLAIN = {'sqlite': ('EXPLAIN QUERY PLAN ', 3), 'postgresql': ('EXPLAIN ', 0)}
+
+
+def fingerprint(statement):
+    """Returns the statement without its formatting and with every IN list as one, the parameters are already out of it."""
+    return IN_LIST.sub('IN (...)', WHITESPACE.sub(' ', statement).strip())
+
+
+def caller_location():
+    """
+        Returns where the current statement was sent from: the closest template line or line of
+        the app (not of flask, jinja or sqlalchemy), e.g. 'cart.html:42' or 'routes.py:310 in cart_page'.
+    """
+    frame = sys._getframe(1)
+    while frame is not None:
+        template = frame.f_globals.get('__jinja_template__')
+        if template is not None:
+            return '{}:{}'.format(template.name or template.filename, template.get_corresponding_lineno(frame.f_lineno))
+        filename = frame.f_code.co_filename
+        if filename.startswith(app.root_path) and filename != __file__ and 'site-packages' not in filename:
+            return '{}:{} in {}'.format(os.path.relpath(filename, app.root_path), frame.f_lineno, frame.f_code.co_name)
+        frame = frame.f_back
+    return 'unknown'
+
+
+##################################### N+1 DETECTOR ##########################################################
+def _count_statement(statement):
+    counts = g.get('query_fingerprints')
+    if counts is None:
+        counts = g.query_fingerprints = {}
+        g.query_locations = {}
+    key = fingerprint(statement)
+    count = counts[key] = counts.get(key, 0) + 1
+    if count == app.config['N_PLUS_ONE_THRESHOLD']:
+        g.query_locations[key] = caller_location()  ## the repeated statements come from the same loop, one stack walk is enough
+
+
+def n_plus_one_queries():
+    """Returns (count, statement, location) of the statements of the current request repeated at least N_PLUS_ONE_THRESHOLD times."""
+    counts, locations = g.get('query_fingerprints') or {}, g.get('query_locations') or {}
+    return [
+        (count, statement, locations.get(statement, 'unknown'))
+        for statement, count in counts.items() if count >= app.config['N_PLUS_ONE_THRESHOLD']
+    ]
+
+
+def _report_n_plus_one(response):
+    for count, statement, location in n_plus_one_queries():
+        app.logger.warning('N+1 queries in %s: %s times "%s" from %s', request.endpoint, count, statement, location)
+    return response
+
+
+##################################### SLOW QUERY LOG ##########################################################
+slow_query_logger = logging.getLogger('quickmart.slow_queries')
+slow_query_logger.propagate = False  ## only in its own file, not in the log of the app
+_handler_lock = threading.Lock()
+
+
+def _slow_query_handler():
+    # the file is opened by the first slow query of each worker, the workers append their lines to the same file
+    with _handler_lock:
+        if not slow_query_logger.handlers:
+            os.makedirs(os.path.dirname(os.path.abspath(app.config['SLOW_QUERY_LOG'])), exist_ok=True)
+            handler = logging.FileHandler(app.config['SLOW_QUERY_LOG'], encoding='utf-8')
+            handler.setFormatter(logging.Formatter('%(message)s'))
+            slow_query_logger.addHandler(handler)
+            slow_query_logger.setLevel(logging.INFO)
+
+
+def query_plan(connection, statement, parameters):
+    """Returns the steps of the query plan of a SELECT statement, or None when the database can't tell it."""
+    explain = EXPLAIN.get(connection.dialect.name)
+    if explain is None or not statement.lstrip().upper().startswith(('SELECT', 'WITH')):
+        return None
+    prefix, column = explain
+    # the raw DB-API cursor, so the EXPLAIN isn't seen by the listeners of the engine
+    cursor = connection.connection.cursor()
+    try:
+        cursor.execute(prefix + statement, parameters)
+        return [row[column] for row in cursor.fetchall()]
+    except Exception as error:
+        return ['no plan: {}'.format(error)]
+    finally:
+        cursor.close()
+
+
+def log_slow_query(connection, statement, parameters, executemany, seconds):
+    """Writes a slow statement to the slow query log with its plan."""
+    from migrations.plans import bad_plan_steps
+
+    _slow_query_handler()
+    plan = None if executemany else query_plan(connection, statement, parameters)
+    entry = {
+        'time': datetime.now(timezone.utc).isoformat(timespec='milliseconds'),
+        'endpoint': request.endpoint if has_request_context() else None,
+        'duration_ms': round(seconds * 1000, 2),
+        'statement': statement,
+        'parameters': None if executemany else _parameters(parameters),
+        'location': caller_location(),
+        'plan': plan,
+        'bad_plan_steps': bad_plan_steps(plan) if plan and connection.dialect.name == 'sqlite' else [],
+    }
+    slow_query_logger.info(json.dumps(entry, default=str))
+
+
+def _parameters(parameters):
+    if isinstance(parameters, dict):
+        return {name: _parameter(value) for name, value in parameters.items()}
+    return [_parameter(value) for value in parameters or ()]
+
+
+def _parameter(value):
+    # a long text or a file in the parameters would make the log huge
+    if isinstance(value, (bytes, bytearray)):
+        return '<{} bytes>'.format(len(value))
+    if isinstance(value, str) and len(value) > 200:
+        return value[:200] + '...'
+    return value
+
+
+##################################### ENGINE LISTENERS ##########################################################
+def _before_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+    connection.info['querylog_started'] = time.perf_counter()
+    # only the reads, the checkout updates the stock of every product of a cart on purpose
+    if app.config['N_PLUS_ONE_DETECTION'] and has_request_context() and statement.lstrip()[:6].upper() == 'SELECT':
+        _count_statement(statement)
+
+
+def _after_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+    started = connection.info.pop('querylog_started', None)
+    threshold = app.config['SLOW_QUERY_THRESHOLD_MS']
+    if started is None or not threshold:
+        return
+    seconds = time.perf_counter() - started
+    if seconds * 1000 >= threshold:
+        log_slow_query(connection, statement, parameters, executemany, seconds)
+
+
+if app.config['N_PLUS_ONE_DETECTION'] or app.config['SLOW_QUERY_THRESHOLD_MS']:
+    event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)  ## every engine, the primary and the replica
+    event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+if app.config['N_PLUS_ONE_DETECTION']:
+    app.after_request(_report_n_plus_one)
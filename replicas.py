@@ -0,0 +1,142 @@
+"""
+    A module that contains the routing of the read-only pages to a read replica of the database.
+
+    When SQLALCHEMY_REPLICA_URI is set, the views decorated with replica_reads (the storefront,
+    cart and history pages and the admin listings) run their SELECT queries on the replica, so
+    the catalog browsing doesn't compete with the checkouts on the primary. Everything else runs
+    on the primary: the other views, every INSERT, UPDATE and DELETE, and the queries of a
+    request after it wrote something.
+
+    A replica is a little behind the primary, so a user who just changed something (added to
+    their cart, checked out) would not see it on the next page. After a request commits a write,
+    the pages of that user read from the primary for REPLICA_STICKY_SECONDS, kept in their
+    session cookie.
+
+    Locally, the replica can be a second SQLite file copied from the primary with
+    'flask replica sync', e.g. SQLALCHEMY_REPLICA_URI=sqlite:///replica.sqlite3.
+"""
+
+import sqlite3
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+import click
+from flask import g, session, has_request_context
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event
+from sqlalchemy.sql import Select, CompoundSelect
+
+from config import app
+
+
+REPLICA_BIND = 'replica'
+
+
+def replica_enabled():
+    """Returns True if a read replica is configured."""
+    return REPLICA_BIND in app.config.get('SQLALCHEMY_BINDS', {})
+
+
+class RoutingSession(Session):
+    """The session of db.session, sending the SELECT queries of the replica_reads views to the replica."""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and not self._flushing and isinstance(clause, (Select, CompoundSelect)) and _reads_from_replica():
+            return self._db.engines[REPLICA_BIND]
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+def _reads_from_replica():
+    return has_request_context() and g.get('replica_reads', False)
+
+
+def replica_reads(func):
+    """
+        A decorator for the views that only read, their queries run on the replica unless
+        the user wrote something in the last REPLICA_STICKY_SECONDS.
+    """
+    @wraps(func)
+    def inner(*args, **kwargs):
+        g.replica_reads = replica_enabled() and session.get('primary_until', 0) < time.time()
+        return func(*args, **kwargs)
+    return inner
+
+
+@contextmanager
+def primary_reads():
+    """Runs the queries of the with block on the primary, even in a replica_reads view."""
+    if not has_request_context():
+        yield
+        return
+    previous = g.get('replica_reads', False)
+    g.replica_reads = False
+    try:
+        yield
+    finally:
+        g.replica_reads = previous
+
+
+##################################### stick to the primary after a write ##########################################################
+@event.listens_for(RoutingSession, 'after_flush')
+def _flushed(db_session, flush_context):
+    db_session.info['wrote'] = True  ## a flush only runs when there are changes to write
+
+
+@event.listens_for(RoutingSession, 'do_orm_execute')
+def _executed(orm_execute_state):
+    # the bulk INSERT, UPDATE and DELETE statements that don't go through a flush
+    if orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete:
+        orm_execute_state.session.info['wrote'] = True
+
+
+def stick_to_primary():
+    """
+        Makes the rest of the request read what it just wrote, and the pages of its user read from
+        the primary for REPLICA_STICKY_SECONDS. Called after every commit of a write of the request,
+        and by the requests whose write was committed by another thread (see flash_sale.py).
+        Does nothing outside of a request.
+    """
+    if not has_request_context():
+        return
+    g.replica_reads = False
+    if replica_enabled():
+        session['primary_until'] = time.time() + app.config['REPLICA_STICKY_SECONDS']
+
+
+@event.listens_for(RoutingSession, 'after_commit')
+def _committed(db_session):
+    if db_session.info.pop('wrote', False):
+        stick_to_primary()  ## a commit of a background thread has no request, see stick_to_primary
+
+
+@event.listens_for(RoutingSession, 'after_rollback')
+def _rolled_back(db_session):
+    db_session.info.pop('wrote', None)
+
+
+##################################### flask replica COMMANDS ##########################################################
+@app.cli.group('replica')
+def replica_cli():
+    """The local read replica for development."""
+
+
+@replica_cli.command('sync')
+def sync_replica():
+    """Copies the SQLite primary database to the SQLite replica, to try the replica routing locally."""
+    from models import db
+
+    if not replica_enabled():
+        raise click.ClickException('SQLALCHEMY_REPLICA_URI is not set')
+    primary, replica = db.engine, db.engines[REPLICA_BIND]
+    if primary.dialect.name != 'sqlite' or replica.dialect.name != 'sqlite':
+        raise click.ClickException('only SQLite files are copied, a PostgreSQL replica is kept up to date by streaming replication')
+    # the online backup of SQLite copies a consistent snapshot while the app keeps running
+    source, destination = sqlite3.connect(primary.url.database), sqlite3.connect(replica.url.database)
+    try:
+        source.backup(destination)
+    finally:
+        source.close()
+        destination.close()
+    replica.dispose()  ## the pooled connections of the replica see the new file
+    click.echo('copied {} to {}'.format(primary.url.database, replica.url.database))
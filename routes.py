@@ -5,22 +5,40 @@
 
 from config import app
 from flask import render_template
-from flask import request, flash, redirect, url_for, session
+from flask import request, flash, redirect, url_for, session, g, jsonify, Response, stream_with_context
+from werkzeug.local import LocalProxy
 
 from models import db, User, Cart, Category, Product, Order, Transaction
-
-from werkzeug.security import generate_password_hash, check_password_hash
+from sqlalchemy import func
+from sqlalchemy.orm import joinedload, selectinload
+from sqlalchemy.exc import IntegrityError
+from pagination import keyset_paginate, InvalidCursor, CATEGORY_PRODUCT_SORT_ORDERS, TRANSACTION_SORT_ORDER
+import search
+import images
+from catalog import find_products, bump_catalog_version, InvalidSort
+from cart import cart_summary, add_to_cart
+from sales import sales_report, SALES_PERIODS
+from inventory import validate_product_fields, InvalidProduct, import_products, read_rows, import_format, IMPORT_KEYS
+from exports import stream_export, export_filename, orders_query, transactions_query, inventory_query, ExportFilters, EXPORT_FORMATS, MIMETYPES
+from checkout import cart_lines, OutOfStock, CartChanged
+from flash_sale import place_cart_order, FlashSaleBusy
+from replicas import replica_reads
+from admins import admins_version
+import metrics
+from budgets import query_budget
+
+from passwords import hash_password, check_password, needs_rehash, PasswordHashBusy
+import hmac
 from functools import wraps
+from itertools import groupby
+from operator import attrgetter
 from datetime import datetime
 
 
 
 
-import os
 import imghdr
-import uuid
 from flask import request, session, send_from_directory
-from werkzeug.utils import secure_filename
 
 
 
@@ -43,6 +61,65 @@ def validate_image(stream):
 
 
 ##################################### Authenticator ##########################################################
+# get_current_user, loads the logged in user at most once per request
+def get_current_user():
+    """
+        A function that returns the logged in user of the session, loaded from the database
+        the first time it is needed in a request and kept in g.current_user for the rest of it,
+        so the decorators and the routes of one request never query the same user twice.
+        Returns None if nobody is logged in, or if the user was deleted, in which case the
+        session is logged out. The admin flag of the session is refreshed from the loaded user.
+    """
+    if 'current_user' not in g:
+        g.current_user = db.session.get(User, session['user_id']) if 'user_id' in session else None
+        if 'user_id' in session and g.current_user is None:
+            logout_user()
+        elif g.current_user is not None and session.get('is_admin') != g.current_user.is_admin:
+            session['is_admin'] = g.current_user.is_admin
+    return g.current_user
+
+
+# current_user, the logged in user of the request, only loaded when one of its attributes is used
+current_user = LocalProxy(get_current_user)
+
+
+# login_user, saves the user and their admin flag in the signed session cookie
+def login_user(user):
+    """
+        A function that logs the user in by saving their ID and admin flag in the session.
+        The session cookie is signed with the SECRET_KEY, so the user can't change the flag, and
+        the pages can trust it without querying the database. admin_required checks it against
+        the version of the admin flags (see admins.py), so a demoted or deleted admin loses the
+        admin pages within ADMINS_VERSION_TTL seconds.
+    """
+    session['user_id'] = user.id
+    session['is_admin'] = user.is_admin
+    session.pop('admins_version', None)  ## the first admin page checks the flag against the user record
+    g.current_user = user
+
+
+# logout_user, removes the user from the session cookie
+def logout_user():
+    """A function that logs the user of the session out."""
+    session.pop('user_id', None)
+    session.pop('is_admin', None)
+    session.pop('admins_version', None)
+    g.current_user = None
+
+
+# is_admin, checks the admin flag carried in the session
+def is_admin():
+    """
+        Returns True if the logged in user is an admin, from the session without a database query when possible.
+        It only chooses what to show, the admin pages are guarded by admin_required.
+    """
+    if 'is_admin' not in session:
+        # sessions from before the admin flag was carried in the cookie load the user once to learn it
+        user = get_current_user()
+        return user.is_admin if user is not None else False
+    return session['is_admin']
+
+
 # auth_required, checks if the user is logged in or not to retrieve their session and unique activity
 def auth_required(func):
     """
@@ -77,17 +154,37 @@ def admin_required(func):
         if 'user_id' not in session:
             flash("please login to continue")
             return redirect(url_for('login_page'))
-        
-        # we retrieve the user unique session if they are logged in
+
+        # the admin flag of the session is trusted as long as no admin flag changed since it was checked
+        # (see admins.py), else the user record is loaded once to refresh it, a deleted user is logged out
+        version = admins_version.get()
+        if session.get('admins_version') != version:
+            if get_current_user() is None:
+                flash("please login to continue")
+                return redirect(url_for('login_page'))
+            session['admins_version'] = version
+
         # we check if they are not admin and restrict them from accessing the admin pages
         # if they are admins, we grant them access to the admin required pages
-        user = User.query.get(session['user_id'])
-        if not user.is_admin:
+        if not session.get('is_admin'):
             flash("You are not authorized to access this page")
             return redirect(url_for('home_page'))
         else:
             return func(*args, **kwargs)
     return inner
+# json_auth_required, the auth_required of the JSON endpoints, answers with a JSON error instead of a redirect
+def json_auth_required(func):
+    """
+        A custom function that is use to wrap around the JSON endpoints that need the user session,
+        the scripts calling them get a 401 JSON error they can handle instead of the login page.
+    """
+    @wraps(func)
+    def inner(*args, **kwargs):
+        if 'user_id' in session:
+            return func(*args, **kwargs)
+        else:
+            return jsonify(error='please login to continue'), 401
+    return inner
 ################################## End of Authenticator #############################################
 
 
@@ -111,21 +208,15 @@ def admin_required(func):
 
 
 @app.route('/')
+@replica_reads  ## the catalog pages read from the replica when there is one, see replicas.py
 @auth_required 
+@query_budget(statements=2, rows=50, ms=100)  ## the catalog version check and the search, browsing is served from the cached catalog
 def home_page():
     """Return the index page or the admin page if user is admin."""
-    user = User.query.get(session['user_id'])
-    if user.is_admin:
+    if is_admin():
         return redirect(url_for('admin_dashboard')) ##The route for admin_dashboard is below
     
 
-    # normal display without search
-    # retrieves all categories from the database for the index.html file to use
-    # and dispay the each category and their products
-    categories = Category.query.all()
-
-
-
     # search functionality
     # retrieve the form name for searching this includes the select and input from name the search form in
     # the search_bar.html file included with context in the index.html file
@@ -134,10 +225,6 @@ def home_page():
     pname = request.args.get('pname') or ''
     price = request.args.get('price')
 
-    # check if the user is searching for a category name\
-    if cname:
-        categories = Category.query.filter(Category.cat_name.ilike(f'%{cname}%')).all()
-
     # check if price is given and convert it to a float 
     if price:
         try:
@@ -150,15 +237,42 @@ def home_page():
             return redirect(url_for('home_page'))
 
 
+    # the category name, product name and price filters all run in the database as one joined query,
+    # the product name is looked up in the full-text search index of the product names, descriptions and
+    # category names. Browsing without a search is served from the catalog snapshot cached in this worker.
+    # Either way the products are read one page at a time with keyset pagination, in the sort order the user picked.
+    # "Best match" (relevance) is the default choice of the search bar, so the first search submitted from it is
+    # ranked by relevance, without a search it lists the products in the category order
+    sort = request.args.get('sort') or 'relevance'
+    products_sort = 'category' if sort == 'relevance' and not pname else sort
+    try:
+        page = find_products(category_name=cname, terms=pname, max_price=price, sort=products_sort, after=request.args.get('after'), before=request.args.get('before'))
+    except InvalidSort:
+        flash('Invalid sort order')
+        return redirect(url_for('home_page'))
+    except InvalidCursor:
+        flash('Invalid page')
+        return redirect(url_for('home_page'))
 
+    # renders the matching products grouped by their category
+    return render_template('index.html', categories=group_by_category(page.items, products_sort), page=page, sort=sort, cname=cname, pname=pname, price=price)
 
 
-    # renders normal display without search
-    return render_template('index.html', categories=categories, cname=cname, pname=pname, price=price)
 
 
 
 
+def group_by_category(products, sort):
+    """
+        Groups the products of a page by their category for the index.html file to use
+        and dispay the each category and their products. When sorting by relevance, price or date the
+        products of different categories are mixed, so they are shown in one group without a category heading.
+    """
+    if sort == 'category':
+        return [(category, list(category_products)) for category, category_products in groupby(products, key=attrgetter('category'))]
+    return [(None, products)] if products else []
+
+
 
 
 ################################# END of FRONTEND ROUTE [home page]  #################################################
@@ -167,6 +281,7 @@ def home_page():
 
 #################################  BACKEND Controller [home page]  #################################################
 @app.route('/add_to_cart/<int:product_id>', methods=['POST'])
+@query_budget(statements=3, rows=5, ms=100)
 def home_page_add_to_cart_post(product_id):
     """
     
@@ -216,8 +331,14 @@ def home_page_add_to_cart_post(product_id):
         cart = Cart(user_id=session['user_id'], product_id=product_id, quantity_added_to_cart=quantity_input)
         db.session.add(cart) 
     
-    # save the changes to the database
-    db.session.commit()
+    # save the changes to the database, a user has only one cart line per product,
+    # so adding the same product from two tabs at the same moment is refused for the second one
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        flash('The product was just added to your cart from another page, please check your cart')
+        return redirect(url_for('home_page'))
 
     flash('Product added to cart successfully')
     return redirect(url_for('home_page'))
@@ -252,11 +373,13 @@ def home_page_add_to_cart_post(product_id):
 
 
 @app.route('/login')
+@query_budget(statements=0, rows=0, ms=50)
 def login_page():
     """Return the login page."""
     return render_template('login.html')
 
 @app.route('/register')
+@query_budget(statements=0, rows=0, ms=50)
 def register_page():
     """Returns the register page"""
     return render_template('register.html')
@@ -264,17 +387,18 @@ def register_page():
 
 @app.route("/profile")
 @auth_required  
+@query_budget(statements=1, rows=1, ms=50)
 def profile_page():
-    user  = User.query.get(session["user_id"])  # saves the user id in the  variable
     ## renders the profile page with the user's unique session and activity
-    return render_template("profile.html", user=user) 
+    return render_template("profile.html", user=current_user) 
     
 
 
 @app.route("/logout")
 @auth_required ## checks for user's session
+@query_budget(statements=0, rows=0, ms=50)
 def logout_page():
-    session.pop('user_id')
+    logout_user()
     return redirect(url_for('login_page'))
 
 ############################### END of FRONTEND ROUTES #################################################
@@ -291,6 +415,7 @@ def logout_page():
 #### Register Backend controller
 # Related html file => register.html
 @app.route('/register', methods=['POST'])   
+@query_budget(statements=2, rows=2, ms=400)  ## the username check and the insert, the time is the hashing of the password
 def register_post():                        
     input_username =  request.form.get('username')
     password = request.form.get('password')
@@ -323,8 +448,13 @@ def register_post():
         flash("Username already exists")
         return redirect(url_for('register_page'))
     
-    ### secure the users password
-    hashPassword = generate_password_hash(password)
+    ### secure the users password, hashed in the bounded pool of passwords.py
+    db.session.commit()  ## nothing changed yet, ends the transaction so the connection is not held while the password is hashed
+    try:
+        hashPassword = hash_password(password)
+    except PasswordHashBusy:
+        flash("Too many sign ups at the moment, please try again")
+        return redirect(url_for('register_page'))
     ## set the newly registered user to database query
     new_user = User(username=input_username, hashed_password=hashPassword, name=name)
     # Initialises the new user database query
@@ -340,6 +470,7 @@ def register_post():
 #### login Backend and controller
 # the related html file => login.html
 @app.route('/login', methods=['POST']) 
+@query_budget(statements=2, rows=2, ms=400)  ## the user, loaded again after the transaction ended for the password check, the time is the check
 def login_post():      
     input_username = request.form.get("username")
     password = request.form.get("password")
@@ -357,16 +488,26 @@ def login_post():
     # checks if the user and user password is in the database with the same user variable.
     # if it is, it saves it in the variable password.
     # for the user password we use the check_password_hash function from werkzeug.security to check
-    # if the password is the same as the one in the database with the same given user name
-    if not user or not check_password_hash(user.hashed_password, password):
-        flash("Invalid username or password")
+    # if the password is the same as the one in the database with the same given user name.
+    # check_password from passwords.py hashes in a bounded pool, a hash made with outdated settings is made again
+    stored_hash = user.hashed_password if user else None
+    db.session.commit()  ## nothing changed yet, ends the transaction so the connection is not held while the password is checked
+    try:
+        if not user or not check_password(stored_hash, password):
+            flash("Invalid username or password")
+            return redirect(url_for('login_page'))
+        if needs_rehash(stored_hash):
+            user.hashed_password = hash_password(password)
+    except PasswordHashBusy:
+        flash("Too many logins at the moment, please try again")
         return redirect(url_for('login_page'))
+    db.session.commit()  ## saves the new hash of the password when one was made
     
     
     # return the home page when successful logged in.
     # Before we send the user to the home or index page,
     # we create the user cookies to track their unique activities.
-    session['user_id'] = user.id
+    login_user(user)
     flash('Login Successful')
     return redirect(url_for('home_page'))
 
@@ -375,6 +516,7 @@ def login_post():
 #### Profile Backend  Controller
 # related html file => profile.html
 @app.route("/profile", methods=["POST"])
+@query_budget(statements=4, rows=5, ms=700)  ## the user, the password checked and the new one hashed take the time
 def profile_post():
     username = request.form.get("username")
     current_password = request.form.get("current_password")
@@ -387,9 +529,15 @@ def profile_post():
         flash('Please fill out all fields')
         return redirect(url_for('profile_page'))
     
-    user = User.query.get(session["user_id"])  ## gets the user session id for their unique info
-    if not check_password_hash(user.hashed_password, current_password):
-        flash('Incorrect current password!')
+    user = get_current_user()  ## gets the user of the session for their unique info
+    stored_hash = user.hashed_password
+    db.session.commit()  ## nothing changed yet, ends the transaction so the connection is not held while the password is checked
+    try:
+        if not check_password(stored_hash, current_password):
+            flash('Incorrect current password!')
+            return redirect(url_for('profile_page'))
+    except PasswordHashBusy:
+        flash('Too many requests at the moment, please try again')
         return redirect(url_for('profile_page'))
     
     # checks if username is already in the database for further implementation to change their user name with the line -> user.username = username, located below.
@@ -417,8 +565,13 @@ def profile_post():
         flash("New password cannot be the same as current password")
         return redirect(url_for('profile_page'))
 
-    # hashes the new user password
-    new_password_hash = generate_password_hash(new_password)
+    # hashes the new user password, after ending the transaction of the username check like above
+    db.session.commit()
+    try:
+        new_password_hash = hash_password(new_password)
+    except PasswordHashBusy:
+        flash('Too many requests at the moment, please try again')
+        return redirect(url_for('profile_page'))
 
 
     user.username = username  ##updates the current user's name to the new user name.
@@ -452,16 +605,33 @@ def profile_post():
 
 # related html file => admin.html ---- serves the page that displays a table of all categories available in the database and given links to add, show, edit and delete caegories.
 @app.route("/admin_dashboard")
+@replica_reads
 @admin_required
+@query_budget(statements=4, rows=150, ms=150)  ## the categories and the sales rollups
 def admin_dashboard():
-    categories = Category.query.all() ## This retrieves all category names that were recently added to the database or already availble in the database.
-    return render_template("admin.html", categories=categories)
+    # the categories with the number of products of each, counted by the database in one grouped query instead of loading every product
+    categories = db.session.execute(
+        db.select(Category.id, Category.cat_name, func.count(Product.id).label('product_count'))
+        .outerjoin(Product, Product.category_id == Category.id)
+        .group_by(Category.id, Category.cat_name)
+        .order_by(Category.id)
+    ).all()
+
+    # the sales of the last 7, 30 or 365 days, read from the daily sales rollups
+    try:
+        days = int(request.args.get('days', 30))
+    except ValueError:
+        days = 30
+    if days not in SALES_PERIODS:
+        days = 30
+    return render_template("admin.html", categories=categories, report=sales_report(days), periods=SALES_PERIODS)
 
 
 # related html file => admin.html  ---- give a preview of the button to add category in the table in admin.html page and return the rendered page in the admin.html file when clicked
 # related html file => category/add.html  ---- serves the page for the actual adding operation that the backend post method found below operates with.
 @app.route("/category/add")
 @admin_required
+@query_budget(statements=0, rows=0, ms=50)
 def add_category():
     return render_template('category/add.html')
 
@@ -477,22 +647,34 @@ def add_category():
 # related html file => admin.html  ---- give a preview of the link to list products in a category in the table in admin.html page and return the rendered page show.html with the admin.html page when the button for show products is clicked.
 # related html file => show.html  ---- serves the page for the actual listinh and CRUD opration for adding, editing, and deleting products
 @app.route("/category/show/<int:id>/")  ## we user <int:id> to identify the category we want to show using the ID of the category
+@replica_reads
 @admin_required
+@query_budget(statements=2, rows=50, ms=100)  ## the category and one keyset page of its products
 def show_category(id):  ## id is the ID number of the category we want to show. flask automatically trask the ID that is been worked on, on the frontend view on the browser to relate them to the actual codes we are working with, in the code or programming section.
     # check if id from the route is in the database
     category = Category.query.get(id)
-    datetime_now = datetime.now().strftime('%Y-%m-%d')
     if not category:
         flash("Category not found")
         return redirect(url_for('admin_dashboard'))
-    else:
 
-        return render_template('category/show.html', category=category)  ## if the category is found in the database, it renders the show.html page with the category name in the database.
+    # the products of the category are listed a page at a time with keyset pagination
+    sort = request.args.get('sort') or 'id'
+    if sort not in CATEGORY_PRODUCT_SORT_ORDERS:
+        flash('Invalid sort order')
+        return redirect(url_for('show_category', id=category.id))
+    try:
+        page = keyset_paginate(Product.query.filter_by(category_id=category.id), CATEGORY_PRODUCT_SORT_ORDERS[sort], after=request.args.get('after'), before=request.args.get('before'))
+    except InvalidCursor:
+        flash('Invalid page')
+        return redirect(url_for('show_category', id=category.id))
+
+    return render_template('category/show.html', category=category, page=page, sort=sort)  ## if the category is found in the database, it renders the show.html page with a page of the category's products.
 
 
 
 @app.route("/category/show/<int:id>/product/add/")
 @admin_required
+@query_budget(statements=2, rows=50, ms=50)  ## the category and the categories of the select
 def add_product(id):
     category = Category.query.get(id)
     if not category:
@@ -505,6 +687,7 @@ def add_product(id):
 
 @app.route("/category/show/<int:id>/product/edit/")
 @admin_required
+@query_budget(statements=2, rows=50, ms=50)  ## the categories of the select and the product
 def edit_product(id):
     categories = Category.query.all()
     product = Product.query.get(id)
@@ -514,6 +697,7 @@ def edit_product(id):
 
 @app.route("/category/show/<int:id>/product/delete/")
 @admin_required
+@query_budget(statements=2, rows=5, ms=50)
 def delete_product(id):
     product = Product.query.get(id)
     category = Category.query.get(product.category_id)
@@ -538,6 +722,7 @@ def delete_product(id):
 # related html file => edit.html  ---- serves the page for the actual editing operation that the backend post method found below operates with.
 @app.route("/category/<int:id>/edit")
 @admin_required
+@query_budget(statements=1, rows=2, ms=50)
 def edit_category(id):  ## id is the ID number of the category we want to edit. flask automatically trask the ID that is been worked on, on the frontend view on the browser to relate them to the actual codes we are working with, in the code or programming section.
     category = Category.query.get(id) ## the ID is not retrieved from the ID base but from the frontend route of the category we are working with to edit. It checks the database if the iD is available and saves it into the varible to work with. 
     # check if ID is available in the database and flash given msg, else edit the retrieved category based ont the retrieved ID number.
@@ -552,6 +737,7 @@ def edit_category(id):  ## id is the ID number of the category we want to edit.
 # related html file => delete.html  ---- serves the page for the actual delete operation that the backend post method found below operates with.
 @app.route("/category/<int:id>/delete")
 @admin_required
+@query_budget(statements=1, rows=2, ms=50)
 def delete_category(id): ## id is the ID number of the category we want to delete. flask automatically trask the ID that is been worked on, on the frontend view on the browser to relate them to the actual codes we are working with, in the code or programming section.
     category = Category.query.get(id)  ## the ID is not retrieved from the ID database but from the frontend route of the category we are working with to edit. It checks the database if the iD is available and saves it into the varible to work with. 
     # check if the category id from the frontend route is available in the database and flash given msg, else render the html page to delete category from the database
@@ -570,6 +756,7 @@ def delete_category(id): ## id is the ID number of the category we want to delet
 
 # Add Backend Controller
 @app.route("/category/add", methods=['POST'])
+@query_budget(statements=2, rows=5, ms=50)
 def add_category_post():
     """
         A function that request the form name from the html routing on the same
@@ -590,6 +777,7 @@ def add_category_post():
     else:
         add_cat_name = Category(cat_name=name)
         db.session.add(add_cat_name)
+        bump_catalog_version()  ## tells the workers to rebuild their cached catalog
         db.session.commit()
 
         flash('Successfully added category')
@@ -609,6 +797,7 @@ def add_category_post():
 
 @app.route("/category/show/<int:id>/product/add/", methods=['POST'])
 @admin_required
+@query_budget(statements=7, rows=10, ms=100)  ## the image reference, the product, its search index row and the catalog version
 def add_product_post(id):
     
     name = request.form.get('product_name')
@@ -623,54 +812,31 @@ def add_product_post(id):
     if not category:
         flash('Category not found')
         return redirect(url_for('admin_dashboard'))
-    if not name or not price or not category_id or not quantity_available or not manu_date:
-        flash('Please fill out all fields')
-        return redirect(url_for('add_product', id=category.id))
+    # the fields are checked by the same function as the bulk import, see inventory.py
     try:
-        price = float(price)
-        quantity_available = int(quantity_available)
-        manu_date = datetime.strptime(manu_date, '%Y-%m-%d')
-    except ValueError:
-        flash('Price and quantity must be numbers')
-        return redirect(url_for('add_product', id=category.id))
-    
-    if quantity_available <= 0:
-        flash('Quantity must be greater than 0')
-        return redirect(url_for('add_product', id=category.id))
-    if manu_date > datetime.now():
-        flash('Manufacture date cannot be in the future')
+        name, price, quantity_available, manu_date = validate_product_fields(name, price, quantity_available, manu_date)
+    except InvalidProduct as error:
+        flash(str(error))
         return redirect(url_for('add_product', id=category.id))
     
 
 
-    if image is None:
+    if not image or not image.filename:
         flash('No image file provided')
         return redirect(url_for('add_product', id=category.id))
 
-    # check if filepath already exists. append random string if it does
-    filename = secure_filename(image.filename)
-    existing_paths = [p.product_image_path for p in Product.query.all()]
-
-    if filename and filename in existing_paths:
-        unique_str = str(uuid.uuid4())[:8]
-        image.filename = f"{unique_str}_{image.filename}"
-
-
-    if filename:
-            file_ext = os.path.splitext(filename)[1]
-            if file_ext not in app.config[
-                "UPLOAD_EXTENSIONS"
-            ]:
-                flash('"error": "Image extension not supported"')
-                return redirect(url_for('add_product', id=category.id))
-            
-            image_path = os.path.join(app.config["UPLOAD_PATH"], image.filename)
-            image.save(image_path)
-
+    # the image is stored under the hash of its content, a picture that is already stored is shared with its products
+    try:
+        image_path = images.save_image(image)
+    except images.UnsupportedImage:
+        flash('"error": "Image extension not supported"')
+        return redirect(url_for('add_product', id=category.id))
 
 
     product = Product(product_name=name, price=price, category_id=category.id, quantity_available=quantity_available, manu_date=manu_date, product_image_path=image_path)
     db.session.add(product)
+    search.index_product(product)  ## adds the new product to the search index in the same commit
+    bump_catalog_version()  ## tells the workers to rebuild their cached catalog
     db.session.commit()
 
     flash('Product added successfully')
@@ -681,6 +847,7 @@ def add_product_post(id):
     
 # edit product backend controller
 @app.route("/category/show/<int:id>/product/edit/", methods=['POST'])
+@query_budget(statements=7, rows=10, ms=50)
 def edit_product_post(id):
     name = request.form.get('product_name')
     price = request.form.get('price')
@@ -695,52 +862,23 @@ def edit_product_post(id):
     if not category:
         flash('Category not found')
         return redirect(url_for('admin_dashboard'))
-    if not name or not price or not category_id or not quantity_available or not manu_date:
-        flash('Please fill out all fields')
-        return redirect(url_for('edit_product', id=product.id))
+    # the fields are checked by the same function as the bulk import, see inventory.py
     try:
-        price = float(price)
-        quantity_available = int(quantity_available)
-        manu_date = datetime.strptime(manu_date, '%Y-%m-%d')
-    except ValueError:
-        flash('Price and quantity must be numbers')
+        name, price, quantity_available, manu_date = validate_product_fields(name, price, quantity_available, manu_date)
+    except InvalidProduct as error:
+        flash(str(error))
         return redirect(url_for('edit_product', id=product.id))
-    
-    if quantity_available <= 0:
-        flash('Quantity must be greater than 0')
-        return redirect(url_for('edit_product', id=product.id))
-    if manu_date > datetime.now():
-        flash('Manufacture date cannot be in the future')
-        return redirect(url_for('edit_product', id=product.id))
-
-
-    if image:
-
-        # remove previous file path from database and dir before updating new one
-         # remove file from dir
-        if os.path.exists(product.product_image_path):
-            os.remove(product.product_image_path)
-        
-        # remove path from database
-        product.product_image_path = 'No file yet'
-        db.session.commit()
-
-
 
-        filename = secure_filename(image.filename)
-        existing_paths = [p.product_image_path for p in Product.query.all()]
 
-        if filename and filename in existing_paths:
-            unique_str = str(uuid.uuid4())[:8]
-            image.filename = f"{unique_str}_{image.filename}"
-
-        file_ext = os.path.splitext(filename)[1]
-        if file_ext.lower() not in app.config["UPLOAD_EXTENSIONS"]:
+    if image and image.filename:
+        # the new image takes a reference to its file and the old one gives its reference back,
+        # the old file is removed from the directory after the commit if no other product uses it
+        try:
+            image_path = images.save_image(image)
+        except images.UnsupportedImage:
             flash('"error": "Image extension not supported"')
-            return redirect(url_for('edit_product_post', id=product.id))
-
-        image_path = os.path.join(app.config["UPLOAD_PATH"], image.filename)
-        image.save(image_path)
+            return redirect(url_for('edit_product', id=product.id))
+        images.release_image(product.product_image_path)
         product.product_image_path = image_path
 
 
@@ -749,7 +887,8 @@ def edit_product_post(id):
     product.category_id = category.id
     product.quantity_available = quantity_available
     product.manu_date = manu_date
-    
+    search.index_product(product)  ## updates the product in the search index in the same commit
+    bump_catalog_version()  ## tells the workers to rebuild their cached catalog
     
     db.session.commit()
 
@@ -758,16 +897,125 @@ def edit_product_post(id):
 
 
 @app.route("/category/show/<int:id>/product/delete/", methods=['POST'])
+@query_budget(statements=8, rows=10, ms=50)  ## deleting the product loads its cart lines and orders, see the relationships of Product
 def delete_product_post(id):
     product = Product.query.get(id)
     category = Category.query.get(product.category_id)
+    search.remove_product(product.id)  ## removes the product from the search index in the same commit
+    images.release_image(product.product_image_path)  ## its image file is removed after the commit if no other product uses it
     db.session.delete(product)
+    bump_catalog_version()  ## tells the workers to rebuild their cached catalog
     db.session.commit()
     flash('Product deleted successfully')
     return redirect(url_for('show_category', id=category.id))
 
 
 
+# related html file => product_import.html  ---- serves the page to upload a CSV or JSON file of products, and shows the report of the import
+@app.route("/products/import")
+@admin_required
+@query_budget(statements=1, rows=50, ms=50)
+def import_products_page():
+    return render_template('product_import.html', categories=Category.query.order_by(Category.id).all(), report=None)
+
+
+@app.route("/products/import", methods=['POST'])
+@admin_required
+@query_budget(statements=8, rows=100, ms=100)  ## a batch of the reference import (see inventory.py) and the categories of the page
+def import_products_post():
+    """
+        A function that imports the products of the uploaded file. The rows are read from the
+        upload as they are saved, in batches (see inventory.py), so a large file is not loaded
+        in memory. The rows with an error are skipped and listed in the report with their message.
+
+        Related Html File(s):
+            product_import.html: the upload form and the report of the import.
+    """
+    upload = request.files.get('products_file')
+    if not upload or not upload.filename:
+        flash('No file provided')
+        return redirect(url_for('import_products_page'))
+    format = import_format(upload.filename)
+    if format is None:
+        flash('The file must be a .csv, .json or .jsonl file')
+        return redirect(url_for('import_products_page'))
+    key = request.form.get('key', 'sku')
+    if key not in IMPORT_KEYS:
+        key = 'sku'
+
+    report = import_products(read_rows(upload.stream, format), key=key)
+    flash('Imported {} rows: {} added, {} updated, {} errors'.format(report.rows, report.inserted, report.updated, report.error_count))
+    if report.stopped:
+        flash('{}, the {} products saved before it were kept'.format(report.stopped, report.inserted + report.updated))
+    return render_template('product_import.html', categories=Category.query.order_by(Category.id).all(), report=report)
+
+
+# the admin downloads of the orders, transactions and inventory, linked from the export form in admin.html
+@app.route("/export/<any(orders, transactions, inventory):name>")
+@replica_reads  ## the large exports are read from the replica when there is one
+@admin_required
+@query_budget(statements=2, rows=1000, ms=100)  ## the whole inventory of the reference dataset, or the orders of one user
+def export(name):
+    """
+        A function that sends an export as a CSV or JSON Lines download. The file is streamed
+        while it is read from the database (see exports.py), so the download starts right away
+        whatever the number of rows. The orders and transactions can be filtered with the
+        start and end dates (YYYY-MM-DD) and the username of the query string.
+    """
+    format = request.args.get('format', 'csv')
+    if format not in EXPORT_FORMATS:
+        flash('Unknown export format')
+        return redirect(url_for('admin_dashboard'))
+
+    filters = None
+    if name != 'inventory':
+        try:
+            start, end = (
+                datetime.strptime(request.args[day], '%Y-%m-%d').date() if request.args.get(day) else None
+                for day in ('start', 'end')
+            )
+        except ValueError:
+            flash('Dates must be in the format YYYY-MM-DD')
+            return redirect(url_for('admin_dashboard'))
+        user_id = None
+        if request.args.get('username'):
+            user = User.query.filter_by(username=request.args['username']).first()
+            if not user:
+                flash('User not found')
+                return redirect(url_for('admin_dashboard'))
+            user_id = user.id
+        filters = ExportFilters(start, end, user_id)
+
+    statement = {'orders': orders_query, 'transactions': transactions_query}[name](filters) if filters else inventory_query()
+    # stream_with_context keeps the request and its database session open while the response is sent
+    return Response(
+        stream_with_context(stream_export(statement, format)),
+        mimetype=MIMETYPES[format],
+        headers={'Content-Disposition': 'attachment; filename="{}"'.format(export_filename(name, filters, format))},
+    )
+
+
+# the per-route metrics of all the workers in the Prometheus text format, see metrics.py
+@app.route("/metrics")
+@query_budget(statements=0, rows=0, ms=50)  ## the numbers are read from the files of METRICS_DIR
+def show_metrics():
+    """
+        A function that shows the metrics to Prometheus, with the METRICS_TOKEN in its
+        Authorization header, or to a logged in admin. Not found when the metrics are off.
+    """
+    if not app.config['METRICS_ENABLED']:
+        return 'Not Found', 404
+    token = app.config['METRICS_TOKEN']
+    if token and hmac.compare_digest(request.headers.get('Authorization', ''), 'Bearer ' + token):
+        return metrics_response()
+    return admin_required(metrics_response)()
+
+
+def metrics_response():
+    return Response(metrics.collect(), mimetype='text/plain; version=0.0.4')
+
+
+
 
 
 
@@ -782,6 +1030,7 @@ def delete_product_post(id):
 
 # Edit Back Controller
 @app.route("/category/<int:id>/edit", methods=['POST'])
+@query_budget(statements=4, rows=5, ms=50)
 def edit_category_post(id):
     """
         A function that retrieves the user input from the html input form name
@@ -819,6 +1068,8 @@ def edit_category_post(id):
         # Now, we perform the actual update of the category name in the database with retrieved name from the frontend,
         # `name = request.form.get('category_name')`
         category.cat_name = name
+        search.index_category(category)  ## the category name is part of the search index of its products
+        bump_catalog_version()  ## tells the workers to rebuild their cached catalog
         db.session.commit()
         flash('Category updated successfully')
         return redirect(url_for('admin_dashboard'))
@@ -827,6 +1078,7 @@ def edit_category_post(id):
 
 # Delete Backend Controller
 @app.route("/category/<int:id>/delete", methods=['POST'])
+@query_budget(statements=9, rows=10, ms=50)  ## deleting the products of the category loads their cart lines and orders
 def delete_category_post(id):
     """
         A function that deletes a category from the database.
@@ -849,7 +1101,11 @@ def delete_category_post(id):
         flash("Category not found")
         return redirect(url_for('admin_dashboard'))
     else:
+        search.remove_category(category.id)  ## removes the products of the category from the search index before they are deleted
+        # the products are deleted with the category, so they give back the references to their image files
+        images.release_images(db.session.execute(db.select(Product.product_image_path).filter_by(category_id=category.id)).scalars())
         db.session.delete(category)
+        bump_catalog_version()  ## tells the workers to rebuild their cached catalog
         db.session.commit()
         flash('Category deleted successfully')
         return redirect(url_for('admin_dashboard'))
@@ -877,7 +1133,9 @@ def delete_category_post(id):
 
 
 @app.route('/cart')
+@replica_reads
 @auth_required
+@query_budget(statements=1, rows=20, ms=50)
 def cart_page():
     """
         A function that retrieves the user's cart items from the database
@@ -886,8 +1144,8 @@ def cart_page():
         Related Html File(s):
             cart.html: serves the frontend page which the user interacts with to view their cart items.
     """
-    # retrieves the user's cart items from the database
-    cart_items = Cart.query.filter_by(user_id=session['user_id']).all()
+    # retrieves the user's cart items from the database, with their product in the same query (the template shows it for every line)
+    cart_items = Cart.query.filter_by(user_id=session['user_id']).options(joinedload(Cart.product)).all()
     
     # get the sum of the total price of the cart items
     total_price = sum([cart_item.product.price * cart_item.quantity_added_to_cart for cart_item in cart_items])
@@ -905,6 +1163,7 @@ def cart_page():
 # cart 
 @app.route('/cart/<int:id>/delete', methods=['POST'])
 @auth_required
+@query_budget(statements=2, rows=5, ms=50)
 def cart_delete(id):
     """
         A function that deletes a product from the user's cart.
@@ -945,40 +1204,116 @@ def cart_delete(id):
 # order now button in cart
 @app.route("/order_now", methods=['POST'])
 @auth_required
+@query_budget(statements=18, rows=20, ms=200)  ## the stock of each of the 10 lines of the reference cart is taken by its own UPDATE
 def order_now_button():
-    carts = Cart.query.filter_by(user_id=session['user_id']).all()
+    """
+        A function that orders everything in the user's cart as one database transaction.
+        The stock of every product is taken only if enough of it is left, so concurrent orders
+        can't oversell a product. If any product is out of stock, nothing is ordered and
+        the user is told about every product that is out of stock. Carts with a flash-sale
+        product are ordered in batches by the queue of that product (see flash_sale.py).
+
+        Related Html File(s):
+            cart.html: serves the frontend page with the order now button.
+    """
+    # retrieves the user's cart items with their products in one query
+    carts = Cart.query.filter_by(user_id=session['user_id']).options(joinedload(Cart.product)).all()
 
     if not carts:
         flash('Cart is empty')
         return redirect(url_for('cart_page'))
-    
-    # Add the cart items to the transaction table
-    transaction = Transaction(user_id=session['user_id'], date_time=datetime.now(), price=sum([cart.product.price * cart.quantity_added_to_cart for cart in carts]))
 
-    # Add transaction to the session to generate its id
-    db.session.add(transaction)
+    # carts with a flash-sale product wait for their turn in the queue of that product
+    try:
+        place_cart_order(session['user_id'], cart_lines(carts))
+    except OutOfStock as error:
+        for message in error.messages():
+            flash(message)
+        return redirect(url_for('cart_page'))
+    except CartChanged:
+        flash('Your cart was changed while ordering, please check it and order again')
+        return redirect(url_for('cart_page'))
+    except FlashSaleBusy:
+        flash('Too many orders at the moment, please try again')
+        return redirect(url_for('cart_page'))
+
+    flash('Order placed successfully')
+    return redirect(url_for('cart_page'))
+
+
+######################################  END OF BACKEND CONTROLLER for cart and order now button ###########################################################################
+
+
+
+
+
+
+
+
+######################################  CART JSON API  ###########################################################################
+# JSON endpoints the scripts of index.html and cart.html (static/js/cart.js) call to change the cart
+# without reloading the page, every call costs a few small queries instead of rendering the whole catalog again.
+# The pages still work with the forms and redirects above when scripts are off.
+
+
+@app.route('/api/cart')
+@json_auth_required
+@query_budget(statements=1, rows=1, ms=50)
+def cart_api_summary():
+    """Returns the number of items and the total of the user's cart."""
+    return jsonify(cart_summary(session['user_id']))
+
+
+@app.route('/api/cart/items', methods=['POST'])
+@json_auth_required
+@query_budget(statements=4, rows=5, ms=50)
+def cart_api_add():
+    """
+        Adds one or several products to the user's cart in a single commit.
+        The JSON body is {"items": [{"product_id": 1, "quantity": 2}, ...]}. If any item is invalid
+        nothing is added and the errors of every invalid item are returned with a 400 status.
+    """
+    errors = add_to_cart(session['user_id'], (request.get_json(silent=True) or {}).get('items'))
+    if errors:
+        return jsonify(errors=errors), 400
+
+    return jsonify(message='Product added to cart successfully', **cart_summary(session['user_id']))
+
+
+@app.route('/api/cart/items/<int:id>', methods=['PATCH'])
+@json_auth_required
+@query_budget(statements=3, rows=5, ms=50)
+def cart_api_update(id):
+    """Changes the quantity of a line of the user's cart, the JSON body is {"quantity": 3}."""
+    cart = Cart.query.options(joinedload(Cart.product)).filter_by(id=id, user_id=session['user_id']).first()
+    if not cart:
+        return jsonify(error='Product not found in cart'), 404
+
+    quantity = (request.get_json(silent=True) or {}).get('quantity')
+    if not isinstance(quantity, int) or quantity <= 0 or quantity > cart.product.quantity_available:
+        return jsonify(error='Invalid quantity, should be between 1 and {}'.format(cart.product.quantity_available)), 400
+
+    cart.quantity_added_to_cart = quantity
+    subtotal = quantity * cart.product.price
     db.session.commit()
 
+    return jsonify(id=id, quantity=quantity, subtotal=subtotal, **cart_summary(session['user_id']))
 
-    for cart in carts:
-        order = Order(user_id=session['user_id'], product_id=cart.product_id, quantity=cart.quantity_added_to_cart, transaction_id=transaction.id, price=cart.product.price)
-        # check if the product quantity saved in the cart is less than the total cart quantity
-        if cart.product.quantity_available < cart.quantity_added_to_cart:
-            flash(f'Product, {cart.product.product_name} is out of stock')
-            return redirect(url_for('delete_product', id=cart.id))
-        cart.product.quantity_available -= cart.quantity_added_to_cart
-        
-        db.session.add(order)
-        db.session.delete(cart)
 
-    db.session.add(transaction)
+@app.route('/api/cart/items/<int:id>', methods=['DELETE'])
+@json_auth_required
+@query_budget(statements=2, rows=5, ms=50)
+def cart_api_remove(id):
+    """Removes a line from the user's cart with one delete statement."""
+    deleted = Cart.query.filter_by(id=id, user_id=session['user_id']).delete()
+    if not deleted:
+        return jsonify(error='Product not found in cart'), 404
     db.session.commit()
 
-    flash('Order placed successfully')
-    return redirect(url_for('cart_page'))
+    return jsonify(message='Product removed from cart successfully', **cart_summary(session['user_id']))
 
 
-######################################  END OF BACKEND CONTROLLER for cart and order now button ###########################################################################
+######################################  END OF CART JSON API ###########################################################################
 
 
 
@@ -999,7 +1334,9 @@ def order_now_button():
 ######################################  FRONTEND ROUTE FOR SHOW ORDER TRANSACTION HISTORY ###########################################################################
 
 @app.route("/transaction_history")
+@replica_reads
 @auth_required
+@query_budget(statements=2, rows=150, ms=100)
 def show_orders():
     """
         A function that retrieves the user's order history from the database
@@ -1008,9 +1345,16 @@ def show_orders():
         Related Html File(s):
             transaction_history.html: serves the frontend page which the user interacts with to view their order history.
     """
-    # retrieves the user's order transaction history from the database
-    transactions = Transaction.query.filter_by(user_id=session['user_id']).order_by(Transaction.date_time.desc()).all()
-    return render_template('transaction_history.html', transactions=transactions)
+    # retrieves a page of the user's order transaction history from the database, the latest first.
+    # the orders of the page and their products are loaded with one query each instead of one per transaction and order
+    transactions = Transaction.query.filter_by(user_id=session['user_id']) \
+        .options(selectinload(Transaction.orders).joinedload(Order.product))
+    try:
+        page = keyset_paginate(transactions, TRANSACTION_SORT_ORDER, after=request.args.get('after'), before=request.args.get('before'), per_page=app.config['HISTORY_PAGE_SIZE'])
+    except InvalidCursor:
+        flash('Invalid page')
+        return redirect(url_for('show_orders'))
+    return render_template('transaction_history.html', page=page)
 
 ######################################  END OF FRONTEND ROUTE FOR SHOW ORDER TRANSACTION HISTORY ###########################################################################
 
@@ -0,0 +1,163 @@
+"""
+    A module that contains the daily sales rollups shown on the admin dashboard.
+
+    Every checkout adds the units and revenue of its lines to one row per product and day
+    (product_daily_sales) and one row per category and day (category_daily_sales), in the
+    same database transaction as its orders. The dashboard charts then read at most a row
+    per category and day of the period instead of every order ever placed.
+    'flask sales rebuild' computes the rollups again from the orders, e.g. for the orders
+    placed before the rollups existed.
+"""
+
+from collections import namedtuple
+from datetime import date, timedelta
+
+import click
+from sqlalchemy import func, update, insert, delete
+from sqlalchemy.dialects import sqlite, postgresql
+
+from config import app
+from models import db, Product, Category, Order, Transaction, ProductDailySales, CategoryDailySales
+
+
+# the periods of the dashboard charts, in days
+SALES_PERIODS = (7, 30, 365)
+
+# the totals of a period: the revenue, units and order lines, the totals of each day, each category and the best selling products
+SalesReport = namedtuple('SalesReport', ['days', 'start', 'end', 'revenue', 'units', 'orders', 'daily', 'categories', 'top_products'])
+DailyTotal = namedtuple('DailyTotal', ['day', 'revenue', 'units'])
+CategoryTotal = namedtuple('CategoryTotal', ['category_id', 'cat_name', 'revenue', 'units'])
+ProductTotal = namedtuple('ProductTotal', ['product_id', 'product_name', 'revenue', 'units'])
+
+
+def record_sales(day, lines):
+    """
+        Adds the cart lines of a checkout to the rollups of the day, in the current database transaction.
+
+        Args:
+            day: the date of the checkout.
+            lines: the CartLine of every line ordered, each product at most once.
+    """
+    products, categories = [], {}
+    for line in sorted(lines, key=lambda line: line.product_id):
+        revenue = line.price * line.quantity
+        products.append(dict(day=day, product_id=line.product_id, category_id=line.category_id, units=line.quantity, revenue=revenue, orders=1))
+        category = categories.setdefault(line.category_id, dict(day=day, category_id=line.category_id, units=0, revenue=0, orders=0))
+        category['units'] += line.quantity
+        category['revenue'] += revenue
+        category['orders'] += 1
+    # the rows are always locked in the same order, products then categories by id, so concurrent checkouts don't deadlock
+    _add_to_rollup(ProductDailySales, ['day', 'product_id'], products)
+    _add_to_rollup(CategoryDailySales, ['day', 'category_id'], [categories[category_id] for category_id in sorted(categories)])
+
+
+def _add_to_rollup(model, key_columns, rows):
+    """Adds the units, revenue and orders of the rows to the rollup rows with the same keys, making the missing ones."""
+    if not rows:
+        return
+    table = model.__table__
+    dialect = db.session.get_bind().dialect.name
+    if dialect in ('sqlite', 'postgresql'):
+        # one INSERT ... ON CONFLICT DO UPDATE adds to the existing rows and makes the new ones
+        dialect_insert = sqlite.insert if dialect == 'sqlite' else postgresql.insert
+        statement = dialect_insert(table).values(rows)
+        statement = statement.on_conflict_do_update(index_elements=key_columns, set_={
+            column: table.c[column] + statement.excluded[column] for column in ('units', 'revenue', 'orders')
+        })
+        db.session.execute(statement)
+        return
+
+    for row in rows:
+        key = [table.c[column] == row[column] for column in key_columns]
+        result = db.session.execute(update(table).where(*key).values(
+            units=table.c.units + row['units'], revenue=table.c.revenue + row['revenue'], orders=table.c.orders + row['orders'],
+        ))
+        if result.rowcount == 0:
+            db.session.execute(insert(table).values(**row))
+
+
+def sales_report(days, today=None):
+    """Returns the SalesReport of the last days, today included, read from the rollups."""
+    end = today or date.today()
+    start = end - timedelta(days=days - 1)
+    in_period = CategoryDailySales.day.between(start, end)
+
+    totals = {
+        day: (revenue, units, orders) for day, revenue, units, orders in db.session.execute(
+            db.select(CategoryDailySales.day, func.sum(CategoryDailySales.revenue), func.sum(CategoryDailySales.units), func.sum(CategoryDailySales.orders))
+            .where(in_period).group_by(CategoryDailySales.day)
+        )
+    }
+    # every day of the period has a bar, the days without sales are 0
+    daily = [
+        DailyTotal(day, *totals.get(day, (0, 0, 0))[:2])
+        for day in (start + timedelta(days=offset) for offset in range(days))
+    ]
+
+    categories = [
+        CategoryTotal(*row) for row in db.session.execute(
+            db.select(CategoryDailySales.category_id, func.coalesce(Category.cat_name, '(deleted)'),
+                      func.sum(CategoryDailySales.revenue), func.sum(CategoryDailySales.units))
+            .outerjoin(Category, Category.id == CategoryDailySales.category_id)
+            .where(in_period)
+            .group_by(CategoryDailySales.category_id, Category.cat_name)
+            .order_by(func.sum(CategoryDailySales.revenue).desc())
+        )
+    ]
+    top_products = [
+        ProductTotal(*row) for row in db.session.execute(
+            db.select(ProductDailySales.product_id, func.coalesce(Product.product_name, '(deleted)'),
+                      func.sum(ProductDailySales.revenue), func.sum(ProductDailySales.units))
+            .outerjoin(Product, Product.id == ProductDailySales.product_id)
+            .where(ProductDailySales.day.between(start, end))
+            .group_by(ProductDailySales.product_id, Product.product_name)
+            .order_by(func.sum(ProductDailySales.revenue).desc())
+            .limit(10)
+        )
+    ]
+    return SalesReport(
+        days, start, end,
+        revenue=sum(total.revenue for total in daily), units=sum(total.units for total in daily), orders=sum(total[2] for total in totals.values()),
+        daily=daily, categories=categories, top_products=top_products,
+    )
+
+
+def rebuild_sales():
+    """Computes the rollups again from all the orders, in the current database transaction."""
+    db.session.execute(delete(ProductDailySales))
+    db.session.execute(delete(CategoryDailySales))
+    product_rows = db.session.execute(
+        db.select(Transaction.date_time, Order.product_id, Product.category_id,
+                  func.sum(Order.quantity), func.sum(Order.subtotal), func.count(Order.id))
+        .join(Transaction, Transaction.id == Order.transaction_id)
+        .join(Product, Product.id == Order.product_id)
+        .group_by(Transaction.date_time, Order.product_id, Product.category_id)
+    ).all()
+
+    categories = {}
+    for day, product_id, category_id, units, revenue, orders in product_rows:
+        category = categories.setdefault((day, category_id), dict(day=day, category_id=category_id, units=0, revenue=0, orders=0))
+        category['units'] += units
+        category['revenue'] += revenue
+        category['orders'] += orders
+    if product_rows:
+        db.session.execute(insert(ProductDailySales), [
+            dict(day=day, product_id=product_id, category_id=category_id, units=units, revenue=revenue, orders=orders)
+            for day, product_id, category_id, units, revenue, orders in product_rows
+        ])
+        db.session.execute(insert(CategoryDailySales), list(categories.values()))
+    return len(product_rows), len(categories)
+
+
+##################################### flask sales COMMANDS ##########################################################
+@app.cli.group('sales')
+def sales_cli():
+    """The daily sales rollups of the admin dashboard."""
+
+
+@sales_cli.command('rebuild')
+def rebuild_command():
+    """Computes the daily sales rollups again from all the orders."""
+    products, categories = rebuild_sales()
+    db.session.commit()
+    click.echo('rebuilt {} product and {} category rollup rows'.format(products, categories))
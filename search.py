@@ -0,0 +1,146 @@
+"""
+    A module that contains the full-text product search of the storefront.
+
+    Products are indexed in an SQLite FTS5 virtual table named product_search,
+    one row per product (the rowid is the product id) with the product name,
+    description and category name. The routes that change products and categories
+    keep the index in sync in the same database transaction as the change.
+    Other databases don't have FTS5, there the search falls back to a substring match.
+"""
+
+import re
+
+from sqlalchemy import text, func, literal_column, column, table, bindparam, Float
+
+from models import db, Product
+
+
+SEARCH_TABLE = 'product_search'
+
+# lightweight description of the virtual table, to use it in the queries of the routes
+product_search = table(SEARCH_TABLE, column('rowid'), column(SEARCH_TABLE))
+
+# bm25 weights of the product_name, description and category_name columns, a match in the name counts the most
+BM25_WEIGHTS = (10.0, 1.0, 4.0)
+
+
+def search_enabled():
+    """Returns True if the database supports the FTS5 search index."""
+    return db.engine.dialect.name == 'sqlite'
+
+
+def create_search_index():
+    """
+        Creates the product_search table if it doesn't exist yet and fills it
+        with the products that are already in the database.
+    """
+    if not search_enabled():
+        return
+    exists = db.session.execute(text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"), {'name': SEARCH_TABLE}).first()
+    if exists:
+        return
+    # the prefix option keeps extra indexes of the first 2 and 3 characters of every word for fast prefix queries
+    db.session.execute(text(
+        f"CREATE VIRTUAL TABLE {SEARCH_TABLE} USING fts5("
+        "product_name, description, category_name, "
+        "tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')"
+    ))
+    rebuild_search_index()
+    db.session.commit()
+
+
+def rebuild_search_index():
+    """Indexes all products again, used to create the index or to repair it."""
+    if not search_enabled():
+        return
+    db.session.flush()
+    db.session.execute(text(f"DELETE FROM {SEARCH_TABLE}"))
+    _index_products_where("1 = 1", {})
+
+
+def _index_products_where(condition, params, expanding=()):
+    # the rows are copied straight from the product and category tables, so they match what was flushed in this transaction.
+    # expanding names the list parameters of an IN condition
+    db.session.execute(text(
+        f"INSERT INTO {SEARCH_TABLE} (rowid, product_name, description, category_name) "
+        "SELECT product.id, product.product_name, coalesce(product.description, ''), category.cat_name "
+        "FROM product JOIN category ON category.id = product.category_id "
+        f"WHERE {condition}"
+    ).bindparams(*[bindparam(name, expanding=True) for name in expanding]), params)
+
+
+def index_product(product):
+    """Adds or updates the index row of a product, call it after the product is flushed."""
+    if not search_enabled():
+        return
+    db.session.flush()
+    remove_product(product.id)
+    _index_products_where("product.id = :id", {'id': product.id})
+
+
+def index_products(product_ids):
+    """Adds or updates the index rows of many products at once, e.g. a batch of the bulk import."""
+    if not search_enabled() or not product_ids:
+        return
+    db.session.flush()
+    params = {'ids': list(product_ids)}
+    db.session.execute(text(f"DELETE FROM {SEARCH_TABLE} WHERE rowid IN :ids").bindparams(bindparam('ids', expanding=True)), params)
+    _index_products_where("product.id IN :ids", params, expanding=['ids'])
+
+
+def remove_product(product_id):
+    """Removes the index row of a product."""
+    if not search_enabled():
+        return
+    db.session.execute(text(f"DELETE FROM {SEARCH_TABLE} WHERE rowid = :id"), {'id': product_id})
+
+
+def index_category(category):
+    """Updates the index rows of all products of a category, after the category is renamed."""
+    if not search_enabled():
+        return
+    db.session.flush()
+    remove_category(category.id)
+    _index_products_where("product.category_id = :id", {'id': category.id})
+
+
+def remove_category(category_id):
+    """Removes the index rows of all products of a category, call it before the category is deleted."""
+    if not search_enabled():
+        return
+    db.session.execute(text(
+        f"DELETE FROM {SEARCH_TABLE} WHERE rowid IN (SELECT id FROM product WHERE category_id = :id)"
+    ), {'id': category_id})
+
+
+def match_query(terms):
+    """
+        Turns the words typed in the search bar into an FTS5 query where every word
+        must match the start of a word in the product, e.g. 'sam gal' => "sam"* "gal"*.
+        Returns None if there are no words to search for.
+    """
+    words = re.findall(r'\w+', terms)
+    if not words:
+        return None
+    return ' '.join('"{}"*'.format(word) for word in words)
+
+
+def search_products(products, terms):
+    """
+        Filters a Product query down to the products matching the search terms.
+
+        Returns the filtered query and the bm25 rank column of each product to order by
+        (lower is a better match), or None as rank when the database has no FTS5 index.
+    """
+    if not search_enabled():
+        return products.filter(Product.product_name.icontains(terms, autoescape=True)), None
+
+    query = match_query(terms)
+    if query is None:
+        return products.filter(db.false()), None
+
+    rank = func.bm25(literal_column(SEARCH_TABLE), *BM25_WEIGHTS, type_=Float)
+    matches = db.select(product_search.c.rowid.label('product_id'), rank.label('rank')) \
+        .where(literal_column(SEARCH_TABLE).op('MATCH')(query)) \
+        .subquery()
+    return products.join(matches, matches.c.product_id == Product.id), matches.c.rank
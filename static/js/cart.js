@@ -0,0 +1,101 @@
+/*
+    Progressive enhancement of the cart forms of index.html and cart.html.
+
+    With scripts on, adding to the cart, changing a quantity and removing a line call the
+    JSON cart endpoints (/api/cart...) and update the page in place, instead of posting the
+    form and rendering the whole page again. Without scripts the forms still work as before.
+*/
+(function () {
+    'use strict';
+
+    // shows a message like the flash messages of flash_message.html, green when successful
+    function showMessage(text, success) {
+        var alert = document.createElement('div');
+        alert.className = 'alert ' + (success ? 'alert-success' : 'alert-danger');
+        alert.setAttribute('role', 'alert');
+        alert.textContent = text;
+        var container = document.querySelector('.container');
+        container.insertBefore(alert, container.firstChild);
+        setTimeout(function () { alert.remove(); }, 4000);
+    }
+
+    // updates the cart item count in the navbar and the total on the cart page
+    function updateSummary(summary) {
+        document.querySelectorAll('[data-cart-count]').forEach(function (element) {
+            element.textContent = summary.count;
+        });
+        document.querySelectorAll('[data-cart-total]').forEach(function (element) {
+            element.textContent = summary.total;
+        });
+    }
+
+    // sends a JSON request and returns the response status and the decoded body
+    function send(method, url, body) {
+        return fetch(url, {
+            method: method,
+            credentials: 'same-origin',
+            headers: {'Content-Type': 'application/json', 'Accept': 'application/json'},
+            body: body === undefined ? undefined : JSON.stringify(body)
+        }).then(function (response) {
+            return response.json().then(function (data) {
+                return {ok: response.ok, data: data};
+            });
+        });
+    }
+
+    function errorText(data) {
+        if (data.errors) {
+            return data.errors.map(function (error) { return error.error; }).join(', ');
+        }
+        return data.error || 'Something went wrong, please try again';
+    }
+
+    // index.html: the add to cart form of every product
+    document.querySelectorAll('form[data-add-to-cart]').forEach(function (form) {
+        form.addEventListener('submit', function (event) {
+            event.preventDefault();
+            var quantity = parseInt(form.elements.quantity_input.value, 10);
+            send('POST', form.dataset.addToCart, {items: [{product_id: parseInt(form.dataset.productId, 10), quantity: quantity}]})
+                .then(function (result) {
+                    if (result.ok) {
+                        updateSummary(result.data);
+                        showMessage(result.data.message, true);
+                    } else {
+                        showMessage(errorText(result.data), false);
+                    }
+                });
+        });
+    });
+
+    // cart.html: the quantity input and the remove form of every cart line
+    document.querySelectorAll('tr[data-cart-line]').forEach(function (row) {
+        var quantityInput = row.querySelector('input[name="quantity"]');
+        if (quantityInput) {
+            quantityInput.addEventListener('change', function () {
+                send('PATCH', row.dataset.cartLine, {quantity: parseInt(quantityInput.value, 10)})
+                    .then(function (result) {
+                        if (result.ok) {
+                            row.querySelector('[data-line-subtotal]').textContent = result.data.subtotal;
+                            updateSummary(result.data);
+                        } else {
+                            quantityInput.value = quantityInput.defaultValue;
+                            showMessage(errorText(result.data), false);
+                        }
+                    });
+            });
+        }
+
+        row.querySelector('form[data-remove-from-cart]').addEventListener('submit', function (event) {
+            event.preventDefault();
+            send('DELETE', row.dataset.cartLine).then(function (result) {
+                if (result.ok) {
+                    row.remove();
+                    updateSummary(result.data);
+                    showMessage(result.data.message, true);
+                } else {
+                    showMessage(errorText(result.data), false);
+                }
+            });
+        });
+    });
+})();
@@ -0,0 +1,261 @@
+"""
+    A module that contains the resized copies (variants) of the product images.
+
+    The uploads are often photos and screenshots of several MB, while a storefront card
+    is 18rem wide. After an upload is committed, its image is queued to a background thread
+    of the worker that makes a WebP and a JPEG copy at each of the IMAGE_VARIANT_WIDTHS,
+    saves them next to the original (static/images/3f/3f2a...c9-320.webp) and lists them
+    in the image_variant table. The templates render the images with the product_image
+    macro, which picks the variants in a srcset, or the original until they are made.
+    Images queued in a worker that stopped before making them are made again with
+    'flask images variants'. New variants raise their own version (a row of the
+    catalog_version table), not the catalog version, so the orders changing the stock
+    don't make the workers read the variants again.
+
+    Pillow is needed to make the variants, without it the originals are served as before.
+"""
+
+import os
+import queue
+import tempfile
+import threading
+import time
+from collections import namedtuple
+
+from sqlalchemy import event, delete
+
+from config import app
+from models import db, ImageBlob, ImageVariant
+from catalog import bump_version, catalog_version_row
+from assets import asset_url
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  ## Pillow is not installed, the variants are not made
+    Image = None
+
+
+# the catalog_version row of the variants, raised when variants are made
+VARIANTS_VERSION_ID = 2
+
+# the formats of the variants, as (format, Pillow format, file extension), the first one is preferred by the browsers that support it
+VARIANT_FORMATS = [('webp', 'WEBP', '.webp'), ('jpeg', 'JPEG', '.jpg')]
+
+
+def variant_widths(width):
+    """Returns the widths of the variants of an image of the given width, an image is never made larger."""
+    widths = [variant_width for variant_width in app.config['IMAGE_VARIANT_WIDTHS'] if variant_width < width]
+    if len(widths) < len(app.config['IMAGE_VARIANT_WIDTHS']):
+        widths.append(width)  ## a small image still gets a lighter copy at its own size
+    return widths
+
+
+def variant_path(path, width, extension):
+    """Returns the path of a variant, next to the original image."""
+    return '{}-{}{}'.format(os.path.splitext(path)[0], width, extension)
+
+
+def make_variants(sha256, path):
+    """
+        Makes the missing variants of an image and saves their image_variant rows in the current
+        database transaction. Returns the number of variants made, 0 if the image is gone or unreadable.
+    """
+    if Image is None:
+        return 0
+    if db.session.get(ImageBlob, sha256) is None:
+        return 0  ## the image was removed before its turn
+    existing = set(db.session.execute(
+        db.select(ImageVariant.format, ImageVariant.width).filter_by(sha256=sha256)
+    ).all())
+
+    try:
+        with Image.open(path) as opened:
+            original = ImageOps.exif_transpose(opened)  ## phone photos are stored sideways with a rotation tag
+            if original.mode not in ('RGB', 'RGBA'):
+                original = original.convert('RGBA' if 'transparency' in original.info or original.mode in ('LA', 'PA') else 'RGB')
+
+            made = 0
+            for width in variant_widths(original.width):
+                height = max(1, round(original.height * width / original.width))
+                resized = None
+                for format, pillow_format, extension in VARIANT_FORMATS:
+                    if (format, width) in existing:
+                        continue
+                    if resized is None:
+                        resized = original.resize((width, height), Image.LANCZOS)
+                    image = resized
+                    if pillow_format == 'JPEG' and image.mode == 'RGBA':
+                        # JPEG has no transparency, the transparent parts become white like the card behind them
+                        image = Image.new('RGB', resized.size, 'white')
+                        image.paste(resized, mask=resized.getchannel('A'))
+                    destination = variant_path(path, width, extension)
+                    size = _save(image, destination, pillow_format)
+                    db.session.add(ImageVariant(sha256=sha256, format=format, width=width, height=height, path=destination, size=size))
+                    made += 1
+            return made
+    except (OSError, Image.DecompressionBombError):
+        app.logger.exception('could not make the variants of image %s', path)
+        return 0
+
+
+def _save(image, destination, pillow_format):
+    # written to a temporary file first, so a page never links to a half written variant
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(destination), prefix='.variant-')
+    try:
+        with os.fdopen(fd, 'wb') as temp_file:
+            if pillow_format == 'JPEG':
+                image.save(temp_file, pillow_format, quality=app.config['IMAGE_VARIANT_QUALITY'], optimize=True, progressive=True)
+            else:
+                image.save(temp_file, pillow_format, quality=app.config['IMAGE_VARIANT_QUALITY'], method=4)
+        os.replace(temp_path, destination)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return os.path.getsize(destination)
+
+
+def remove_variants(sha256):
+    """Deletes the image_variant rows of an image in the current transaction, returns the paths of their files."""
+    paths = list(db.session.execute(db.select(ImageVariant.path).filter_by(sha256=sha256)).scalars())
+    if paths:
+        db.session.execute(delete(ImageVariant).where(ImageVariant.sha256 == sha256))
+    return paths
+
+
+class VariantWorker:
+    """The background thread of this worker making the variants of the images uploaded in it."""
+
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, sha256, path):
+        """Queues an image whose upload was committed."""
+        if Image is None:
+            return
+        self._start()
+        self._queue.put((sha256, path))
+
+    def _start(self):
+        # started by the first upload, so it runs in the gunicorn worker and not in the master process
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='image-variants', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            sha256, path = self._queue.get()
+            with app.app_context():
+                try:
+                    if make_variants(sha256, path):
+                        bump_variants_version()  ## the workers pick up the new srcset
+                    db.session.commit()
+                except Exception:
+                    db.session.rollback()
+                    app.logger.exception('could not save the variants of image %s', path)
+
+
+variant_worker = VariantWorker()
+
+
+def bump_variants_version():
+    """Raises the version of the variants in the current transaction, call it before committing new variants."""
+    bump_version(VARIANTS_VERSION_ID)
+    db.session.info['variants_changed'] = True
+
+
+def queue_variants(sha256, path):
+    """Makes the variants of an image in the background once the current transaction is committed."""
+    db.session.info.setdefault('images_to_resize', []).append((sha256, path))
+
+
+@event.listens_for(db.session, 'after_commit')
+def _submit_committed_images(session):
+    for sha256, path in session.info.pop('images_to_resize', []):
+        variant_worker.submit(sha256, path)
+
+
+@event.listens_for(db.session, 'after_commit')
+def _invalidate_image_sets(session):
+    if session.info.pop('variants_changed', False):
+        image_sets.invalidate()  ## this worker shows the variants it made on its next page
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _forget_rolled_back_images(session):
+    session.info.pop('images_to_resize', None)
+    session.info.pop('variants_changed', None)
+
+
+##################################### srcset of the templates ##########################################################
+# the variants of an image for its <picture> element: the size of the largest variant, the url to use
+# without srcset support and the srcset of each format
+ImageSet = namedtuple('ImageSet', ['width', 'height', 'src', 'srcsets'])
+
+
+class ImageSetCache:
+    """
+        The ImageSet of every image with variants, loaded once per version of the variants in each worker.
+
+        Args:
+            ttl: number of seconds the image sets are used without checking the version in the database.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._version = None
+        self._image_sets = {}
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+    def get(self, path):
+        if time.monotonic() - self._checked_at >= self.ttl:
+            with self._lock:
+                if time.monotonic() - self._checked_at >= self.ttl:
+                    version = catalog_version_row(VARIANTS_VERSION_ID)[0]
+                    if version != self._version:
+                        self._image_sets = self._load()
+                        self._version = version
+                    self._checked_at = time.monotonic()
+        return self._image_sets.get(path)
+
+    def invalidate(self):
+        """Makes the next get check the version of the variants in the database."""
+        self._checked_at = 0.0
+
+    def _load(self):
+        rows = db.session.execute(
+            db.select(ImageBlob.path, ImageVariant.format, ImageVariant.width, ImageVariant.height, ImageVariant.path)
+            .join(ImageVariant, ImageVariant.sha256 == ImageBlob.sha256)
+            .order_by(ImageBlob.path, ImageVariant.width)
+        ).all()
+        variants = {}
+        for original, format, width, height, path in rows:
+            variants.setdefault(original, []).append((format, width, height, asset_url(path)))
+
+        image_sets = {}
+        for original, image_variants in variants.items():
+            srcsets = {
+                format: ', '.join('{} {}w'.format(url, width) for variant_format, width, height, url in image_variants if variant_format == format)
+                for format, pillow_format, extension in VARIANT_FORMATS
+            }
+            jpegs = [variant for variant in image_variants if variant[0] == 'jpeg']
+            if not jpegs:
+                continue
+            # the fallback src is the copy that fills a card on a retina screen
+            src = next((url for format, width, height, url in jpegs if width >= 576), jpegs[-1][3])
+            format, width, height, url = jpegs[-1]
+            image_sets[original] = ImageSet(width, height, src, srcsets)
+        return image_sets
+
+
+image_sets = ImageSetCache(ttl=app.config['CATALOG_CACHE_TTL'])
+
+
+@app.template_global()
+def image_set(path):
+    """Returns the ImageSet of a product image for the product_image macro, or None until its variants are made."""
+    return image_sets.get(path)
@@ -0,0 +1,14 @@
+"""
+    The WSGI entry point of the app for production, e.g. gunicorn -c gunicorn.conf.py.
+
+    The app is warmed up when this module is imported (see app.warm_up). With preload_app
+    (gunicorn --preload) that happens once in the master process before the workers are forked,
+    so every worker starts with the compiled templates and the filled catalog cache.
+    Run 'flask init-db' before starting it.
+"""
+
+from app import create_app, warm_up
+
+
+application = create_app()
+warm_up(application)